@@ -1,6 +1,12 @@
-import os, itertools
-from scipy.stats import norm
-from numpy import mean, std
+#!/usr/bin/env python
+
+# Gaussian naive Bayes classifier. Importing this module only defines the
+# loaders and the Reverand model; run it to train, predict with or evaluate a
+# saved model from the command line.
+
+import os, sys, itertools, multiprocessing, optparse, cPickle, shutil
+import numpy
+from numpy import array, asarray, dot, log, pi, sqrt
 
 def parse(x):
     data = filter(None, [y.split() for y in open(x).read().split("\n")])
@@ -9,23 +15,246 @@ def parse(x):
         rv[float(targ)] = tuple((map(float, x[1:]) for x in feat))
     return rv
 
-train = parse("train.data")
-test = list(itertools.chain(*parse("test.data").itervalues()))
-val = list(itertools.chain(*parse("train.data").itervalues()))
+# Bytes of text parsed into an array at a time by chunks, and rows handed
+# out at a time by blocks for training and scoring.
+LOAD_CHUNK = 16 << 20
+CHUNK_ROWS = 65536
+
+# Fraction of the largest variance of any feature, over all classes, added to
+# every variance, so a class with one point or a feature that is constant
+# within a class still has a usable Gaussian.
+VAR_SMOOTHING = 1e-9
+
+def chunks(x, size=LOAD_CHUNK):
+    """Yields the rows of data file x as 2-D float arrays, label first,
+    parsing about size bytes of text at a time."""
+    ncols = None
+    with open(x, "rb") as f:
+        tail = ""
+        while True:
+            data = f.read(size)
+            text = tail + data
+            if data:
+                # Hold back any partial last line for the next chunk.
+                cut = text.rfind("\n") + 1
+                text, tail = text[:cut], text[cut:]
+            lines = [line for line in text.splitlines() if line.strip()]
+            if lines:
+                if ncols is None:
+                    ncols = len(lines[0].split())
+                # Any run of spaces, tabs and newlines separates values, so
+                # rows are checked for their number of fields one by one: a
+                # short row next to a long one would otherwise shift every
+                # later feature. fromstring stops quietly at the first value
+                # it cannot parse, so check that every row was read in full.
+                values = numpy.fromstring(text, sep=" ")
+                if (len(values) != len(lines) * ncols or
+                        any(len(line.split()) != ncols for line in lines)):
+                    _bad_row(x, lines, ncols)
+                yield values.reshape(-1, ncols)
+            if not data:
+                return
+
+def _bad_row(x, lines, ncols):
+    for line in lines:
+        row = line.split()
+        if len(row) != ncols:
+            raise ValueError("%s: expected %d columns in row %r"
+                             % (x, ncols, line))
+        try:
+            map(float, row)
+        except ValueError:
+            raise ValueError("%s: bad number in row %r" % (x, line))
+    raise ValueError("%s: could not parse rows" % x)
+
+def groups(labels, features):
+    """The rows of features by class, as a dict like parse returns."""
+    return dict((targ, features[labels == targ]) for targ in numpy.unique(labels))
+
+def stream(x, size=CHUNK_ROWS, cache=True):
+    """Yields dicts of class to points, like parse, for size rows of the file
+    at a time."""
+    for rows in blocks(x, size, cache):
+        yield groups(rows[:, 0], rows[:, 1:])
+
+def _stamp(x):
+    st = os.stat(x)
+    return array([st.st_mtime, st.st_size], dtype=float)
+
+def _load_cache(x, stamp):
+    try:
+        with numpy.load(x + ".npz") as meta:
+            if not (meta["stamp"] == stamp).all():
+                return None
+        return numpy.load(x + ".npy", mmap_mode="r")
+    except (IOError, KeyError, ValueError):
+        return None
+
+def _build_cache(x, stamp):
+    # The rows are parsed a chunk at a time into a raw file, then copied behind
+    # a .npy header once their number is known, so memory stays bounded. Each
+    # file is written under a temporary name and renamed into place, so a
+    # reader never sees half a cache.
+    raw, tmp = x + ".npy.raw", x + ".npy.tmp"
+    try:
+        nrows, ncols = 0, 1
+        with open(raw, "wb") as f:
+            for part in chunks(x):
+                part.tofile(f)
+                nrows, ncols = nrows + len(part), part.shape[1]
+        with open(tmp, "wb") as f:
+            numpy.lib.format.write_array_header_1_0(f, {
+                "descr": numpy.lib.format.dtype_to_descr(numpy.dtype(float)),
+                "fortran_order": False, "shape": (nrows, ncols)})
+            with open(raw, "rb") as data:
+                shutil.copyfileobj(data, f, 1 << 20)
+        os.rename(tmp, x + ".npy")
+        with open(x + ".npz.tmp", "wb") as f:
+            numpy.savez(f, stamp=stamp)
+        os.rename(x + ".npz.tmp", x + ".npz")
+    except (IOError, OSError):
+        return None
+    finally:
+        for path in (raw, tmp):
+            if os.path.exists(path):
+                os.unlink(path)
+    return _load_cache(x, stamp)
+
+def _cached(x):
+    """The rows of data file x memory-mapped from its cache, building the
+    cache first if it is missing or stale, or None if it cannot be written."""
+    stamp = _stamp(x)
+    rows = _load_cache(x, stamp)
+    return rows if rows is not None else _build_cache(x, stamp)
+
+def blocks(x, size=CHUNK_ROWS, cache=True):
+    """Yields the rows of data file x, label first, size rows at a time. With
+    cache they are sliced from its memory-mapped cache (see load); without,
+    or if the cache cannot be written, they are parsed as they are read."""
+    rows = _cached(x) if cache else None
+    if rows is None:
+        for part in chunks(x):
+            for i in xrange(0, len(part), size):
+                yield part[i:i + size]
+        return
+    for i in xrange(0, len(rows), size):
+        yield rows[i:i + size]
+
+def load(x, cache=True):
+    """Returns (labels, features) for data file x: a vector of class labels
+    and a matrix with a row of features for each. With cache, the parsed rows
+    are saved beside x in x.npy, with x.npz recording the mtime and size of x
+    they came from, and later loads memory-map x.npy instead of parsing until
+    x changes."""
+    rows = _cached(x) if cache else None
+    if rows is None:
+        parts = list(chunks(x))
+        rows = numpy.concatenate(parts) if parts else numpy.zeros((0, 1))
+    return rows[:, 0], rows[:, 1:]
 
 class Reverand:
-    def __init__(s, data):
-        s.data = data
-        s.n = len(list(itertools.chain(*data.itervalues())))
+    var_smoothing = VAR_SMOOTHING
+
+    def __init__(s, data=None, var_smoothing=VAR_SMOOTHING):
+        # Per-class sufficient statistics: number of points, mean and sum of
+        # squared deviations from the mean (M2) of each feature.
+        s.count = {}
+        s.mean = {}
+        s.m2 = {}
+        s.var_smoothing = var_smoothing
+        s._update()
+        if data:
+            s.partial_fit(data)
+
+    def partial_fit(s, batch):
+        """Adds a batch of labelled points, a dict of class to points like
+        parse returns, updating the statistics with Chan's parallel form of
+        Welford's algorithm."""
+        for targ, points in batch.iteritems():
+            points = asarray(points, dtype=float)
+            if not len(points):
+                continue
+            mu = points.mean(axis=0)
+            s._combine(targ, len(points), mu, ((points - mu) ** 2).sum(axis=0))
+        s._update()
+        return s
+
+    def merge(s, other):
+        """Adds the points other was trained on, exactly as if they had been
+        passed to partial_fit."""
+        for targ in other.count:
+            s._combine(targ, other.count[targ], other.mean[targ],
+                       other.m2[targ])
+        s._update()
+        return s
+
+    def _combine(s, targ, n, mu, m2):
+        if targ not in s.count:
+            s.count[targ], s.mean[targ], s.m2[targ] = n, mu, m2
+            return
+        total = s.count[targ] + n
+        delta = mu - s.mean[targ]
+        s.mean[targ] = s.mean[targ] + delta * n / total
+        s.m2[targ] = s.m2[targ] + m2 + delta ** 2 * s.count[targ] * n / total
+        s.count[targ] = total
+
+    def _update(s):
+        s.n = sum(s.count.itervalues())
         s.prior = {}
         s.cond = {}
-        s.nfeat = len(data[0]) - 1
-        for targ, points in data.iteritems():
-            s.prior[targ] = len(points) / float(s.n)
-            for i, feat in enumerate(zip(*points)):
-                s.cond[i, targ] = mean(feat), std(feat)
-                
+        s.nfeat = min([len(mu) for mu in s.mean.itervalues()] or [0])
+        s.var = {}
+        s._smooth()
+        for targ, count in s.count.iteritems():
+            s.prior[targ] = count / float(s.n)
+            s.var[targ] = s.m2[targ][:s.nfeat] / count + s.epsilon
+            for i in range(s.nfeat):
+                s.cond[i, targ] = s.mean[targ][i], sqrt(s.var[targ][i])
+        s._vectorize()
+
+    def _smooth(s):
+        # Variance of each feature over the points of every class, from the
+        # per-class statistics, and the floor it sets on the class variances.
+        s.epsilon = 0.
+        if not s.n or not s.nfeat:
+            return
+        mean = sum(count * s.mean[targ][:s.nfeat]
+                   for targ, count in s.count.iteritems()) / s.n
+        m2 = sum(s.m2[targ][:s.nfeat]
+                 + count * (s.mean[targ][:s.nfeat] - mean) ** 2
+                 for targ, count in s.count.iteritems())
+        s.epsilon = s.var_smoothing * ((m2 / s.n).max() or 1.)
+
+    def _vectorize(s):
+        # Per-class rows of the log-likelihood terms, so predict can score
+        # every row against every class with two matrix products.
+        s.classes = array(sorted(s.prior))
+        shape = len(s.classes), s.nfeat
+        means = array([s.mean[targ][:s.nfeat]
+                       for targ in s.classes]).reshape(shape)
+        inv_var = 1 / array([s.var[targ]
+                             for targ in s.classes]).reshape(shape)
+        s._sq = -0.5 * inv_var
+        s._lin = means * inv_var
+        s._const = (log([s.prior[targ] for targ in s.classes])
+                    + 0.5 * log(inv_var / (2 * pi)).sum(axis=1)
+                    - 0.5 * (means ** 2 * inv_var).sum(axis=1))
+
+    def log_likelihood(s, X):
+        """Log of prior times likelihood for each row of X (a 2-D array of
+        samples) and each class in s.classes, as an array of shape
+        (len(X), len(s.classes))."""
+        X = asarray(X, dtype=float)[:, :s.nfeat]
+        return dot(X ** 2, s._sq.T) + dot(X, s._lin.T) + s._const
+
+    def predict(s, X):
+        """Most probable class for each row of X, like calling s on every
+        row, but in log space so long feature vectors do not underflow."""
+        return s.classes[s.log_likelihood(X).argmax(axis=1)]
+
     def __call__(s, feat):
+        # scipy is slow to import and only needed for this per-row path.
+        from scipy.stats import norm
         posterior = {}
         for targ, prior in s.prior.iteritems():
             posterior[targ] = prior
@@ -33,7 +262,129 @@ class Reverand:
                 posterior[targ] *= norm(*s.cond[i, targ]).pdf(feat[i])
         return max(posterior.iteritems(), key=lambda (x, y): y)[0]
             
-r = Reverand(train)
-r(test[0])
+def _fit_shard(task):
+    x, cache = task
+    model = Reverand()
+    for batch in stream(x, cache=cache):
+        model.partial_fit(batch)
+    return model
+
+def train_shards(paths, processes=None, cache=True):
+    """Trains one model on every file in paths, streaming each shard into its
+    own model in a pool of processes (default one per CPU) and merging them
+    in order. With cache, shards are read from their caches (see load)."""
+    tasks = [(x, cache) for x in paths]
+    if processes == 1:
+        models = itertools.imap(_fit_shard, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            models = pool.map(_fit_shard, tasks)
+        finally:
+            pool.terminate()
+    return reduce(Reverand.merge, models, Reverand())
+
+# Model used by _score, in pool worker processes as well as this one.
+_model = None
+
+def _score_init(model):
+    global _model
+    _model = model
+
+def _score(task):
+    rows, labelled = task
+    if labelled:
+        return rows[:, 0], _model.predict(rows[:, 1:])
+    return None, _model.predict(rows)
+
+def _scored(model, paths, opts):
+    """Yields (labels, predictions) for each chunk of the data files in turn,
+    scoring chunks in a pool of opts.jobs processes if that is more than one.
+    At most two chunks per process are held at a time."""
+    tasks = ((rows, not opts.unlabelled)
+             for x in paths for rows in blocks(x, opts.chunk, opts.cache))
+    if opts.jobs <= 1:
+        _score_init(model)
+        for result in itertools.imap(_score, tasks):
+            yield result
+        return
+    pool = multiprocessing.Pool(opts.jobs, _score_init, (model,))
+    try:
+        while True:
+            window = list(itertools.islice(tasks, 2 * opts.jobs))
+            if not window:
+                return
+            for result in pool.imap(_score, window):
+                yield result
+    finally:
+        pool.terminate()
+
+def _load_model(x):
+    with open(x, "rb") as f:
+        return cPickle.load(f)
+
+def train(args, opts):
+    """Train command: fits a model to the data files and saves it."""
+    model = train_shards(args[2:], opts.jobs, opts.cache)
+    with open(args[1], "wb") as f:
+        cPickle.dump(model, f, -1)
+
+def predict(args, opts):
+    """Predict command: writes the predicted class of each row of the input,
+    one per line, a chunk at a time."""
+    model = _load_model(args[1])
+    out = open(args[3], "w") if args[3] != "-" else sys.stdout
+    for labels, predictions in _scored(model, [args[2]], opts):
+        out.write("".join(repr(float(targ)) + "\n" for targ in predictions))
+    if out is not sys.stdout:
+        out.close()
+
+def evaluate(args, opts):
+    """Eval command: prints the fraction of rows of the data files whose
+    label the model predicts."""
+    if opts.unlabelled:
+        print >> sys.stderr, "eval needs labelled data."
+        return
+    model = _load_model(args[1])
+    correct = total = 0
+    for labels, predictions in _scored(model, args[2:], opts):
+        correct += (labels == predictions).sum()
+        total += len(labels)
+    print "%d/%d correct (%.2f%%)" % (correct, total,
+                                      100. * correct / total if total else 0)
+
+MODES = {"train":(train, 3),
+         "predict":(predict, 4),
+         "eval":(evaluate, 3)}
+
+def main():
+    parser = optparse.OptionParser(
+        usage="%prog [options] train model datafile [datafile ...]\n"
+              "       %prog [options] predict model infile outfile\n"
+              "       %prog [options] eval model datafile [datafile ...]")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="processes to train on shards or score chunks with")
+    parser.add_option("-c", "--chunk", type="int", default=CHUNK_ROWS,
+                      help="rows of input scored at a time [%default]")
+    parser.add_option("-n", "--no-cache", dest="cache", action="store_false",
+                      default=True,
+                      help="parse the input every time rather than keep a "
+                           ".npy cache of it beside each file")
+    parser.add_option("-u", "--unlabelled", action="store_true",
+                      default=False,
+                      help="input rows to predict are features only, with no "
+                           "label column")
+    opts, args = parser.parse_args()
+
+    if not args or args[0] not in MODES or len(args) < MODES[args[0]][1]:
+        parser.print_usage(sys.stderr)
+        return 2
+    MODES[args[0]][0](args, opts)
+    return 0
+
+if __name__ == "__main__":
+    # Run from the imported module, so saved models refer to bayes.Reverand
+    # rather than __main__.Reverand and load anywhere bayes can be imported.
+    import bayes
+    sys.exit(bayes.main())
 
-print map(r, val)
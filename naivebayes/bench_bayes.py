@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Timing harness for naivebayes. Writes synthetic shards in the train.data
+# format to a temporary directory, then times each benchmark on them.
+
+import optparse, os, shutil, sys, tempfile, timeit
+import numpy
+
+import bayes
+
+def make_shards(directory, shards, rows, seed):
+    R = numpy.random.RandomState(seed)
+    centres = R.uniform(0, 100, (2, 3))
+    paths = []
+    for k in range(shards):
+        labels = R.randint(0, 2, rows)
+        points = centres[labels] + R.normal(0, 5, (rows, 3))
+        path = os.path.join(directory, "train%02d.data" % k)
+        with open(path, "w") as f:
+            for label, point in zip(labels, points):
+                f.write("%d\t%s\n" % (label, "\t".join("%.4f" % x for x in point)))
+        paths.append(path)
+    return paths
+
+def same_model(a, b):
+    return (a.count == b.count and
+            all(numpy.allclose(a.cond[key], b.cond[key]) for key in a.cond))
+
+def _best_of(fxn, repeat):
+    return min(timeit.repeat(fxn, number=1, repeat=repeat))
+
+def bench_load(paths, opts):
+    """Compares parse with load, uncached and from its cache, on the first
+    shard."""
+    path = paths[0]
+    mb = os.path.getsize(path) / float(1 << 20)
+    # Writes the cache for the cached case.
+    labels, features = bayes.load(path)
+    assert len(labels) == opts.rows
+    print "%-10s %10s %10s" % ("loader", "seconds", "MB/s")
+    for name, fxn in (("parse", lambda: bayes.parse(path)),
+                      ("uncached", lambda: bayes.load(path, cache=False)),
+                      ("cached", lambda: bayes.load(path))):
+        elapsed = _best_of(fxn, opts.repeat)
+        print "%-10s %10.3f %10.1f" % (name, elapsed, mb / elapsed)
+
+def bench_shards(paths, opts):
+    """Times train_shards with each number of workers."""
+    workers = map(int, opts.workers.split(","))
+    reference = bayes.train_shards(paths, 1)
+    print "%-8s %10s %9s" % ("workers", "seconds", "speedup")
+    sequential = None
+    for processes in workers:
+        model = bayes.train_shards(paths, processes)
+        assert same_model(model, reference), processes
+        elapsed = _best_of(lambda: bayes.train_shards(paths, processes),
+                           opts.repeat)
+        sequential = sequential or elapsed
+        print "%-8d %10.3f %8.1fx" % (processes, elapsed, sequential / elapsed)
+
+BENCHMARKS = {"load":bench_load,
+              "shards":bench_shards}
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="timing runs per worker count; the best is kept")
+    parser.add_option("-s", "--seed", type="int", default=34,
+                      help="seed for the shards")
+    parser.add_option("-n", "--shards", type="int", default=16,
+                      help="number of shard files [%default]")
+    parser.add_option("-l", "--rows", type="int", default=50000,
+                      help="rows per shard [%default]")
+    parser.add_option("-w", "--workers", default="1,2,4,8,16",
+                      help="comma separated worker counts [%default]")
+    opts, args = parser.parse_args()
+
+    for name in args:
+        if name not in BENCHMARKS:
+            print >> sys.stderr, "Unknown benchmark %s; choose from %s" % (
+                name, ", ".join(sorted(BENCHMARKS)))
+            return 2
+    directory = tempfile.mkdtemp()
+    try:
+        paths = make_shards(directory, opts.shards, opts.rows, opts.seed)
+        for name in args or sorted(BENCHMARKS):
+            print "== %s" % name
+            BENCHMARKS[name](paths, opts)
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
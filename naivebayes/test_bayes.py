@@ -0,0 +1,353 @@
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import mock
+import numpy
+
+import bayes
+
+TRAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train.data")
+
+class test_predict(unittest.TestCase):
+    def setUp(self):
+        self.model = bayes.Reverand(bayes.parse(TRAIN))
+
+    def test_train_data(self):
+        labels, features = bayes.load(TRAIN, cache=False)
+        self.assertEquals(list(self.model.predict(features)),
+                          map(self.model, features))
+        self.assertEquals(list(self.model.predict(features)), list(labels))
+
+    def test_random_data(self):
+        R = numpy.random.RandomState(34)
+        X = numpy.column_stack([R.uniform(4.5, 6.5, 500),
+                                R.uniform(90, 200, 500),
+                                R.uniform(5, 13, 500)])
+        self.assertEquals(list(self.model.predict(X)), map(self.model, X))
+
+    def test_log_likelihood(self):
+        X = [[5.5, 150, 9], [6, 180, 12]]
+        scores = self.model.log_likelihood(X)
+        self.assertEquals(scores.shape, (2, 2))
+        for row, feat in zip(scores, X):
+            for score, targ in zip(row, self.model.classes):
+                density = numpy.prod([
+                    numpy.exp(-0.5 * ((x - mu) / sigma) ** 2) /
+                    (sigma * numpy.sqrt(2 * numpy.pi))
+                    for x, (mu, sigma) in
+                    ((feat[i], self.model.cond[i, targ])
+                     for i in range(self.model.nfeat))])
+                self.assertAlmostEqual(
+                    score, numpy.log(self.model.prior[targ] * density))
+
+    def test_no_underflow(self):
+        # Hundreds of features multiply out to 0 as probabilities, but not as
+        # log probabilities.
+        R = numpy.random.RandomState(34)
+        data = dict((targ, R.normal(targ, 1, (50, 400))) for targ in (0., 1.))
+        model = bayes.Reverand(data)
+        X = R.normal(1, 1, (20, 400))
+        self.assertTrue((model.predict(X) == 1).all())
+
+def assert_same_model(test, a, b):
+    test.assertEquals(a.count, b.count)
+    test.assertEquals(sorted(a.cond), sorted(b.cond))
+    for targ in a.count:
+        test.assertTrue(numpy.allclose(a.mean[targ], b.mean[targ]))
+        test.assertTrue(numpy.allclose(a.m2[targ], b.m2[targ]))
+        test.assertAlmostEqual(a.prior[targ], b.prior[targ])
+    for key in a.cond:
+        test.assertTrue(numpy.allclose(a.cond[key], b.cond[key]))
+
+class test_incremental(unittest.TestCase):
+    def setUp(self):
+        R = numpy.random.RandomState(34)
+        self.data = {0.: R.normal(1, 2, (300, 3)), 1.: R.normal(3, 1, (150, 3)),
+                     2.: R.normal(-4, 3, (40, 3))}
+        self.model = bayes.Reverand(self.data)
+
+    def batches(self, size):
+        for i in range(0, 300, size):
+            yield dict((targ, points[i:i + size])
+                       for targ, points in self.data.iteritems())
+
+    def test_single_fit(self):
+        # The statistics are those of the points themselves.
+        for targ, points in self.data.iteritems():
+            self.assertEquals(self.model.count[targ], len(points))
+            for i, feat in enumerate(points.T):
+                self.assertTrue(numpy.allclose(self.model.cond[i, targ],
+                                               (feat.mean(), feat.std())))
+        self.assertAlmostEqual(sum(self.model.prior.values()), 1)
+
+    def test_partial_fit(self):
+        for size in (1, 7, 64, 300):
+            model = bayes.Reverand()
+            for batch in self.batches(size):
+                model.partial_fit(batch)
+            assert_same_model(self, model, self.model)
+
+    def test_merge(self):
+        even, odd = bayes.Reverand(), bayes.Reverand()
+        for k, batch in enumerate(self.batches(23)):
+            (odd if k % 2 else even).partial_fit(batch)
+        assert_same_model(self, even.merge(odd), self.model)
+
+    def test_merge_into_empty(self):
+        assert_same_model(self, bayes.Reverand().merge(self.model), self.model)
+        assert_same_model(self, bayes.Reverand(self.data).merge(bayes.Reverand()),
+                          self.model)
+
+    def test_merge_disjoint_classes(self):
+        # Classes present on only one side carry over unchanged.
+        left = bayes.Reverand({0.: self.data[0.], 2.: self.data[2.][:10]})
+        right = bayes.Reverand({1.: self.data[1.], 2.: self.data[2.][10:]})
+        assert_same_model(self, left.merge(right), self.model)
+        only = bayes.Reverand({1.: self.data[1.]})
+        merged = bayes.Reverand({0.: self.data[0.]}).merge(only)
+        self.assertEquals(merged.count, {0.: 300, 1.: 150})
+        assert_same_model(self, merged,
+                          bayes.Reverand({0.: self.data[0.],
+                                          1.: self.data[1.]}))
+
+    def test_single_point_class(self):
+        # A class seen once has no spread of its own; it still scores as a
+        # narrow Gaussian instead of NaN.
+        model = bayes.Reverand({0.: [[1., 2.]], 1.: [[5., 6.], [7., 9.]]})
+        self.assertTrue(numpy.isfinite(model.log_likelihood([[1., 2.]])).all())
+        self.assertEquals(list(model.predict([[1., 2.], [5., 6.], [7., 9.]])),
+                          [0., 1., 1.])
+        self.assertEquals(map(model, [[1., 2.], [6., 7.]]), [0., 1.])
+        model = bayes.Reverand()
+        for point in ([1., 2.], [1.5, 2.5]):
+            model.partial_fit({0.: [point]})
+        model.partial_fit({1.: [[5., 6.]]})
+        self.assertEquals(list(model.predict([[1.2, 2.2], [5., 6.]])), [0., 1.])
+
+    def test_constant_feature(self):
+        data = {0.: [[1., 3.], [2., 3.], [1.5, 3.]],
+                1.: [[1., 8.], [2., 7.], [1.5, 9.]]}
+        model = bayes.Reverand(data)
+        self.assertTrue(numpy.isfinite(model.log_likelihood([[1., 3.]])).all())
+        self.assertEquals(list(model.predict([[1.5, 3.], [1.5, 8.]])), [0., 1.])
+        # Even when every point is the same.
+        model = bayes.Reverand({0.: [[4., 4.]] * 3})
+        self.assertEquals(list(model.predict([[4., 4.], [0., 9.]])), [0., 0.])
+
+def write_data(path, data):
+    with open(path, "w") as f:
+        for targ, points in sorted(data.iteritems()):
+            for point in points:
+                f.write("%r\t%s\n" % (targ, "\t".join(map(repr, point))))
+
+class test_train_shards(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        R = numpy.random.RandomState(34)
+        self.shards = [dict((targ, R.normal(targ, 2, (R.randint(1, 50), 3)))
+                            for targ in (0., 1.)) for _ in range(3)]
+        # The last shard has a class the others lack.
+        self.shards[-1][5.] = R.normal(5, 1, (7, 3))
+        self.paths = []
+        for k, shard in enumerate(self.shards):
+            self.paths.append(os.path.join(self.tempdir, "train%d.data" % k))
+            write_data(self.paths[-1], shard)
+        self.expected = bayes.Reverand()
+        for shard in self.shards:
+            self.expected.partial_fit(shard)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_one_process(self):
+        assert_same_model(self, bayes.train_shards(self.paths, 1),
+                          self.expected)
+
+    def test_pool(self):
+        assert_same_model(self, bayes.train_shards(self.paths, 2),
+                          self.expected)
+        assert_same_model(self, bayes.train_shards(self.paths[:2], 2),
+                          bayes.Reverand().partial_fit(self.shards[0])
+                                          .partial_fit(self.shards[1]))
+
+class test_load(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "rows.data")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, text):
+        with open(self.path, "w") as f:
+            f.write(text)
+
+    def test_chunks(self):
+        self.write("0\t1 2\n\n1 3\t4 \n  \n0 5 6")
+        for size in (1, 3, 7, 100):
+            rows = numpy.concatenate(list(bayes.chunks(self.path, size)))
+            self.assertEquals(rows.tolist(), [[0, 1, 2], [1, 3, 4], [0, 5, 6]])
+
+    def test_bad_rows(self):
+        rows = ["0 1 2", "1 3 4", "NA 1 2", "0 5 6", "1 7 8", "0 9 10"]
+        for size in (1, 6, 12, 100):
+            self.write("\n".join(rows) + "\n")
+            with self.assertRaisesRegexp(ValueError, "bad number in row 'NA"):
+                list(bayes.chunks(self.path, size))
+        for bad in ("1 2", "1 2 3 4", "1 2 3x"):
+            self.write("\n".join(rows[:2] + [bad] + rows[3:]) + "\n")
+            with self.assertRaisesRegexp(ValueError, repr(bad)):
+                bayes.load(self.path, cache=False)
+        # A short row and a long one hold the right number of values between
+        # them, but not in the right rows.
+        self.write("\n".join(rows[:2] + ["0 1", "1 2 3 4"] + rows[3:]) + "\n")
+        for size in (12, 100):
+            with self.assertRaisesRegexp(ValueError,
+                                         "expected 3 columns in row '0 1'"):
+                list(bayes.chunks(self.path, size))
+        with self.assertRaisesRegexp(ValueError, "expected 3 columns"):
+            bayes.load(self.path)
+
+    def test_cache(self):
+        self.write("0 1 2\n1 3 4\n0 5 6\n")
+        labels, features = bayes.load(self.path)
+        self.assertTrue(os.path.exists(self.path + ".npy"))
+        self.assertTrue(os.path.exists(self.path + ".npz"))
+        self.assertEquals(sorted(os.listdir(self.tempdir)),
+                          ["rows.data", "rows.data.npy", "rows.data.npz"])
+        # Later loads, blocks and streams come from the cache unparsed.
+        real_chunks = bayes.chunks
+        bayes.chunks = None
+        try:
+            labels, features = bayes.load(self.path)
+            self.assertTrue(isinstance(features, numpy.memmap))
+            self.assertEquals(labels.tolist(), [0, 1, 0])
+            self.assertEquals(features.tolist(), [[1, 2], [3, 4], [5, 6]])
+            self.assertEquals([b.tolist() for b in bayes.blocks(self.path, 2)],
+                              [[[0, 1, 2], [1, 3, 4]], [[0, 5, 6]]])
+            batches = list(bayes.stream(self.path, 2))
+            self.assertEquals(batches[1][0.].tolist(), [[5, 6]])
+        finally:
+            bayes.chunks = real_chunks
+
+        # A change in size invalidates the cache.
+        self.write("0 1 2\n1 3 4\n")
+        self.assertEquals(bayes.load(self.path)[0].tolist(), [0, 1])
+        # So does a change in mtime alone.
+        self.write("1 1 2\n1 3 4\n")
+        os.utime(self.path, (0, 12345))
+        self.assertEquals(bayes.load(self.path)[0].tolist(), [1, 1])
+
+    def test_empty(self):
+        self.write("\n \n")
+        labels, features = bayes.load(self.path)
+        self.assertEquals(len(labels), 0)
+        self.assertEquals(list(bayes.blocks(self.path)), [])
+
+    def test_unwritable_cache(self):
+        self.write("0 1 2\n1 3 4\n0 5 6\n")
+        real_rename = os.rename
+        def rename(src, dst):
+            raise OSError("read-only")
+        os.rename = rename
+        try:
+            self.assertEquals(bayes.load(self.path)[0].tolist(), [0, 1, 0])
+            self.assertEquals([b.tolist() for b in bayes.blocks(self.path, 2)],
+                              [[[0, 1, 2], [1, 3, 4]], [[0, 5, 6]]])
+        finally:
+            os.rename = real_rename
+        self.assertEquals(os.listdir(self.tempdir), ["rows.data"])
+
+    def test_no_cache(self):
+        self.write("0 1 2\n")
+        self.assertEquals(bayes.load(self.path, cache=False)[0].tolist(), [0])
+        self.assertEquals(len(list(bayes.stream(self.path, cache=False))), 1)
+        self.assertEquals(os.listdir(self.tempdir), ["rows.data"])
+
+class test_command_line(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        R = numpy.random.RandomState(34)
+        # Labels that "%g" would not write back exactly.
+        self.data = dict((targ, R.normal(k * 4, 1, (40, 3)))
+                         for k, targ in enumerate((0.1, 1234567., 2.)))
+        self.shards = [self.path("train0.data"), self.path("train1.data")]
+        for k, shard in enumerate(self.shards):
+            write_data(shard, dict((targ, points[k::2])
+                                   for targ, points in self.data.iteritems()))
+        self.model = self.path("model")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def path(self, name):
+        return os.path.join(self.tempdir, name)
+
+    def run_bayes(self, *args):
+        stdout = StringIO.StringIO()
+        with mock.patch("sys.argv", ["bayes.py"] + list(args)):
+            with mock.patch("sys.stdout", stdout):
+                with mock.patch("sys.stderr", stdout):
+                    code = bayes.main()
+        return code, stdout.getvalue()
+
+    def test_train(self):
+        for jobs in ("1", "2"):
+            self.assertEquals(self.run_bayes("-j", jobs, "train", self.model,
+                                             *self.shards)[0], 0)
+            with open(self.model, "rb") as f:
+                assert_same_model(self, bayes.cPickle.load(f),
+                                  bayes.Reverand(self.data))
+
+    def test_predict(self):
+        self.run_bayes("train", self.model, *self.shards)
+        expected = bayes.Reverand(self.data).predict(
+            bayes.load(self.shards[0])[1])
+        out = self.path("out")
+        for options in ([], ["-c", "7"], ["-j", "2", "-c", "7"], ["-n"]):
+            self.run_bayes(*(options + ["predict", self.model, self.shards[0],
+                                        out]))
+            with open(out) as f:
+                predictions = map(float, f.read().split())
+            self.assertEquals(predictions, list(expected))
+        self.assertTrue(1234567. in predictions and 0.1 in predictions)
+        self.assertEquals(self.run_bayes("predict", self.model,
+                                         self.shards[0], "-")[1],
+                          "".join(repr(targ) + "\n" for targ in expected))
+
+    def test_unlabelled(self):
+        self.run_bayes("train", self.model, *self.shards)
+        labels, features = bayes.load(self.shards[1])
+        unlabelled = self.path("unlabelled.data")
+        with open(unlabelled, "w") as f:
+            for row in features:
+                f.write(" ".join(map(repr, row)) + "\n")
+        code, out = self.run_bayes("-u", "-j", "2", "-c", "5", "predict",
+                                   self.model, unlabelled, "-")
+        self.assertEquals(map(float, out.split()),
+                          list(bayes.Reverand(self.data).predict(features)))
+        self.assertRegexpMatches(self.run_bayes("-u", "eval", self.model,
+                                                unlabelled)[1],
+                                 "needs labelled data")
+
+    def test_eval(self):
+        self.run_bayes("train", self.model, *self.shards)
+        for options in ([], ["-j", "2", "-c", "3"]):
+            code, out = self.run_bayes(*(options + ["eval", self.model] +
+                                         self.shards))
+            self.assertEquals(out, "120/120 correct (100.00%)\n")
+        mislabelled = self.path("mislabelled.data")
+        write_data(mislabelled, {2.: self.data[0.1][:3]})
+        self.assertEquals(self.run_bayes("eval", self.model, mislabelled)[1],
+                          "0/3 correct (0.00%)\n")
+
+    def test_usage(self):
+        for args in ([], ["nosuch"], ["train", self.model],
+                     ["predict", self.model, self.shards[0]]):
+            code, out = self.run_bayes(*args)
+            self.assertEquals(code, 2)
+            self.assertRegexpMatches(out, "^Usage:")
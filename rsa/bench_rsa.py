@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+
+# Timing harness for the toy RSA implementation. Each benchmark prints one line
+# per configuration so runs are easy to compare by eye or with diff.
+#
+# The "suite" benchmark instead times a fixed set of cases, optionally writes
+# them as JSON, and exits non-zero if any is slower than a stored baseline by
+# more than a given ratio.
+
+import collections
+import cPickle
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import timeit
+
+import rsa
+
+MODULUS_BITS = (512, 1024, 2048, 4096)
+
+def _odd_modulus(R, nbits):
+  """Returns a random odd number of exactly nbits bits."""
+  return R.getrandbits(nbits) | (1 << (nbits - 1)) | 1
+
+def _probable_prime(R, nbits):
+  """Fermat-tests random odd candidates with the builtin pow, so benchmarks of
+     other routines do not have to wait for rsa.get_prime."""
+  while True:
+    n = _odd_modulus(R, nbits)
+    if all(pow(a, n - 1, n) == 1 for a in (2, 3, 5, 7, 11, 13)):
+      return n
+
+def _make_key(R, nbits):
+  """Builds an RSAPrivateKey with an nbits-bit modulus from fast primes."""
+  p = _probable_prime(R, nbits / 2)
+  q = _probable_prime(R, nbits - nbits / 2)
+  phi = (p - 1) * (q - 1)
+  e = 3
+  while rsa.gcd(e, phi) != 1:
+    e += 2
+  key = rsa.RSAPrivateKey.__new__(rsa.RSAPrivateKey)
+  key.__setstate__({"p":p, "q":q, "phi":phi, "N":p * q, "e":e,
+                    "d":rsa.modinv(e, phi),
+                    "public":rsa.RSAPublicKey(p * q, e)})
+  return key
+
+def _best_of(fxn, repeat):
+  return min(timeit.repeat(fxn, number=1, repeat=repeat))
+
+def _worker_counts():
+  """1, 2, 4, ... up to the number of CPUs."""
+  counts = [1]
+  while counts[-1] * 2 <= multiprocessing.cpu_count():
+    counts.append(counts[-1] * 2)
+  return counts
+
+def bench_montgomery(repeat, seed):
+  """Compares full-size modular exponentiation through the Karatsuba modmul
+     path against the Montgomery path."""
+  R = random.Random(seed)
+  print "%-8s %14s %14s %9s" % ("bits", "karatsuba (s)", "montgomery (s)",
+                                "speedup")
+  for nbits in MODULUS_BITS:
+    n = _odd_modulus(R, nbits)
+    x = R.randint(2, n - 1)
+    y = R.getrandbits(nbits)
+    ctx = rsa.MontgomeryContext(n)
+    assert rsa.modexp(x, y, n) == rsa.modexp(x, y, n, ctx) == pow(x, y, n)
+
+    plain = _best_of(lambda: rsa.modexp(x, y, n), repeat)
+    mont = _best_of(lambda: rsa.modexp(x, y, n, ctx), repeat)
+    print "%-8d %14.4f %14.4f %8.1fx" % (nbits, plain, mont, plain / mont)
+
+def bench_window(repeat, seed):
+  """Compares square-and-multiply against fixed and sliding window
+     exponentiation, all in Montgomery form, with full-length exponents."""
+  R = random.Random(seed)
+  print "%-8s %7s %12s %12s %12s" % ("bits", "window", "binary (s)",
+                                     "fixed (s)", "sliding (s)")
+  for nbits in MODULUS_BITS:
+    n = _odd_modulus(R, nbits)
+    x = R.randint(2, n - 1)
+    y = R.getrandbits(nbits)
+    ctx = rsa.MontgomeryContext(n)
+    k = rsa._window_size(y.bit_length())
+
+    binary = _best_of(lambda: rsa.modexp(x, y, n, ctx), repeat)
+    fixed = _best_of(lambda: rsa.modexp(x, y, n, ctx, k, False), repeat)
+    sliding = _best_of(lambda: rsa.modexp(x, y, n, ctx, k), repeat)
+    print "%-8d %7d %12.4f %12.4f %12.4f" % (nbits, k, binary, fixed, sliding)
+
+def bench_multiply(repeat, seed):
+  """Times native multiplication against one level of Karatsuba and of Toom-3
+     over native sub-products, as calibrate compares them."""
+  R = random.Random(seed)
+  print "%-8s %12s %14s %12s" % ("bits", "native (ms)", "karatsuba (ms)",
+                                 "toom3 (ms)")
+  thresholds = rsa.NATIVE_MATH_MAX, rsa.TOOM3_MATH_MIN
+  rsa.NATIVE_MATH_MAX = rsa.TOOM3_MATH_MIN = None
+  try:
+    for nbits in (1024, 4096, 16384, 65536, 262144):
+      x = _odd_modulus(R, nbits)
+      y = _odd_modulus(R, nbits)
+      times = [_best_of(lambda: fxn(x, y), repeat) * 1000
+               for fxn in (rsa.multiply, rsa._multiply_karatsuba,
+                           rsa._multiply_toom3)]
+      print "%-8d %12.3f %14.3f %12.3f" % tuple([nbits] + times)
+  finally:
+    rsa.NATIVE_MATH_MAX, rsa.TOOM3_MATH_MIN = thresholds
+
+def bench_crt(repeat, seed):
+  """Compares CRT decryption against exponentiation mod the full modulus."""
+  R = random.Random(seed)
+  print "%-8s %12s %12s %9s" % ("bits", "full (s)", "crt (s)", "speedup")
+  for nbits in MODULUS_BITS:
+    key = _make_key(R, nbits)
+    c = R.randint(0, key.N - 1)
+    full = _best_of(lambda: key.DecryptIntegerFull(c), repeat)
+    crt = _best_of(lambda: key.DecryptInteger(c), repeat)
+    print "%-8d %12.4f %12.4f %8.1fx" % (key.N.bit_length(), full, crt,
+                                         full / crt)
+
+def bench_context(repeat, seed):
+  """Compares per-block encryption and decryption with the key's exponent
+     contexts rebuilt for every block against reusing them."""
+  R = random.Random(seed)
+  blocks = 32
+  print "%-8s %-8s %12s %12s %9s" % ("bits", "op", "cold (s)", "cached (s)",
+                                     "speedup")
+  for nbits in MODULUS_BITS:
+    key = _make_key(R, nbits)
+    public = key.GetPublicKey()
+    data = [R.randint(0, key.N - 1) for _ in xrange(blocks)]
+
+    for op, fxn, owner in (("encrypt", public.EncryptInteger, public),
+                           ("decrypt", key.DecryptInteger, key)):
+      def cold():
+        for number in data:
+          owner.__dict__.pop("_contexts", None)
+          rsa.clear_context_cache()
+          fxn(number)
+      cold_time = _best_of(cold, repeat)
+      cached = _best_of(lambda: map(fxn, data), repeat)
+      print "%-8d %-8s %12.4f %12.4f %8.1fx" % (nbits, op, cold_time, cached,
+                                                cold_time / cached)
+
+def bench_get_prime(repeat, seed):
+  """Compares the sieved prime search against testing uniformly random
+     numbers, reporting work counters alongside time."""
+  print "%-8s %-8s %10s %11s %10s %9s" % ("bits", "mode", "time (s)",
+                                          "candidates", "sieved", "MR rounds")
+  for nbits in (128, 256, 512):
+    for sieve in (False, True):
+      random.seed(seed)
+      stats = collections.Counter()
+      elapsed = _best_of(lambda: rsa.get_prime(nbits, sieve, stats), repeat)
+      print "%-8d %-8s %10.4f %11d %10d %9d" % (
+          nbits, "sieve" if sieve else "random", elapsed,
+          stats["candidates"] / repeat, stats["sieved"] / repeat,
+          stats["mr_rounds"] / repeat)
+
+def bench_keygen(repeat, seed):
+  """Times key generation with the prime search spread over 1, 2, 4, ... up to
+     the number of CPUs worker processes."""
+  workers = _worker_counts()
+  print "%-8s %8s %10s %9s" % ("bits", "workers", "time (s)", "speedup")
+  for nbits in (1024, 2048, 4096):
+    sequential = None
+    for count in workers:
+      random.seed(seed)
+      elapsed = _best_of(lambda: rsa.RSAPrivateKey(nbits / 2, count), repeat)
+      sequential = sequential or elapsed
+      print "%-8d %8d %10.4f %8.1fx" % (nbits, count, elapsed,
+                                        sequential / elapsed)
+
+def _legacy_encode(data, modulo):
+  """Message.Encode as it was before the bulk codec, for comparison."""
+  bytes_per_item = rsa.Message._bytes_per_item(modulo)
+  items = []
+  for i in range(0, len(data), bytes_per_item):
+    num = 0
+    for byte in data[i:i + bytes_per_item]:
+      num = ((num << 8) + ord(byte))
+    num <<= 8 * (bytes_per_item - len(data[i:i + bytes_per_item]))
+    items.append(num)
+  return items
+
+def _legacy_decode(numbers, modulo):
+  """Message.Decode as it was before the bulk codec, for comparison."""
+  bytes_per_item = rsa.Message._bytes_per_item(modulo)
+  my_data = []
+  for item in numbers:
+    for i in reversed(xrange(bytes_per_item)):
+      my_data.append(chr((((0xFF << (i * 8)) & item) >> (i * 8))))
+  return "".join(my_data)
+
+def bench_backends(repeat, seed):
+  """Times the key and primality arithmetic under each available backend."""
+  R = random.Random(seed)
+  backends = rsa.available_backends()
+  print "%-8s %-10s" % ("bits", "op") + "".join(
+      "%14s" % ("%s (ms)" % name) for name in backends)
+  previous = rsa.get_backend().name
+  try:
+    for nbits in MODULUS_BITS:
+      key = _make_key(R, nbits)
+      public = key.GetPublicKey()
+      c = R.randint(0, key.N - 1)
+      ops = (("encrypt", lambda: public.EncryptInteger(c)),
+             ("decrypt", lambda: key.DecryptInteger(c)),
+             ("isprime", lambda: rsa.isprime(key.p)),
+             ("invert", lambda: rsa.get_backend().invert(key.e, key.phi)))
+      for op, fxn in ops:
+        times = []
+        for name in backends:
+          rsa.set_backend(name)
+          fxn()  # Warm the key's contexts.
+          times.append(_best_of(fxn, repeat) * 1000)
+        print "%-8d %-10s" % (nbits, op) + "".join("%14.3f" % t for t in times)
+  finally:
+    rsa.set_backend(previous)
+
+def bench_codec(repeat, seed):
+  """Measures Message.Encode and Decode throughput against the original
+     per-byte loops."""
+  R = random.Random(seed)
+  size = 1 << 20
+  data = "".join(chr(R.randint(0, 255)) for _ in xrange(size))
+  print "%-8s %-8s %14s %14s" % ("bits", "op", "per-byte MB/s", "bulk MB/s")
+  for nbits in MODULUS_BITS:
+    modulo = _odd_modulus(R, nbits)
+    msg = rsa.Message.Encode(data, modulo)
+    assert _legacy_encode(data, modulo) == msg.numbers
+    assert _legacy_decode(msg.numbers, modulo)[:size] == msg.Decode() == data
+
+    for op, legacy, bulk in (
+        ("encode", lambda: _legacy_encode(data, modulo),
+         lambda: rsa.Message.Encode(data, modulo)),
+        ("decode", lambda: _legacy_decode(msg.numbers, modulo),
+         lambda: msg.Decode())):
+      mb = size / float(1 << 20)
+      print "%-8d %-8s %14.2f %14.2f" % (nbits, op, mb / _best_of(legacy, repeat),
+                                         mb / _best_of(bulk, repeat))
+
+def bench_packing(repeat, seed):
+  """Compares byte and bit packing of 256 KB of plaintext: blocks (and so
+     exponentiations), ciphertext size and encryption time. Bit packing gains
+     most (7 bits a block) when the modulus size is a multiple of 8 bits and
+     nothing when it is one more."""
+  R = random.Random(seed)
+  data = "".join(chr(R.randint(0, 255)) for _ in xrange(256 << 10))
+  print "%-8s %-8s %10s %14s %12s %12s" % ("bits", "packing", "blocks",
+                                           "ciphertext KB", "encode (s)",
+                                           "encrypt (s)")
+  for nbits in (24, 64, 512, 521, 2048):
+    key = _make_key(R, nbits).GetPublicKey()
+    for name, packing in (("bytes", rsa.PACKING_BYTES),
+                          ("bits", rsa.PACKING_BITS)):
+      msg = rsa.Message.Encode(data, key.N, packing)
+      encode = _best_of(lambda: rsa.Message.Encode(data, key.N, packing),
+                        repeat)
+      encrypt = _best_of(lambda: key.Encrypt(msg), repeat)
+      print "%-8d %-8s %10d %14.1f %12.4f %12.4f" % (
+          key.N.bit_length(), name, len(msg.BlockBytes()) / msg._width,
+          len(msg.BlockBytes()) / 1024., encode, encrypt)
+
+def bench_jobs(repeat, seed):
+  """Measures decryption throughput of a 2048-bit key over 256 KB of data with
+     the blocks spread over 1, 2, 4, ... worker processes."""
+  R = random.Random(seed)
+  key = _make_key(R, 2048)
+  data = "".join(chr(R.randint(0, 255)) for _ in xrange(256 << 10))
+  enc = key.GetPublicKey().Encrypt(rsa.Message.Encode(data, key.N))
+  print "%-8s %10s %9s" % ("jobs", "KB/s", "speedup")
+  sequential = None
+  for jobs in _worker_counts():
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+      elapsed = _best_of(lambda: key.Decrypt(enc, pool), repeat)
+    finally:
+      if pool is not None:
+        pool.terminate()
+    sequential = sequential or elapsed
+    print "%-8d %10.1f %8.1fx" % (jobs, len(data) / 1024. / elapsed,
+                                  sequential / elapsed)
+
+def bench_hybrid(repeat, seed):
+  """Compares encryption and decryption throughput of block and hybrid mode
+     for 2048-bit keys: block mode over 256 KB, hybrid over 16 MB streamed in
+     HYBRID_CHUNK_BYTES chunks."""
+  R = random.Random(seed)
+  key = _make_key(R, 2048)
+  public = key.GetPublicKey()
+  block = "".join(chr(R.randint(0, 255)) for _ in xrange(256 << 10))
+  bulk = block * 64
+
+  def blocks_encrypt():
+    return public.Encrypt(rsa.Message.Encode(block, key.N))
+  def blocks_decrypt(enc=blocks_encrypt()):
+    return key.Decrypt(enc).Decode()
+  def chunks(data):
+    return rsa._read_chunks(StringIO.StringIO(data), rsa.HYBRID_CHUNK_BYTES)
+  def hybrid_encrypt():
+    out = StringIO.StringIO()
+    rsa._encrypt_hybrid(public, chunks(bulk), out)
+    return out.getvalue()
+  def hybrid_decrypt(ciphertext=hybrid_encrypt()):
+    session, payload = rsa._load_ciphertext(StringIO.StringIO(ciphertext), key)
+    return "".join(rsa._decrypt_chunks(key, session, payload))
+  assert blocks_decrypt() == block and hybrid_decrypt() == bulk
+
+  print "%-8s %-8s %10s" % ("mode", "op", "MB/s")
+  for mode, size, ops in (
+      ("blocks", len(block), (("encrypt", blocks_encrypt),
+                              ("decrypt", blocks_decrypt))),
+      ("hybrid", len(bulk), (("encrypt", hybrid_encrypt),
+                             ("decrypt", hybrid_decrypt)))):
+    for op, fxn in ops:
+      print "%-8s %-8s %10.2f" % (mode, op,
+                                  size / float(1 << 20) / _best_of(fxn, repeat))
+
+def bench_memory(repeat, seed):
+  """Compares the memory held by 1 MB of encrypted blocks as a list of Python
+     integers against the packed Message buffer."""
+  R = random.Random(seed)
+  size = 1 << 20
+  print "%-8s %10s %14s %14s %9s" % ("bits", "blocks", "list (KB)",
+                                     "buffer (KB)", "ratio")
+  for nbits in MODULUS_BITS:
+    modulo = _odd_modulus(R, nbits)
+    width = rsa.Message._base_from_modulo(modulo) / 8
+    numbers = [R.randint(0, modulo - 1) for _ in xrange(size / (width - 1))]
+    msg = rsa.Message(numbers, modulo, 1)
+    listed = sys.getsizeof(numbers) + sum(sys.getsizeof(n) for n in numbers)
+    packed = sys.getsizeof(msg._buffer)
+    print "%-8d %10d %14.1f %14.1f %8.1fx" % (nbits, len(numbers),
+                                              listed / 1024., packed / 1024.,
+                                              float(listed) / packed)
+
+SIZE_SUFFIXES = {"": 1, "K": 1 << 10, "M": 1 << 20}
+
+def _parse_size(text):
+  """Parses a byte count such as 512, 64K or 100M."""
+  text = text.strip().upper()
+  if text[-1:] in SIZE_SUFFIXES:
+    return int(text[:-1]) * SIZE_SUFFIXES[text[-1]]
+  return int(text)
+
+def _format_size(size):
+  for suffix in ("M", "K"):
+    if size % SIZE_SUFFIXES[suffix] == 0:
+      return "%d%s" % (size / SIZE_SUFFIXES[suffix], suffix)
+  return str(size)
+
+def _suite_cases(key_bits, payloads, seed):
+  """Yields (name, setup) for every suite case. setup prepares the inputs
+     from a seed of its own and returns the function to time, so that every
+     case sees the same inputs however the suite is filtered."""
+  def seeded(name):
+    return random.Random("%d:%s" % (seed, name))
+
+  for nbits in key_bits:
+    def modmul_case(nbits=nbits, name="modmul/%d" % nbits):
+      R = seeded(name)
+      n = _odd_modulus(R, nbits)
+      pairs = [(R.randint(0, n - 1), R.randint(0, n - 1)) for _ in xrange(100)]
+      return lambda: [rsa.modmul(x, y, n) for x, y in pairs]
+    yield "modmul/%d" % nbits, modmul_case
+
+    def modexp_case(nbits=nbits, name="modexp/%d" % nbits):
+      R = seeded(name)
+      n = _odd_modulus(R, nbits)
+      x, y = R.randint(2, n - 1), R.getrandbits(nbits)
+      return lambda: rsa.modexp(x, y, n, rsa.MontgomeryContext(n),
+                                rsa.WINDOW_AUTO)
+    yield "modexp/%d" % nbits, modexp_case
+
+    def isprime_case(nbits=nbits, name="isprime/%d" % nbits):
+      prime = _probable_prime(seeded(name), nbits)
+      def run():
+        random.seed(seed)
+        rsa.isprime(prime)
+      return run
+    yield "isprime/%d" % nbits, isprime_case
+
+    # Keys are made of primes half the modulus size.
+    def get_prime_case(nbits=nbits):
+      def run():
+        random.seed(seed)
+        rsa.get_prime(nbits / 2)
+      return run
+    yield "get_prime/%d" % (nbits / 2), get_prime_case
+
+  for size in payloads:
+    def codec_case(size=size, name="codec/%s" % _format_size(size)):
+      R = seeded(name)
+      data = "".join(
+          chr(R.getrandbits(8)) for _ in xrange(min(size, 1 << 16)))
+      data = (data * (size / len(data) + 1))[:size]
+      modulo = _odd_modulus(R, 1024)
+      return data, modulo
+    def encode_case(codec_case=codec_case):
+      data, modulo = codec_case()
+      return lambda: rsa.Message.Encode(data, modulo)
+    def decode_case(codec_case=codec_case):
+      data, modulo = codec_case()
+      message = rsa.Message.Encode(data, modulo)
+      return message.Decode
+    yield "encode/%s" % _format_size(size), encode_case
+    yield "decode/%s" % _format_size(size), decode_case
+
+    def keystream_case(size=size, name="keystream/%s" % _format_size(size)):
+      R = seeded(name)
+      data = "".join(
+          chr(R.getrandbits(8)) for _ in xrange(min(size, 1 << 16)))
+      data = (data * (size / len(data) + 1))[:size]
+      session_key = "".join(chr(R.getrandbits(8))
+                            for _ in xrange(rsa.SESSION_KEY_BYTES))
+      chunks = [data[i:i + rsa.HYBRID_CHUNK_BYTES]
+                for i in xrange(0, size, rsa.HYBRID_CHUNK_BYTES)]
+      return lambda: list(rsa._keystream_xor(session_key, chunks))
+    yield "keystream/%s" % _format_size(size), keystream_case
+
+  for nbits in key_bits:
+    for size in payloads:
+      label = "%d/%s" % (nbits, _format_size(size))
+      for mode in ("encrypt", "decrypt"):
+        def cli_case(nbits=nbits, size=size, mode=mode, label=label):
+          return _cli_case(seeded("cli/" + label), nbits, size, mode)
+        yield "cli_%s/%s" % (mode, label), cli_case
+
+def _cli_case(R, nbits, size, mode):
+  """Prepares key and data files in a temporary directory for timing the
+     encrypt or decrypt command."""
+  tempdir = tempfile.mkdtemp()
+  def path(name):
+    return os.path.join(tempdir, name)
+
+  key = _make_key(R, nbits)
+  with open(path("key"), "wb") as fileio:
+    cPickle.dump(key, fileio, -1)
+  with open(path("key.pub"), "wb") as fileio:
+    cPickle.dump(key.GetPublicKey(), fileio, -1)
+  block = "".join(chr(R.getrandbits(8)) for _ in xrange(min(size, 1 << 16)))
+  with open(path("plain"), "wb") as fileio:
+    for i in xrange(0, size, len(block)):
+      fileio.write(block[:size - i])
+  rsa.encrypt(["encrypt", path("key.pub"), path("plain"), path("cipher")])
+
+  if mode == "encrypt":
+    args = ["encrypt", path("key.pub"), path("plain"), path("out")]
+  else:
+    args = ["decrypt", path("key"), path("cipher"), path("out")]
+  run = lambda: rsa.MODES[mode](args)
+  run.cleanup = lambda: shutil.rmtree(tempdir)
+  return run
+
+def run_suite(opts):
+  """Times every suite case, best of opts.repeat, and returns the results as
+     a dict that can be written out as JSON."""
+  key_bits = [int(bits) for bits in opts.key_bits.split(",")]
+  payloads = [_parse_size(size) for size in opts.payloads.split(",")]
+  results = collections.OrderedDict()
+  for name, setup in _suite_cases(key_bits, payloads, opts.seed):
+    if opts.filter and opts.filter not in name:
+      continue
+    fxn = setup()
+    try:
+      results[name] = _best_of(fxn, opts.repeat)
+    finally:
+      getattr(fxn, "cleanup", lambda: None)()
+    print >> sys.stderr, "%-28s %12.6f s" % (name, results[name])
+  return {"seed":opts.seed, "repeat":opts.repeat,
+          "backend":rsa.get_backend().name, "results":results}
+
+def compare_results(results, baseline, ratio):
+  """Prints each case against the baseline. Returns the names of cases more
+     than ratio times slower than their baseline time."""
+  regressions = []
+  print "%-28s %12s %12s %8s" % ("case", "baseline (s)", "current (s)", "ratio")
+  for name, elapsed in results["results"].iteritems():
+    before = baseline["results"].get(name)
+    if before is None:
+      print "%-28s %12s %12.6f %8s" % (name, "-", elapsed, "new")
+      continue
+    change = elapsed / before if before else float("inf")
+    flag = ""
+    if change > ratio:
+      regressions.append(name)
+      flag = "  REGRESSED"
+    print "%-28s %12.6f %12.6f %7.2fx%s" % (name, before, elapsed, change, flag)
+  return regressions
+
+def suite(opts):
+  results = run_suite(opts)
+  if opts.output == "-":
+    json.dump(results, sys.stdout, indent=2)
+    print
+  elif opts.output:
+    with open(opts.output, "w") as fileio:
+      json.dump(results, fileio, indent=2)
+
+  if opts.baseline:
+    with open(opts.baseline) as fileio:
+      baseline = json.load(fileio)
+    regressions = compare_results(results, baseline, opts.ratio)
+    if regressions:
+      print >> sys.stderr, "%d case(s) slower than %.2fx the baseline: %s" % (
+          len(regressions), opts.ratio, ", ".join(regressions))
+      return 1
+  return 0
+
+BENCHMARKS = {"backends":bench_backends,
+              "codec":bench_codec,
+              "context":bench_context,
+              "crt":bench_crt,
+              "get_prime":bench_get_prime,
+              "hybrid":bench_hybrid,
+              "jobs":bench_jobs,
+              "keygen":bench_keygen,
+              "memory":bench_memory,
+              "montgomery":bench_montgomery,
+              "multiply":bench_multiply,
+              "packing":bench_packing,
+              "window":bench_window}
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]\n"
+                                       "       %prog [options] suite")
+  parser.add_option("-r", "--repeat", type="int", default=3,
+                    help="timing runs per configuration; the best is kept")
+  parser.add_option("-s", "--seed", type="int", default=34,
+                    help="seed for the inputs")
+  group = optparse.OptionGroup(parser, "Suite options")
+  group.add_option("-k", "--key-bits", default="512,1024,2048,4096",
+                   help="comma separated key sizes [%default]")
+  group.add_option("-p", "--payloads", default="1K,64K",
+                   help="comma separated payload sizes, such as 1K,1M,100M "
+                        "[%default]")
+  group.add_option("-f", "--filter", default="",
+                   help="only run cases whose name contains this")
+  group.add_option("-o", "--output",
+                   help="write results as JSON to this file, or - for stdout")
+  group.add_option("-b", "--baseline",
+                   help="compare against JSON results from an earlier run")
+  group.add_option("--ratio", type="float", default=1.5,
+                   help="fail if a case takes more than this many times its "
+                        "baseline [%default]")
+  parser.add_option_group(group)
+  opts, args = parser.parse_args()
+
+  if args == ["suite"]:
+    return suite(opts)
+  for name in args or sorted(BENCHMARKS):
+    if name not in BENCHMARKS:
+      print >> sys.stderr, "Unknown benchmark %s; choose from %s, or suite" % (
+          name, ", ".join(sorted(BENCHMARKS)))
+      return 2
+    print "== %s" % name
+    BENCHMARKS[name](opts.repeat, opts.seed)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
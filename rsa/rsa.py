@@ -18,19 +18,158 @@
 # * http://web.eecs.umich.edu/~valeria/research/publications/DATE10RSA.pdf
 #
 
+import binascii
+import collections
+import contextlib
+import copy_reg
 import cPickle
+import cProfile
 import cStringIO
+import hashlib
+import itertools
+import json
 import math
+import multiprocessing
+import multiprocessing.pool
+import operator
 import optparse
+import os
+import pstats
+import Queue
 import random
+import signal
+import socket
+import SocketServer
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
+import timeit
+import types
 
-PRIMALITY_ITERATIONS = 100
+try:
+  import gmpy2
+except ImportError:
+  gmpy2 = None
+
+# Miller-Rabin rounds for random candidates by size in bits (inclusive lower
+# bound), after FIPS 186-4 Appendix C.3. Smaller candidates that are not
+# covered by the deterministic bases get PRIMALITY_ITERATIONS rounds.
+MR_ROUNDS = ((1536, 4), (1024, 5), (512, 7))
+PRIMALITY_ITERATIONS = 40
+
+# Testing against these bases is exact for all numbers below the limit.
+MR_DETERMINISTIC_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+MR_DETERMINISTIC_LIMIT = 3317044064679887385961981
 DEFAULT_RSA_KEY_LENGTH = 512
 
 # Point at which recursive bigint routines fall back to native Python math.
-# This must be at least 4, and should ideally be the native word size.
+# This must be at least 4, and should ideally be the native word size. Above
+# TOOM3_MATH_MIN (at least 1 << 16), multiply splits three ways instead of two.
+# Either may be None to disable that tier; both are replaced by a calibrated
+# profile, if any. Toom-3 is off until calibrate finds where it wins, as it
+# does not overtake Karatsuba at any size calibrate tries on CPython.
 NATIVE_MATH_MAX = 1 << 64
+TOOM3_MATH_MIN = None
+
+# calibrate writes the tier thresholds found on this machine to a JSON
+# profile, read back by the command line (not on import) from
+# $PROFILE_ENVIRONMENT or DEFAULT_PROFILE.
+PROFILE_ENVIRONMENT = "RSA_PROFILE"
+DEFAULT_PROFILE = os.path.join(os.path.expanduser("~"), ".rsa_profile.json")
+PROFILE_VERSION = 1
+CALIBRATION_BITS = tuple(64 << i for i in range(11))
+
+# Passing WINDOW_AUTO as the window to modexp picks the width from WINDOW_SIZES,
+# which maps exponent lengths (exclusive lower bound in bits) to window widths.
+WINDOW_AUTO = 0
+WINDOW_SIZES = ((671, 6), (239, 5), (79, 4), (23, 3), (7, 2))
+
+# Arithmetic backend used unless the BACKEND_ENVIRONMENT variable names
+# another; see set_backend.
+DEFAULT_BACKEND = "python"
+BACKEND_ENVIRONMENT = "RSA_BACKEND"
+
+# Maximum number of ExponentContexts kept by exponent_context, least recently
+# used first out.
+CONTEXT_CACHE_SIZE = 32
+
+# get_prime sieves windows of SIEVE_WINDOW consecutive odd candidates against
+# the odd primes below SIEVE_PRIME_LIMIT before running Miller-Rabin.
+SIEVE_PRIME_LIMIT = 2000
+SIEVE_WINDOW = 1024
+
+# Number of plaintext blocks read, encrypted and written at a time by the
+# encrypt command in streaming mode.
+STREAM_CHUNK_BLOCKS = 4096
+
+# Number of blocks handed to a worker process at a time when a Message is
+# mapped over a pool.
+PARALLEL_CHUNK_BLOCKS = 256
+
+# Ciphertext container header: magic, version, flags, key fingerprint, block
+# width in bytes and the number of bytes used in the final block.
+CONTAINER_HEADER = struct.Struct(">4sBB20sII")
+CONTAINER_MAGIC = "RSAc"
+CONTAINER_VERSION = 1
+# Flag set when the final block's overflow follows the blocks as one extra
+# record rather than being in the header.
+CONTAINER_TRAILER = 1
+# Flag set when the plaintext was encoded with PACKING_BITS.
+CONTAINER_BIT_PACKED = 2
+# Flag set for hybrid encryption: the blocks hold a random session key,
+# encrypted with the key, and the rest of the file is the plaintext XORed with
+# the session key's keystream (see _keystream).
+CONTAINER_HYBRID = 4
+CONTAINER_FLAGS = CONTAINER_TRAILER | CONTAINER_BIT_PACKED | CONTAINER_HYBRID
+
+# Message encodings. PACKING_BYTES puts whole bytes in each block, one byte
+# fewer than the modulus takes; overflow counts the bytes used in the final
+# block. PACKING_BITS puts floor(log2(modulo)) bits in each block; overflow
+# counts the bits used in the final block.
+PACKING_BYTES = 0
+PACKING_BITS = 1
+
+# Hybrid encryption: bytes of random session key, bytes of keystream made per
+# hash, and bytes of payload read and transformed at a time. The chunk size
+# must be a multiple of KEYSTREAM_BLOCK. A pool is handed at most
+# KEYSTREAM_WINDOW chunks at a time, so memory stays bounded.
+#
+# Python 2's hashlib costs about a microsecond per hash object on top of the
+# hashing, and has no XOF or stream cipher, so the keystream is bounded by one
+# SHA-512 per 64 bytes: tens of MB/s rather than the hundreds first aimed for
+# (bench_rsa.py hybrid, and keystream in the suite).
+SESSION_KEY_BYTES = 32
+KEYSTREAM_BLOCK = hashlib.sha512().digest_size
+KEYSTREAM_COUNTER = struct.Struct(">Q")
+HYBRID_CHUNK_BYTES = 1 << 20
+KEYSTREAM_WINDOW = 8
+
+# serve answers requests on a Unix socket. Each request is a SERVE_REQUEST
+# header (operation index into SERVE_OPERATIONS, key name length, payload
+# length) followed by the key name and payload; each response is a
+# SERVE_RESPONSE header (SERVE_OK or SERVE_ERROR, payload length) followed by
+# the result or an error message. Responses come back in request order, and at
+# most SERVE_MAX_PENDING requests from each connection are worked on at once,
+# so a client that stops reading its responses only holds up itself.
+SERVE_REQUEST = struct.Struct(">BHI")
+SERVE_RESPONSE = struct.Struct(">BI")
+SERVE_OPERATIONS = ("encrypt", "decrypt", "publicextract")
+SERVE_OK = 0
+SERVE_ERROR = 1
+SERVE_MAX_PENDING = 64
+SERVE_MAX_PAYLOAD = 64 << 20
+# Requests a client sends ahead of the responses it has read.
+SERVE_CLIENT_WINDOW = 8
+# The socket decrypts with the keys it serves, so each user gets their own,
+# in their runtime directory where there is one, and only they may connect.
+SOCKET_ENVIRONMENT = "RSA_SOCKET"
+DEFAULT_SOCKET = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(),
+    "rsa-%d.sock" % os.getuid())
+SOCKET_MODE = 0600
 
 class RSAException(Exception):
   pass
@@ -38,9 +177,81 @@ class RSAException(Exception):
 class DecodeRangeError(RSAException):
   pass
 
+class MalformedCiphertext(RSAException):
+  pass
+
+class BlockRangeError(RSAException):
+  pass
+
 class FailedToLoadKeyfile(RSAException):
   pass
 
+class ServeError(RSAException):
+  pass
+
+class UnknownBackend(RSAException):
+  pass
+
+# Instrumentation, off unless enable_stats has been called. Hot paths check
+# _counters against None before counting, so disabled it costs one global
+# lookup per call.
+_counters = None
+_spans = None
+
+def enable_stats():
+  """Starts counting arithmetic and prime search events and timing CLI phases,
+     discarding anything recorded before. Work done in pool worker processes
+     is not counted, except for the blocks handed to them."""
+  global _counters, _spans
+  _counters = collections.Counter()
+  _spans = collections.OrderedDict()
+
+def disable_stats():
+  global _counters, _spans
+  _counters = _spans = None
+
+def get_stats():
+  """Returns (counters, spans): event counts and seconds spent per phase, or
+     None if stats are not enabled."""
+  if _counters is None:
+    return None
+  return collections.Counter(_counters), collections.OrderedDict(_spans)
+
+@contextlib.contextmanager
+def span(name):
+  """Adds the wall time spent in the block to the named phase."""
+  if _spans is None:
+    yield
+    return
+  start = time.time()
+  try:
+    yield
+  finally:
+    _spans[name] = _spans.get(name, 0.0) + time.time() - start
+
+def _spanned(name, iterable):
+  """Yields from iterable, adding the time spent producing each item to the
+     named phase."""
+  iterator = iter(iterable)
+  while True:
+    with span(name):
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+    yield item
+
+def format_stats():
+  """Formats get_stats() as a table for the --stats option."""
+  counters, spans = get_stats()
+  lines = ["%-16s %14s" % ("counter", "count")]
+  for name, count in sorted(counters.iteritems()):
+    lines.append("%-16s %14d" % (name, count))
+  lines.append("%-16s %14s" % ("phase", "seconds"))
+  for name, elapsed in spans.iteritems():
+    lines.append("%-16s %14.4f" % (name, elapsed))
+  return "\n".join(lines)
+
 def _extended_euclidean(a, b):
   """Helper function that runs the extended Euclidean algorithm, which
      finds x and y st a * x + b * y = gcd(a, b). Used for gcd and modular
@@ -48,15 +259,16 @@ def _extended_euclidean(a, b):
   flip = b > a
   if flip:
     a, b = b, a
-  if b == 0:
-    return 1, 0, a
-  x, y, gcd = _extended_euclidean(b, a % b)
-  ny = y
-  nx = x - (a / b) * y
-  assert a * ny + b * nx == gcd
+  # Invariant: a == a0 * x0 + b0 * y0 and b == a0 * x1 + b0 * y1.
+  x0, y0, x1, y1 = 1, 0, 0, 1
+  while b:
+    q, r = divmod(a, b)
+    a, b = b, r
+    x0, x1 = x1, x0 - q * x1
+    y0, y1 = y1, y0 - q * y1
   if flip:
-    ny, nx = nx, ny
-  return ny, nx, gcd
+    x0, y0 = y0, x0
+  return x0, y0, a
 
 def gcd(a, b):
   """Returns the greatest common denominator of a, b."""
@@ -64,7 +276,29 @@ def gcd(a, b):
   _, _, d = _extended_euclidean(a, b)
   return d
 
-def modmul(x, y, n, base=None):
+def _above(x, y, threshold):
+  return threshold is not None and (x >= threshold or y >= threshold)
+
+def multiply(x, y):
+  """Computes x * y without reduction, choosing between native, Karatsuba and
+     Toom-3 multiplication by the size of the operands; see NATIVE_MATH_MAX
+     and TOOM3_MATH_MIN."""
+  if x < 0 or y < 0:
+    product = multiply(abs(x), abs(y))
+    return -product if (x < 0) != (y < 0) else product
+  if _above(x, y, TOOM3_MATH_MIN):
+    if _counters is not None:
+      _counters["toom3"] += 1
+    return _multiply_toom3(x, y)
+  if _above(x, y, NATIVE_MATH_MAX):
+    if _counters is not None:
+      _counters["karatsuba"] += 1
+    return _multiply_karatsuba(x, y)
+  return x * y
+
+def _multiply_karatsuba(x, y):
+  """One level of Karatsuba for non-negative x, y; the three half-size
+     products go back through multiply."""
   # O(n^log_2(3)) algorithm
   #
   # (a + kc)(b + kd) = ab + k(ad + bc) + kkcd
@@ -75,28 +309,129 @@ def modmul(x, y, n, base=None):
   # let crossover = (a + c)(b + d) - ab - cd = ad + bc
   #
   # (a + kc)(b + kd) = ab + k * crossover + k * k * cd
-  if x >= NATIVE_MATH_MAX or y >= NATIVE_MATH_MAX:
-    if base is None:
-      base = int(0.5 + math.log(max(x, y), 2))
-    base /= 2
-
-    # Split x and y into low and high nibbles
-    base_mask = (1 << base) - 1
-    a = x & base_mask
-    c = x >> base
-
-    b = y & base_mask
-    d = y >> base
-
-    # Compute intermediates, which each require one multiplication.
-    ab = modmul(a, b, n)
-    cd = modmul(c, d, n)
-    crossover = (modmul((a + c), (b + d), n) - ab - cd) % n
-
-    # Final result can be assembled with just shifts and adds.
-    return (ab + (((cd << base) + crossover) << base)) % n
-  else:
-    return (x * y) % n
+  base = max(x, y).bit_length() / 2
+
+  # Split x and y into low and high nibbles
+  base_mask = (1 << base) - 1
+  a = x & base_mask
+  c = x >> base
+
+  b = y & base_mask
+  d = y >> base
+
+  # Compute intermediates, which each require one multiplication.
+  ab = multiply(a, b)
+  cd = multiply(c, d)
+  crossover = multiply(a + c, b + d) - ab - cd
+
+  # Final result can be assembled with just shifts and adds.
+  return ab + (((cd << base) + crossover) << base)
+
+def _multiply_toom3(x, y):
+  """One level of Toom-3 for non-negative x, y: five third-size products
+     instead of Karatsuba's nine, at the cost of more additions."""
+  # Split into thirds, x = x0 + x1 k + x2 k^2, and treat x and y as
+  # polynomials in k. Evaluate at 0, 1, -1, -2 and infinity, multiply
+  # pointwise and interpolate the degree 4 product (Bodrato's sequence).
+  base = (max(x, y).bit_length() + 2) / 3
+  mask = (1 << base) - 1
+  x0, x1, x2 = x & mask, (x >> base) & mask, x >> (2 * base)
+  y0, y1, y2 = y & mask, (y >> base) & mask, y >> (2 * base)
+
+  x02 = x0 + x2
+  y02 = y0 + y2
+  r0 = multiply(x0, y0)
+  r1 = multiply(x02 + x1, y02 + y1)
+  rm1 = multiply(x02 - x1, y02 - y1)
+  rm2 = multiply(x0 - 2 * x1 + 4 * x2, y0 - 2 * y1 + 4 * y2)
+  rinf = multiply(x2, y2)
+
+  # All the divisions are exact.
+  c3 = (rm2 - r1) / 3
+  c1 = (r1 - rm1) / 2
+  c2 = rm1 - r0
+  c3 = (c2 - c3) / 2 + 2 * rinf
+  c2 = c2 + c1 - rinf
+  c1 = c1 - c3
+  return r0 + ((c1 + ((c2 + ((c3 + (rinf << base)) << base)) << base)) << base)
+
+def modmul(x, y, n, context=None):
+  """Computes (x * y) mod n. If context is a MontgomeryContext for n, the
+     product is formed with Montgomery reduction; otherwise it is formed in
+     full with multiply and reduced once."""
+  if _counters is not None:
+    _counters["modmul"] += 1
+  if context is not None:
+    assert context.n == n
+    return context.mul(context.to_montgomery(x), y % n)
+  return multiply(x, y) % n
+
+def _time_multiplication(fxn, x, y, repeat):
+  number = max(1, (1 << 20) / x.bit_length())
+  return min(timeit.repeat(lambda: fxn(x, y), number=number, repeat=repeat))
+
+def _crossover(lower, upper, R, repeat, start=0):
+  """Returns the smallest of CALIBRATION_BITS (from start) at which upper
+     multiplies faster than lower, and keeps doing so at the next size up, or
+     None if there is no such size. Near the crossover the two are within
+     timing noise, so a single win is not enough."""
+  wins = []
+  sizes = [nbits for nbits in CALIBRATION_BITS if nbits >= start]
+  for nbits in sizes:
+    x = R.getrandbits(nbits) | (1 << (nbits - 1))
+    y = R.getrandbits(nbits) | (1 << (nbits - 1))
+    wins.append(_time_multiplication(upper, x, y, repeat) <
+                _time_multiplication(lower, x, y, repeat))
+    if len(wins) >= 2 and wins[-2] and wins[-1]:
+      return sizes[len(wins) - 2]
+  return None
+
+def calibrate(path=None, repeat=5):
+  """Measures where Karatsuba overtakes native multiplication and where Toom-3
+     overtakes Karatsuba on this machine, sets the thresholds and saves them
+     as a profile at path (by default as for load_profile). Each comparison is
+     one level of the faster tier over the tier below it. Returns the
+     profile."""
+  global NATIVE_MATH_MAX, TOOM3_MATH_MIN
+  R = random.Random(0)
+  TOOM3_MATH_MIN = None
+  NATIVE_MATH_MAX = None
+  karatsuba = _crossover(multiply, _multiply_karatsuba, R, repeat)
+  toom3 = None
+  if karatsuba is not None:
+    # Below a karatsuba-bit operand, sub-products stay native.
+    NATIVE_MATH_MAX = 1 << karatsuba
+    toom3 = _crossover(multiply, _multiply_toom3, R, repeat, karatsuba)
+  profile = {"version":PROFILE_VERSION, "karatsuba_bits":karatsuba,
+             "toom3_bits":toom3}
+  _apply_profile(profile)
+  with open(path or _profile_path(), "w") as fileio:
+    json.dump(profile, fileio, indent=2, sort_keys=True)
+  return profile
+
+def _profile_path():
+  return os.environ.get(PROFILE_ENVIRONMENT) or DEFAULT_PROFILE
+
+def _apply_profile(profile):
+  global NATIVE_MATH_MAX, TOOM3_MATH_MIN
+  bits = profile["karatsuba_bits"], profile["toom3_bits"]
+  NATIVE_MATH_MAX, TOOM3_MATH_MIN = [
+      None if b is None else 1 << max(int(b), least)
+      for b, least in zip(bits, (2, 16))]
+
+def load_profile(path=None):
+  """Sets the multiplication thresholds from a profile written by calibrate.
+     Returns the profile, or None (leaving the thresholds alone) if there is
+     no usable profile at path."""
+  try:
+    with open(path or _profile_path()) as fileio:
+      profile = json.load(fileio)
+    if profile.get("version") != PROFILE_VERSION:
+      return None
+    _apply_profile(profile)
+  except (IOError, ValueError, KeyError, TypeError, AttributeError):
+    return None
+  return profile
 
 def modinv(x, n):
   """Returns the inverse of x mod n if it exists, or None if not."""
@@ -106,25 +441,246 @@ def modinv(x, n):
   else:
     return a % n
 
-def modexp(x, y, n):
-  """Computes (x ** y) mod n"""
-  z = 1
-  for i in reversed(range(int(math.ceil(math.log(y + 1, 2))))):
-    z_squared = modmul(z, z, n)
-    if (1 << i) & y:
-      z = modmul(x, z_squared, n)
-    else:
-      z = z_squared
-  return z % n
+class MontgomeryContext(object):
+  """Precomputed constants for Montgomery multiplication modulo an odd n > 1.
+     A value x is held in Montgomery form as x * R mod n, where R = 2 ** k is
+     the smallest power of two above n. Products of Montgomery-form values are
+     then reduced with a mask, a multiply and a shift (REDC) instead of a
+     division by n, which is what makes long exponentiations cheap."""
+  def __init__(self, n):
+    assert n > 1 and n % 2 == 1
+    self.n = n
+    self.k = n.bit_length()
+    self.R = 1 << self.k
+    self.mask = self.R - 1
+
+    # Newton iteration for n ** -1 mod R; each step doubles the number of
+    # correct low bits, starting from n * 1 == 1 mod 2.
+    inv = 1
+    bits = 1
+    while bits < self.k:
+      bits *= 2
+      inv = (inv * (2 - n * inv)) & ((1 << bits) - 1)
+    inv &= self.mask
+
+    # n * n_prime == -1 mod R, and R * R_inv == 1 mod n.
+    self.n_prime = (-inv) & self.mask
+    self.R_inv = (-((n * inv - 1) >> self.k)) % n
+    self.R2 = (self.R * self.R) % n
+    self.one = self.R % n
+
+  def reduce(self, t):
+    """Montgomery reduction (REDC): returns t * R ** -1 mod n for 0 <= t < nR."""
+    m = ((t & self.mask) * self.n_prime) & self.mask
+    t = (t + m * self.n) >> self.k
+    if t >= self.n:
+      t -= self.n
+    return t
+
+  def mul(self, a, b):
+    """Multiplies two values in Montgomery form."""
+    if _counters is not None:
+      _counters["montgomery_mul"] += 1
+    return self.reduce(a * b)
+
+  def to_montgomery(self, x):
+    return self.reduce((x % self.n) * self.R2)
+
+  def from_montgomery(self, x):
+    return self.reduce(x)
+
+def _window_size(nbits):
+  """Picks a sliding window width for an exponent of nbits bits, trading the
+     2 ** (k - 1) multiplications spent on the odd-power table against the
+     roughly nbits / (k + 1) multiplications done while scanning."""
+  for min_bits, k in WINDOW_SIZES:
+    if nbits > min_bits:
+      return k
+  return 1
+
+def _exp_binary(x, y, mul, one):
+  """Left-to-right square-and-multiply."""
+  z = one
+  for i in reversed(range(y.bit_length())):
+    z = mul(z, z)
+    if (y >> i) & 1:
+      z = mul(x, z)
+  return z
+
+def _exp_fixed_window(x, y, mul, one, k):
+  """k-ary exponentiation: scans the exponent k bits at a time, multiplying by
+     a table entry x ** digit after every k squarings."""
+  table = [one, x]
+  for i in range(2, 1 << k):
+    table.append(mul(table[-1], x))
+  digit_mask = (1 << k) - 1
+  z = None
+  for shift in reversed(range(0, y.bit_length(), k)):
+    if z is not None:
+      for _ in range(k):
+        z = mul(z, z)
+    digit = (y >> shift) & digit_mask
+    if z is None:
+      z = table[digit]
+    elif digit:
+      z = mul(z, table[digit])
+  return one if z is None else z
+
+def _sliding_window_schedule(y, k):
+  """Recodes the exponent y into windows of at most k bits that start and end
+     on a set bit. Returns a list of (squarings, index) steps: square that many
+     times, then multiply by the odd power 2 * index + 1 (or not at all if
+     index is None). The first step's squarings are skipped, since it only
+     loads the leading window."""
+  schedule = []
+  zeros = 0
+  i = y.bit_length() - 1
+  while i >= 0:
+    if not (y >> i) & 1:
+      zeros += 1
+      i -= 1
+      continue
+    # Take the longest window of at most k bits from bit i down that ends on a
+    # set bit.
+    low = max(i - k + 1, 0)
+    while not (y >> low) & 1:
+      low += 1
+    width = i - low + 1
+    value = (y >> low) & ((1 << width) - 1)
+    schedule.append((zeros + width, value >> 1))
+    zeros = 0
+    i = low - 1
+  if zeros:
+    schedule.append((zeros, None))
+  return schedule
+
+def _exp_sliding_window(x, y, mul, one, k, schedule=None):
+  """Left-to-right sliding window exponentiation. Windows always start and end
+     on a set bit, so only the odd powers x, x ** 3, ..., x ** (2 ** k - 1)
+     need to be tabulated and runs of zeros cost one squaring per bit. schedule
+     may be passed in if already computed by _sliding_window_schedule."""
+  if schedule is None:
+    schedule = _sliding_window_schedule(y, k)
+  odd_powers = [x]
+  if k > 1:
+    x_squared = mul(x, x)
+    for i in range(1, 1 << (k - 1)):
+      odd_powers.append(mul(odd_powers[-1], x_squared))
+
+  z = None
+  for squarings, index in schedule:
+    if z is None:
+      z = odd_powers[index]
+      continue
+    for _ in xrange(squarings):
+      z = mul(z, z)
+    if index is not None:
+      z = mul(z, odd_powers[index])
+  return one if z is None else z
+
+def batch_modinv(values, n):
+  """Returns the inverses of each of values mod n, using Montgomery's trick so
+     that k values cost a single modinv plus 3(k - 1) modmuls. Values with no
+     inverse come back as None."""
+  values = list(values)
+  if not values:
+    return []
+  prefix = [values[0] % n]
+  for value in values[1:]:
+    prefix.append(modmul(prefix[-1], value, n))
 
-def isprime(x, N=PRIMALITY_ITERATIONS):
+  inverse = modinv(prefix[-1], n)
+  if inverse is None:
+    # Some value shares a factor with n; only per-value inversion can tell
+    # which.
+    return [modinv(value, n) for value in values]
+
+  # inverse is now (v0 * ... * vi) ** -1; peel one value off at a time.
+  result = [None] * len(values)
+  for i in reversed(range(1, len(values))):
+    result[i] = modmul(inverse, prefix[i - 1], n)
+    inverse = modmul(inverse, values[i], n)
+  result[0] = inverse
+  return result
+
+def modexp(x, y, n, context=None, window=1, sliding=True):
+  """Computes (x ** y) mod n. If context is a MontgomeryContext for n, the
+     intermediate values stay in Montgomery form for the whole exponentiation
+     and are only converted in and out at the ends.
+
+     window selects the exponentiation strategy: 1 is plain square-and-multiply,
+     k > 1 processes the exponent k bits at a time (sliding windows over odd
+     powers, or fixed k-ary digits if sliding is False), and WINDOW_AUTO picks
+     k from the bit length of y."""
+  if _counters is not None:
+    _counters["modexp"] += 1
+  if context is None:
+    mul = lambda a, b: modmul(a, b, n)
+    one = 1
+    x %= n
+  else:
+    assert context.n == n
+    mul = context.mul
+    one = context.one
+    x = context.to_montgomery(x)
+
+  if window == WINDOW_AUTO:
+    window = _window_size(y.bit_length())
+  if window <= 1:
+    z = _exp_binary(x, y, mul, one)
+  elif sliding:
+    z = _exp_sliding_window(x, y, mul, one, window)
+  else:
+    z = _exp_fixed_window(x, y, mul, one, window)
+
+  if context is None:
+    return z % n
+  return context.from_montgomery(z)
+
+def _mr_rounds(nbits):
+  """Number of random Miller-Rabin bases to try for an nbits-bit candidate."""
+  for min_bits, rounds in MR_ROUNDS:
+    if nbits >= min_bits:
+      return rounds
+  return PRIMALITY_ITERATIONS
+
+def _miller_rabin_round(context, a, t):
+  """Tests one base a against the odd n = context.n, where n - 1 == u * 2 ** t
+     and context raises to the power u mod n. Returns False if a proves n
+     composite (Fermat test or a nontrivial square root of 1), True
+     otherwise."""
+  n = context.n
+  val = context.power(a)
+  if val == 1 or val == n - 1:
+    return True
+  # Square until we reach -1 (consistent with a prime) or 1, in which case the
+  # previous value was a nontrivial square root of 1.
+  for i in xrange(t - 1):
+    val = _backend.mulmod(val, val, n)
+    if val == n - 1:
+      return True
+    if val == 1:
+      return False
+  return False
+
+def isprime(x, N=None, stats=None):
   """Uses the primality test of Rabin and Miller (based on Fermat's little
-     theorem with extensions for Carmichael numbers). Probability of false
-     positive is (1/4) ** PRIMALITY_ITERATIONS."""
+     theorem with extensions for Carmichael numbers). Numbers below
+     MR_DETERMINISTIC_LIMIT are tested against MR_DETERMINISTIC_BASES, which
+     is exact. Larger numbers are tested against N random bases, by default
+     chosen from the bit length with MR_ROUNDS; each base lets a composite
+     through with probability at most 1/4. If stats is given (such as a
+     collections.Counter), the rounds run are added to stats["mr_rounds"]."""
   assert x >= 0
+  if stats is None:
+    stats = _counters
   # Special cases
-  if x == 0 or x == 1:
+  if x < 4:
+    return x in (2, 3)
+  if x % 2 == 0:
     return False
+  if x in MR_DETERMINISTIC_BASES:
+    return True
 
   # Find t and u such that u * (2 ** t) == x - 1
   t = 0
@@ -132,77 +688,268 @@ def isprime(x, N=PRIMALITY_ITERATIONS):
   while u % 2 == 0:
     t += 1
     u /= 2
-  assert (2 ** t) * u == x - 1
-
-  def prime_test_one_base(a, t, u, x):
-    """Tests one 0 < a < x by repeated squaring. Returns False
-       if a contradiction (nontrivial square root or Fermat test), True
-       otherwise."""
-    assert 0 < a < x
-    # Repeatedly square mod x to compute a^N-1 mod x so we can check for
-    # non-trivial square roots, which is necessary to detect Carmichael numbers.
-    val = modexp(a, u, x)
-    found_first_one = (val == 1)
-    for i in range(t):
-      new_val = modexp(val, 2, x)
-      # If there exists a non-trivial square root, x must be composite provided
-      # it is the first time 1 appears in the sequence.
-      if new_val == 1 and not found_first_one:
-        found_first_one = True
-        if val != x - 1:
-          return False
-      val = new_val
-    return val == 1
-    
-  for i in range(N):
-    a = random.randint(1, x - 1)
-    if not prime_test_one_base(a, t, u, x):
-      return False
+
+  if x < MR_DETERMINISTIC_LIMIT:
+    bases = MR_DETERMINISTIC_BASES
   else:
-    return True
+    if N is None:
+      N = _mr_rounds(x.bit_length())
+    bases = (random.randint(2, x - 2) for i in xrange(N))
 
-def get_prime(nbits):
-  """Gets a prime that is n bits in length. Requires nbits > 2."""
+  context = _backend.context(x, u)
+  for a in bases:
+    if stats is not None:
+      stats["mr_rounds"] += 1
+    if not _miller_rabin_round(context, a, t):
+      return False
+  return True
+
+def _small_primes(limit):
+  """Returns the odd primes below limit (sieve of Eratosthenes)."""
+  composite = bytearray(limit)
+  primes = []
+  for i in xrange(3, limit, 2):
+    if not composite[i]:
+      primes.append(i)
+      composite[i * i::2 * i] = "\x01" * len(xrange(i * i, limit, 2 * i))
+  return primes
+
+_SIEVE_PRIMES = _small_primes(SIEVE_PRIME_LIMIT)
+
+def _sieve_window(start, count, largest):
+  """Marks which of the count odd numbers start, start + 2, ... are divisible
+     by a small prime. Primes are only used up to sqrt(largest), so no
+     candidate can be struck for being a small prime itself."""
+  composite = bytearray(count)
+  for p in _SIEVE_PRIMES:
+    if p * p > largest:
+      break
+    # Solve start + 2i == 0 mod p; (p + 1) / 2 is the inverse of 2 mod p.
+    first = (-start * ((p + 1) / 2)) % p
+    if first < count:
+      composite[first::p] = "\x01" * len(xrange(first, count, p))
+  return composite
+
+def get_prime(nbits, sieve=True, stats=None):
+  """Gets a prime that is n bits in length. Requires nbits > 2.
+
+     With sieve, picks a random odd starting point and sieves the following
+     SIEVE_WINDOW odd numbers against small primes, running Miller-Rabin only
+     on the survivors; otherwise every uniformly random number is sent to
+     isprime. If stats is given (such as a collections.Counter), the numbers
+     sent to isprime are added to stats["candidates"], those rejected by the
+     sieve to stats["sieved"], and the Miller-Rabin rounds to
+     stats["mr_rounds"]."""
   assert nbits > 2
-  number = 4
-  while not isprime(number):
-    number = random.randint(2 ** (nbits - 1), 2 ** nbits - 1)
-  return number
+  if stats is None:
+    stats = _counters
+  low = 2 ** (nbits - 1)
+  high = 2 ** nbits - 1
+  if not sieve:
+    number = 4
+    while True:
+      if stats is not None:
+        stats["candidates"] += 1
+      if isprime(number, stats=stats):
+        return number
+      number = random.randint(low, high)
+
+  while True:
+    start = random.randint(low, high) | 1
+    count = min(SIEVE_WINDOW, (high - start) / 2 + 1)
+    composite = _sieve_window(start, count, high)
+    if stats is not None:
+      stats["sieved"] += composite.count("\x01")
+    i = composite.find("\x00")
+    while i != -1:
+      if stats is not None:
+        stats["candidates"] += 1
+      if isprime(start + 2 * i, stats=stats):
+        return start + 2 * i
+      i = composite.find("\x00", i + 1)
+
+def _prime_search_worker(args):
+  """Pool worker for get_distinct_primes: searches its own random stream."""
+  nbits, seed = args
+  random.seed(seed)
+  return get_prime(nbits)
+
+def get_distinct_primes(nbits, count, workers):
+  """Gets count distinct primes that are nbits in length by running get_prime
+     in a pool of worker processes, each reseeded so that they search disjoint
+     candidate streams. The first distinct primes found win and the remaining
+     searches are abandoned."""
+  assert nbits > 2 and workers >= 1
+  pool = multiprocessing.Pool(workers)
+  try:
+    results = Queue.Queue()
+    searches = []
+    def submit():
+      searches.append(pool.apply_async(_prime_search_worker,
+                                       ((nbits, random.getrandbits(64)),),
+                                       callback=results.put))
+
+    for i in range(workers):
+      submit()
+    primes = []
+    while len(primes) < count:
+      # Failed searches never reach the callback, so poll for them instead of
+      # blocking forever.
+      try:
+        prime = results.get(True, 0.1)
+      except Queue.Empty:
+        for search in searches:
+          if search.ready() and not search.successful():
+            search.get()
+        continue
+      if prime not in primes:
+        primes.append(prime)
+      # Keep every worker busy until enough distinct primes have come back.
+      if len(primes) < count:
+        submit()
+    return primes
+  finally:
+    pool.terminate()
+    pool.join()
+
+def _reduce_method(method):
+  return getattr, (method.im_self, method.im_func.__name__)
+
+# Bound methods such as key.EncryptInteger are not picklable by default, but
+# need to be to be sent to worker processes.
+copy_reg.pickle(types.MethodType, _reduce_method)
+
+def _map_chunk(args):
+  """Pool worker for Message.Mapped: transforms a run of packed blocks."""
+  fxn, width, data, result_width = args
+  return _pack_blocks(map(fxn, _unpack_blocks(data, width)), result_width)
+
+def _pack_blocks(numbers, width):
+  """Packs numbers into fixed-width big-endian records. Raises BlockRangeError
+     if any number is negative or too large for the width."""
+  digits = "".join(["%0*x" % (2 * width, number) for number in numbers])
+  if len(digits) != 2 * width * len(numbers) or "-" in digits:
+    raise BlockRangeError("Numbers do not fit in %d byte blocks." % width)
+  return binascii.unhexlify(digits)
+
+def _unpack_blocks(data, width):
+  """Inverse of _pack_blocks; len(data) must be a multiple of width."""
+  digits = binascii.hexlify(data)
+  return [int(digits[i:i + 2 * width], 16)
+          for i in xrange(0, len(digits), 2 * width)]
 
 class Message(object):
   """Very simple class to represent a message that can be [de]encoded through
      a key. This class is used to manage the dual forms of bytestring and number
      sequence. Numbers is a sequence of integers, modulo is the mod we work in.
-     Caller is responsible for validity of numbers. The encoding used here is
-     extremely simple and inefficient in space use."""
-  #TODO: Consider lazy implementation for better large-file performance
-  def __init__(self, numbers, modulo, overflow):
-    self.numbers = numbers
+     Caller is responsible for validity of numbers. The default encoding used
+     here is extremely simple and inefficient in space use; PACKING_BITS fills
+     every usable bit instead.
+
+     The numbers are stored packed in a single buffer of fixed-width big-endian
+     blocks, each wide enough for any number below modulo (or wider, see
+     Mapped), and only become Python integers while they are being operated
+     on."""
+  __slots__ = ("modulo", "overflow", "packing", "_width", "_buffer")
+
+  def __init__(self, numbers, modulo, overflow, packing=PACKING_BYTES):
     self.modulo = modulo
     self.overflow = overflow
+    self.packing = packing
+    self._width = self._base_from_modulo(modulo) / 8
+    self._buffer = bytearray(_pack_blocks(numbers, self._width))
+
+  @classmethod
+  def FromBlocks(klass, data, modulo, overflow, width=None,
+                 packing=PACKING_BYTES):
+    """Creates a message directly from packed blocks, as returned by
+       BlockBytes. width defaults to the narrowest that holds modulo."""
+    message = klass([], modulo, overflow, packing)
+    message._width = width or message._width
+    if len(data) % message._width:
+      raise BlockRangeError("Data is not a whole number of blocks.")
+    message._buffer = bytearray(data)
+    return message
+
+  @property
+  def numbers(self):
+    """The blocks as a list of integers."""
+    return _unpack_blocks(self._buffer, self._width)
+
+  def Blocks(self, count=PARALLEL_CHUNK_BLOCKS):
+    """Yields the blocks as integers, converting count at a time."""
+    for data in self._Chunks(count):
+      for number in _unpack_blocks(data, self._width):
+        yield number
+
+  def BlockBytes(self):
+    """Returns the packed blocks."""
+    return str(self._buffer)
+
+  def _Chunks(self, count):
+    """Yields the packed blocks count at a time."""
+    size = count * self._width
+    view = memoryview(self._buffer)
+    for i in xrange(0, len(self._buffer), size):
+      yield view[i:i + size].tobytes()
 
   @classmethod
-  def Encode(klass, data, modulo):
+  def Encode(klass, data, modulo, packing=PACKING_BYTES):
     """Converts the data to a byte sequence in multiples of 8 (could be more
-       efficient but code complexity not worth it)."""
+       efficient but code complexity not worth it), or with PACKING_BITS to
+       floor(log2(modulo)) bits per number."""
     assert modulo > 2 ** 8
-    base = klass._base_from_modulo(modulo)
-    bytes_per_item = base / 8 - 1
+    if packing == PACKING_BITS:
+      return klass._EncodeBits(data, modulo)
+    bytes_per_item = klass._bytes_per_item(modulo)
     assert bytes_per_item >= 1
     num_items = int(math.ceil(float(len(data)) / bytes_per_item))
-    items = []
     overflow = len(data) % bytes_per_item
     if overflow == 0:
       overflow = bytes_per_item
-    for i in range(num_items):
-      num = 0
-      for byte in data[i * bytes_per_item:(i + 1) * bytes_per_item]:
-        num = ((num << 8) + ord(byte))
-      if (i + 1) * bytes_per_item > len(data):
-        num <<= 8 * ((i + 1) * bytes_per_item - len(data))
-      assert 0 <= num < 256 ** bytes_per_item
-      items.append(num)
-    return Message(items, modulo, overflow)
+    # Each block is a zero byte followed by bytes_per_item bytes of data, with
+    # the final block zero-filled. Copy one byte column at a time so the work
+    # per Python operation grows with the data.
+    data += "\0" * (num_items * bytes_per_item - len(data))
+    width = bytes_per_item + 1
+    buf = bytearray(num_items * width)
+    for i in xrange(bytes_per_item):
+      buf[i + 1::width] = data[i::bytes_per_item]
+    return klass.FromBlocks(buf, modulo, overflow)
+
+  @classmethod
+  def _EncodeBits(klass, data, modulo):
+    bits = klass._bits_per_item(modulo)
+    group_bytes, per_group = klass._bit_groups(bits)
+    num_items = (len(data) * 8 + bits - 1) / bits
+    overflow = len(data) * 8 - (num_items - 1) * bits if num_items else bits
+    # Every group_bytes bytes of data make exactly per_group numbers.
+    data += "\0" * (-len(data) % group_bytes)
+    mask = (1 << bits) - 1
+    shifts = [bits * i for i in reversed(xrange(per_group))]
+    numbers = []
+    for i in xrange(0, len(data), group_bytes):
+      value = int(binascii.hexlify(data[i:i + group_bytes]), 16)
+      numbers.extend([(value >> shift) & mask for shift in shifts])
+    del numbers[num_items:]
+    return klass(numbers, modulo, overflow, PACKING_BITS)
+
+  def _DecodeBits(self):
+    bits = self._bits_per_item(self.modulo)
+    group_bytes, per_group = self._bit_groups(bits)
+    numbers = self.numbers
+    if any(number >> bits for number in numbers):
+      raise DecodeRangeError()
+    total_bits = (len(numbers) - 1) * bits + self.overflow if numbers else 0
+
+    numbers += [0] * (-len(numbers) % per_group)
+    digits = []
+    for i in xrange(0, len(numbers), per_group):
+      value = 0
+      for number in numbers[i:i + per_group]:
+        value = (value << bits) | number
+      digits.append("%0*x" % (2 * group_bytes, value))
+    return binascii.unhexlify("".join(digits))[:total_bits / 8]
 
   def Decode(self):
     """Converts the message contents to bytes. Requires that all numbers are
@@ -210,48 +957,290 @@ class Message(object):
        output of encryption. Throws DecodeRangeError in such cases. This is
        necessary because inputs may be arbitrary data, but encrypted data will
        be modulo some number N, which is represented by ceil(log(N, 2)) bits."""
-    base = self._base_from_modulo(self.modulo)
-    bytes_per_item = base / 8 - 1
+    if self.packing == PACKING_BITS:
+      return self._DecodeBits()
+    bytes_per_item = self._bytes_per_item(self.modulo)
     assert bytes_per_item >= 1
-    my_data = []
-
-    for item in self.numbers:
-      if not 0 <= item < 256 ** bytes_per_item:
+    width = self._width
+    lead = width - bytes_per_item
+    # Numbers below 256 ** bytes_per_item have zero leading bytes.
+    for i in xrange(lead):
+      leading = self._buffer[i::width]
+      if leading.count("\0") != len(leading):
         raise DecodeRangeError()
-      for i in reversed(xrange(bytes_per_item)):
-        my_data.append(chr((((0xFF << (i * 8)) & item) >> (i * 8))))
+
+    data = bytearray(len(self._buffer) / width * bytes_per_item)
+    for i in xrange(bytes_per_item):
+      data[i::bytes_per_item] = self._buffer[i + lead::width]
     if self.overflow < bytes_per_item:
-      return "".join(my_data[:-(bytes_per_item - self.overflow)])
+      return str(data[:-(bytes_per_item - self.overflow)])
     else:
-      return "".join(my_data)
+      return str(data)
 
-  def Mapped(self, fxn):
+  def Mapped(self, fxn, pool=None, bound=None):
     """Returns a new message that is the result of the old with numbers
        transformed by fxn. The result is NOT checked against the base for
-       legality."""
-    return Message(map(fxn, self.numbers), self.modulo, self.overflow)
+       legality, but must fit in the block width; pass bound, an exclusive
+       upper limit on the results, if they may be wider than the base. Blocks
+       are converted and transformed PARALLEL_CHUNK_BLOCKS at a time. If pool
+       is a multiprocessing.Pool, those chunks are sent to it, in which case
+       fxn must be picklable (a module-level function or a bound method)."""
+    width = self._width
+    if bound is not None:
+      width = max(width, self._base_from_modulo(bound) / 8)
+    if _counters is not None:
+      _counters["blocks"] += len(self._buffer) / self._width
+    tasks = ((fxn, self._width, data, width)
+             for data in self._Chunks(PARALLEL_CHUNK_BLOCKS))
+    results = (pool.imap(_map_chunk, tasks) if pool is not None
+               else itertools.imap(_map_chunk, tasks))
+    buf = bytearray(len(self._buffer) / self._width * width)
+    offset = 0
+    for data in results:
+      buf[offset:offset + len(data)] = data
+      offset += len(data)
+    return Message.FromBlocks(buf, self.modulo, self.overflow, width,
+                              self.packing)
 
   @staticmethod
   def _base_from_modulo(modulo):
-    return int(math.ceil(math.log(modulo, 2) / 8.)) * 8
+    """Bits needed to hold any number below modulo, rounded up to a byte."""
+    return ((modulo - 1).bit_length() + 7) / 8 * 8
+
+  @classmethod
+  def _bytes_per_item(klass, modulo):
+    return klass._base_from_modulo(modulo) / 8 - 1
+
+  @staticmethod
+  def _bits_per_item(modulo):
+    return modulo.bit_length() - 1
+
+  @staticmethod
+  def _bit_groups(bits):
+    """Returns (bytes, numbers): the smallest whole number of bytes that
+       splits into a whole number of bits-bit numbers."""
+    common = gcd(bits, 8)
+    return bits / common, 8 / common
+
+  @classmethod
+  def _full_overflow(klass, modulo, packing):
+    """The overflow of a message whose final block is full."""
+    if packing == PACKING_BITS:
+      return klass._bits_per_item(modulo)
+    return klass._bytes_per_item(modulo)
+
+  def __getstate__(self):
+    return {"modulo":self.modulo, "overflow":self.overflow,
+            "packing":self.packing, "width":self._width,
+            "blocks":str(self._buffer)}
+
+  def __setstate__(self, state):
+    if "numbers" in state:
+      # Pickled before messages were stored packed.
+      self.__init__(state["numbers"], state["modulo"], state["overflow"])
+    else:
+      self.__init__([], state["modulo"], state["overflow"],
+                    state.get("packing", PACKING_BYTES))
+      self._width = state["width"]
+      self._buffer = bytearray(state["blocks"])
 
   def __eq__(self, other):
-    return (self.numbers == other.numbers and self.overflow == other.overflow and
-            self.modulo == other.modulo)
+    if self._width == other._width:
+      same = self._buffer == other._buffer
+    else:
+      same = self.numbers == other.numbers
+    return (same and self.overflow == other.overflow and
+            self.modulo == other.modulo and self.packing == other.packing)
 
   def __ne__(self, other):
     return not (self == other)
 
+class ExponentContext(object):
+  """Everything needed to raise numbers to the fixed power y mod n that does
+     not depend on the base: the Montgomery constants (when n is odd), the
+     window width and the recoded exponent. Building one costs about as much
+     as a single exponentiation, so keys keep theirs between blocks."""
+  def __init__(self, n, y, window=WINDOW_AUTO):
+    assert n > 1 and y >= 0
+    self.n = n
+    self.y = y
+    self.montgomery = MontgomeryContext(n) if n % 2 else None
+    if window == WINDOW_AUTO:
+      window = _window_size(y.bit_length())
+    self.window = max(window, 1)
+    self.schedule = _sliding_window_schedule(y, self.window)
+
+  def power(self, x):
+    """Returns (x ** y) mod n."""
+    if _counters is not None:
+      _counters["modexp"] += 1
+    if self.montgomery is None:
+      mul = lambda a, b: modmul(a, b, self.n)
+      z = _exp_sliding_window(x % self.n, self.y, mul, 1, self.window,
+                              self.schedule)
+      return z % self.n
+    context = self.montgomery
+    z = _exp_sliding_window(context.to_montgomery(x), self.y, context.mul,
+                            context.one, self.window, self.schedule)
+    return context.from_montgomery(z)
+
+class _PowContext(object):
+  """ExponentContext work-alike for backends with a native modular power."""
+  def __init__(self, n, y, powmod):
+    self.n = n
+    self.y = y
+    self._powmod = powmod
+
+  def power(self, x):
+    if _counters is not None:
+      _counters["modexp"] += 1
+    return self._powmod(x, self.y, self.n)
+
+class PythonBackend(object):
+  """The arithmetic in this module: Karatsuba modmul, extended Euclid and
+     Montgomery sliding window exponentiation."""
+  name = "python"
+
+  def mulmod(self, x, y, n):
+    return modmul(x, y, n)
+
+  def powmod(self, x, y, n):
+    return self.context(n, y).power(x)
+
+  def invert(self, x, n):
+    return modinv(x, n)
+
+  def context(self, n, y):
+    return ExponentContext(n, y)
+
+class BuiltinBackend(PythonBackend):
+  """The interpreter's own long multiplication and three-argument pow. Python 2
+     pow cannot invert, so inversion stays on extended Euclid."""
+  name = "builtin"
+
+  def mulmod(self, x, y, n):
+    return (x * y) % n
+
+  def powmod(self, x, y, n):
+    return pow(x, y, n)
+
+  def context(self, n, y):
+    return _PowContext(n, y, pow)
+
+class Gmpy2Backend(PythonBackend):
+  """GMP through gmpy2. Results are converted back to Python integers so they
+     pickle and pack like any other."""
+  name = "gmpy2"
+
+  def mulmod(self, x, y, n):
+    return long(gmpy2.f_mod(gmpy2.mul(x, y), n))
+
+  def powmod(self, x, y, n):
+    return long(gmpy2.powmod(x, y, n))
+
+  def invert(self, x, n):
+    try:
+      return long(gmpy2.invert(x, n))
+    except ZeroDivisionError:
+      return None
+
+  def context(self, n, y):
+    return _PowContext(gmpy2.mpz(n), gmpy2.mpz(y), self.powmod)
+
+_backends = collections.OrderedDict()
+
+def register_backend(backend):
+  """Makes backend available to set_backend under backend.name."""
+  _backends[backend.name] = backend
+
+def available_backends():
+  """Names of the registered backends."""
+  return list(_backends)
+
+def get_backend():
+  """Returns the backend in use."""
+  return _backend
+
+def set_backend(name):
+  """Routes the module's key and primality arithmetic through the named
+     backend. Raises UnknownBackend if it is not registered."""
+  global _backend
+  if name not in _backends:
+    raise UnknownBackend("Unknown backend %s; choose from %s." % (
+        name, ", ".join(_backends)))
+  _backend = _backends[name]
+
+register_backend(PythonBackend())
+register_backend(BuiltinBackend())
+if gmpy2 is not None:
+  register_backend(Gmpy2Backend())
+_backend = _backends[DEFAULT_BACKEND]
+if os.environ.get(BACKEND_ENVIRONMENT):
+  try:
+    set_backend(os.environ[BACKEND_ENVIRONMENT])
+  except UnknownBackend, e:
+    print >> sys.stderr, "%s Using %s." % (e, DEFAULT_BACKEND)
+
+ContextCacheInfo = collections.namedtuple("ContextCacheInfo",
+                                          "hits misses maxsize currsize")
+
+_context_cache = collections.OrderedDict()
+_context_cache_stats = collections.Counter()
+
+def exponent_context(n, y):
+  """Returns the current backend's context for raising to the power y mod n,
+     reusing one of the last CONTEXT_CACHE_SIZE built if possible."""
+  key = (_backend.name, n, y)
+  context = _context_cache.pop(key, None)
+  if context is None:
+    _context_cache_stats["misses"] += 1
+    context = _backend.context(n, y)
+  else:
+    _context_cache_stats["hits"] += 1
+  _context_cache[key] = context
+  while len(_context_cache) > CONTEXT_CACHE_SIZE:
+    _context_cache.popitem(last=False)
+  return context
+
+def context_cache_info():
+  """Reports how exponent_context has fared since the last clear."""
+  return ContextCacheInfo(_context_cache_stats["hits"],
+                          _context_cache_stats["misses"], CONTEXT_CACHE_SIZE,
+                          len(_context_cache))
+
+def clear_context_cache():
+  """Empties the exponent_context cache and resets its statistics."""
+  _context_cache.clear()
+  _context_cache_stats.clear()
+
+def _key_context(key, n, y):
+  """Returns the exponent_context for n and y, remembered on the key so later
+     blocks skip even the cache lookup. Keys drop these when pickled."""
+  contexts = key.__dict__.setdefault("_contexts", {})
+  context = contexts.get((_backend.name, n, y))
+  if context is None:
+    context = contexts[(_backend.name, n, y)] = exponent_context(n, y)
+  return context
+
+def _key_getstate(key):
+  state = key.__dict__.copy()
+  state.pop("_contexts", None)
+  return state
+
 class RSAPrivateKey(object):
-  """Represents an RSA private key. Requires nbits > 2."""
-  def __init__(self, nbits=DEFAULT_RSA_KEY_LENGTH):
+  """Represents an RSA private key. Requires nbits > 2. With workers > 1, the
+     two primes are searched for in parallel by that many processes."""
+  def __init__(self, nbits=DEFAULT_RSA_KEY_LENGTH, workers=1):
     assert nbits > 2
-    p = get_prime(nbits)
-    q = p
-    # Must halt because nbits > 2, meaning at least 2 primes are available. Thus,
-    # the expected number of iterations is 2.
-    while q == p:
-      q = get_prime(nbits)
+    if workers > 1:
+      p, q = get_distinct_primes(nbits, 2, workers)
+    else:
+      p = get_prime(nbits)
+      q = p
+      # Must halt because nbits > 2, meaning at least 2 primes are available.
+      # Thus, the expected number of iterations is 2.
+      while q == p:
+        q = get_prime(nbits)
     
     # We need an encryption exponent that is relatively prime to
     # (p - 1) * (q - 1), which is true iff it has an inverse.
@@ -262,7 +1251,7 @@ class RSAPrivateKey(object):
     # The vast majority of primes - 1 are not multiples of 3, so this halts quick.
     while self.d is None and self.d != self.e:
       self.e += 1
-      self.d = modinv(self.e, secret_modulus)
+      self.d = _backend.invert(self.e, secret_modulus)
     
     self.N = p * q
     self.public = RSAPublicKey(self.N, self.e)
@@ -271,19 +1260,56 @@ class RSAPrivateKey(object):
     self.p = p
     self.q = q
     self.phi = secret_modulus
+    self._precompute_crt()
+
+  def _precompute_crt(self):
+    """Precomputes the Chinese Remainder Theorem exponents and coefficient, or
+       clears them if the primes are not known."""
+    if getattr(self, "p", None) is None or getattr(self, "q", None) is None:
+      self.dP = self.dQ = self.qInv = None
+      return
+    self.dP = self.d % (self.p - 1)
+    self.dQ = self.d % (self.q - 1)
+    self.qInv = _backend.invert(self.q, self.p)
+
+  def __getstate__(self):
+    return _key_getstate(self)
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    # Keys pickled before CRT support lack the precomputed values.
+    if "qInv" not in state:
+      self._precompute_crt()
 
   def GetPublicKey(self):
     """Returns the private key's corresponding public key."""
     return self.public
 
-  def Decrypt(self, message):
-    """Decrypts a Message."""
-    return message.Mapped(self.DecryptInteger)
+  def Fingerprint(self):
+    """Returns the fingerprint of the corresponding public key."""
+    return self.public.Fingerprint()
+
+  def Decrypt(self, message, pool=None):
+    """Decrypts a Message, optionally spread over a multiprocessing.Pool."""
+    return message.Mapped(self.DecryptInteger, pool, self.N)
 
   def DecryptInteger(self, number):
-    """Decrypts a single number."""
+    """Decrypts a single number. Exponentiates separately mod p and mod q with
+       the reduced exponents and recombines with Garner's formula, which is
+       several times cheaper than working mod N; falls back to
+       DecryptIntegerFull if the primes are not known."""
+    if self.qInv is None:
+      return self.DecryptIntegerFull(number)
     assert 0 <= number < self.N
-    return modexp(number, self.d, self.N)
+    m1 = _key_context(self, self.p, self.dP).power(number)
+    m2 = _key_context(self, self.q, self.dQ).power(number)
+    h = _backend.mulmod(self.qInv, (m1 - m2) % self.p, self.p)
+    return m2 + h * self.q
+
+  def DecryptIntegerFull(self, number):
+    """Decrypts a single number with the full exponent mod N."""
+    assert 0 <= number < self.N
+    return _key_context(self, self.N, self.d).power(number)
 
   def __eq__(self, other):
     return (self.N == other.N and self.e == other.e and self.d == other.d)
@@ -297,14 +1323,22 @@ class RSAPublicKey(object):
     self.N = N
     self.e = e
 
-  def Encrypt(self, message):
-    """Encrypts a message to the RSA key specified."""
-    return message.Mapped(self.EncryptInteger)
+  def Encrypt(self, message, pool=None):
+    """Encrypts a message to the RSA key specified, optionally spread over a
+       multiprocessing.Pool."""
+    return message.Mapped(self.EncryptInteger, pool, self.N)
 
   def EncryptInteger(self, number):
     """Encrypts a single number."""
     assert 0 <= number < self.N
-    return modexp(number, self.e, self.N)
+    return _key_context(self, self.N, self.e).power(number)
+
+  def Fingerprint(self):
+    """Returns a 20 byte digest identifying the key."""
+    return hashlib.sha1("%x:%x" % (self.N, self.e)).digest()
+
+  def __getstate__(self):
+    return _key_getstate(self)
 
   def __eq__(self, other):
     return (self.N == other.N and self.e == other.e)
@@ -312,6 +1346,264 @@ class RSAPublicKey(object):
   def __ne__(self, other):
     return not (self == other)
 
+def _keystream(session_key, offset, size):
+  """Returns size bytes of session_key's keystream starting at byte offset,
+     which must be a multiple of KEYSTREAM_BLOCK. Keystream block i is
+     SHA-512(session_key || i) with i a 64-bit big-endian counter, so any
+     block-aligned stretch can be made on its own."""
+  if offset % KEYSTREAM_BLOCK:
+    raise ValueError("Keystream offset must be a multiple of %d."
+                     % KEYSTREAM_BLOCK)
+  first = offset / KEYSTREAM_BLOCK
+  count = -(-size // KEYSTREAM_BLOCK)
+  # Chained imaps keep the per-block work out of the interpreter loop.
+  counters = itertools.imap(KEYSTREAM_COUNTER.pack,
+                            xrange(first, first + count))
+  hashes = itertools.imap(hashlib.sha512,
+                          itertools.imap(session_key.__add__, counters))
+  return "".join(itertools.imap(operator.methodcaller("digest"),
+                                hashes))[:size]
+
+def _xor_bytes(a, b):
+  """XORs two byte strings of the same length, eight bytes at a time as
+     native integers, then any remaining bytes one at a time."""
+  words = "=%dq" % (len(a) / 8)
+  head = struct.pack(words, *itertools.imap(operator.xor,
+                                            struct.unpack_from(words, a),
+                                            struct.unpack_from(words, b)))
+  return head + "".join(chr(ord(x) ^ ord(y))
+                        for x, y in zip(a[len(head):], b[len(head):]))
+
+def _keystream_chunk(args):
+  """Pool worker for _keystream_xor: transforms one chunk."""
+  session_key, offset, data = args
+  with span("keystream"):
+    return _xor_bytes(data, _keystream(session_key, offset, len(data)))
+
+def _keystream_xor(session_key, chunks, pool=None):
+  """Yields each chunk XORed with its stretch of session_key's keystream,
+     which both encrypts and decrypts. Every chunk but the last must be a
+     multiple of KEYSTREAM_BLOCK bytes. If pool is a multiprocessing.Pool the
+     chunks are transformed in it, KEYSTREAM_WINDOW at a time."""
+  def tasks():
+    offset = 0
+    for data in chunks:
+      yield session_key, offset, data
+      offset += len(data)
+  tasks = tasks()
+  if pool is None:
+    for data in itertools.imap(_keystream_chunk, tasks):
+      yield data
+    return
+  while True:
+    window = list(itertools.islice(tasks, KEYSTREAM_WINDOW))
+    if not window:
+      return
+    for data in pool.imap(_keystream_chunk, window):
+      yield data
+
+class CiphertextWriter(object):
+  """Writes the binary ciphertext container: a CONTAINER_HEADER followed by the
+     ciphertext blocks as fixed-width big-endian records, each as wide as the
+     key's modulus. When the overflow of the final block is not known up front
+     (streaming), it is written as one extra record at the end instead. The
+     header also records the packing the plaintext was encoded with.
+
+     A hybrid container holds only the encrypted session key in its blocks;
+     write the keystream-encrypted payload after them with write_payload."""
+  def __init__(self, fileio, key, overflow=None, packing=PACKING_BYTES,
+               hybrid=False):
+    self._fileio = fileio
+    self.width = Message._base_from_modulo(key.N) / 8
+    self.trailer = overflow is None
+    self.packing = packing
+    self.hybrid = hybrid
+    flags = CONTAINER_TRAILER if self.trailer else 0
+    if packing == PACKING_BITS:
+      flags |= CONTAINER_BIT_PACKED
+    if hybrid:
+      flags |= CONTAINER_HYBRID
+    fileio.write(CONTAINER_HEADER.pack(
+        CONTAINER_MAGIC, CONTAINER_VERSION, flags,
+        key.Fingerprint(), self.width, overflow or 0))
+
+  def write(self, message):
+    if message._width == self.width:
+      self._fileio.write(message.BlockBytes())
+    else:
+      self._fileio.write(_pack_blocks(message.numbers, self.width))
+
+  def write_payload(self, data):
+    """Writes keystream-encrypted payload following a hybrid container's
+       session key."""
+    assert self.hybrid and not self.trailer
+    self._fileio.write(data)
+
+  def finish(self, overflow):
+    """Records the overflow of the final block if it was not in the header."""
+    if self.trailer:
+      self._fileio.write(_pack_blocks([overflow], self.width))
+
+class CiphertextReader(object):
+  """Reads a container written by CiphertextWriter, either sequentially from
+     any file (including pipes) or one block at a time from a seekable one."""
+  def __init__(self, fileio, prefix=""):
+    """prefix holds any bytes of the header already read from fileio."""
+    self._fileio = fileio
+    header = prefix + fileio.read(CONTAINER_HEADER.size - len(prefix))
+    if len(header) != CONTAINER_HEADER.size:
+      raise MalformedCiphertext("Truncated ciphertext header.")
+    (magic, version, flags, self.fingerprint, self.width,
+     overflow) = CONTAINER_HEADER.unpack(header)
+    if (magic != CONTAINER_MAGIC or version != CONTAINER_VERSION or
+        flags & ~CONTAINER_FLAGS):
+      raise MalformedCiphertext("Unrecognized ciphertext format.")
+    self.trailer = bool(flags & CONTAINER_TRAILER)
+    self.packing = (PACKING_BITS if flags & CONTAINER_BIT_PACKED
+                    else PACKING_BYTES)
+    self.hybrid = bool(flags & CONTAINER_HYBRID)
+    if self.hybrid and (self.trailer or self.packing != PACKING_BYTES):
+      raise MalformedCiphertext("Unrecognized ciphertext format.")
+    # A block holds a zero byte and at least one byte of data.
+    if self.width < 2:
+      raise MalformedCiphertext("Bad ciphertext block width.")
+    # Not known until the trailer has been read.
+    self.overflow = None if self.trailer else overflow
+
+  def _records(self):
+    """Yields runs of whole block records, reading STREAM_CHUNK_BLOCKS at a
+       time. Sets overflow once the trailer, if any, has been read. The
+       records of a hybrid container are just its session key."""
+    width = self.width
+    if self.hybrid:
+      data = self._fileio.read(self._session_blocks() * width)
+      if len(data) != self._session_blocks() * width:
+        raise MalformedCiphertext("Truncated ciphertext.")
+      yield data
+      return
+    pending = ""
+    while True:
+      data = self._fileio.read(width * STREAM_CHUNK_BLOCKS)
+      if not data:
+        break
+      pending += data
+      complete = len(pending) - len(pending) % width
+      if self.trailer:
+        # The last whole record might be the trailer; hold it back until we
+        # know more data follows.
+        complete = max(complete - width, 0)
+      if complete:
+        yield pending[:complete]
+      pending = pending[complete:]
+
+    if self.trailer and len(pending) == width:
+      self.overflow = _unpack_blocks(pending, width)[0]
+    elif pending or self.trailer:
+      raise MalformedCiphertext("Truncated ciphertext.")
+
+  def blocks(self):
+    """Yields each ciphertext block in order."""
+    for data in self._records():
+      for number in _unpack_blocks(data, self.width):
+        yield number
+
+  def messages(self, modulo):
+    """Yields the ciphertext as Messages of about STREAM_CHUNK_BLOCKS blocks.
+       Every Message but the last has full blocks and decodes to whole bytes
+       on its own, which with PACKING_BITS takes a multiple of 8 blocks."""
+    self._check_width(modulo)
+    full = Message._full_overflow(modulo, self.packing)
+    align = self.width * (8 if self.packing == PACKING_BITS else 1)
+    pending = ""
+    count = 0
+    for data in self._records():
+      count += len(data) / self.width
+      # More data follows, so pending is not the end of the message.
+      if len(pending) >= align:
+        cut = len(pending) - len(pending) % align
+        yield Message.FromBlocks(pending[:cut], modulo, full, self.width,
+                                 self.packing)
+        pending = pending[cut:]
+      pending += data
+    self._check_overflow(modulo, count)
+    yield Message.FromBlocks(pending, modulo, self.overflow, self.width,
+                             self.packing)
+
+  def _check_width(self, modulo):
+    """Raises MalformedCiphertext unless the blocks are as wide as the
+       modulus, as CiphertextWriter writes them."""
+    if self.width != Message._base_from_modulo(modulo) / 8:
+      raise MalformedCiphertext("Bad ciphertext block width.")
+
+  def _check_overflow(self, modulo, count):
+    """Raises MalformedCiphertext unless overflow is one Message.Encode could
+       have given a message of count blocks."""
+    full = Message._full_overflow(modulo, self.packing)
+    valid = 1 <= self.overflow <= full
+    if count and self.packing == PACKING_BITS:
+      # The plaintext is a whole number of bytes.
+      valid = valid and ((count - 1) * full + self.overflow) % 8 == 0
+    if not valid:
+      raise MalformedCiphertext("Bad ciphertext overflow.")
+
+  def _session_blocks(self):
+    """Number of blocks holding a hybrid container's session key, encoded
+       with PACKING_BYTES in blocks of width - 1 bytes."""
+    return -(-SESSION_KEY_BYTES // (self.width - 1))
+
+  def session(self, modulo):
+    """Reads the Message holding a hybrid container's encrypted session key.
+       Call before payload."""
+    self._check_width(modulo)
+    if self.overflow != (SESSION_KEY_BYTES % (self.width - 1) or
+                         self.width - 1):
+      raise MalformedCiphertext("Bad ciphertext overflow.")
+    return Message.FromBlocks(next(self._records()), modulo, self.overflow,
+                              self.width)
+
+  def payload(self):
+    """Yields the keystream-encrypted payload of a hybrid container in chunks
+       of HYBRID_CHUNK_BYTES."""
+    return _read_chunks(self._fileio, HYBRID_CHUNK_BYTES)
+
+  def __len__(self):
+    """Number of ciphertext blocks, which for a hybrid container are only
+       those of the session key. Requires a seekable file."""
+    if self.hybrid:
+      return self._session_blocks()
+    self._fileio.seek(0, 2)
+    records = (self._fileio.tell() - CONTAINER_HEADER.size) / self.width
+    return records - 1 if self.trailer else records
+
+  def block(self, k):
+    """Reads block k. Requires a seekable file."""
+    if not 0 <= k < len(self):
+      raise IndexError(k)
+    self._fileio.seek(CONTAINER_HEADER.size + k * self.width)
+    return _unpack_blocks(self._fileio.read(self.width), self.width)[0]
+
+class _PrefixedFile(object):
+  """Puts bytes that were already read back in front of a file, so cPickle can
+     load from a stream whose first bytes were used to sniff the format."""
+  def __init__(self, prefix, fileio):
+    self._prefix = prefix
+    self._fileio = fileio
+
+  def read(self, size=-1):
+    prefix, self._prefix = self._prefix, ""
+    if size < 0:
+      return prefix + self._fileio.read()
+    if len(prefix) > size:
+      prefix, self._prefix = prefix[:size], prefix[size:]
+    return prefix + self._fileio.read(size - len(prefix))
+
+  def readline(self):
+    if "\n" in self._prefix:
+      line, self._prefix = self._prefix.split("\n", 1)
+      return line + "\n"
+    prefix, self._prefix = self._prefix, ""
+    return prefix + self._fileio.readline()
+
 def _load_key(fileio, cast=False):
   """Attempt to load a key from a file. Will convert private keys to public if
      cast is True."""
@@ -324,24 +1616,136 @@ def _load_key(fileio, cast=False):
 
   return key
 
-def encrypt(args):
-  """Encrypt command line option."""
-  key = _load_key(open(args[1], "rb"), True)
+def _read_chunks(infile, size=None):
+  """Yields successive chunks of up to size bytes from infile, or all of it at
+     once if size is None. Always yields at least one, possibly empty, chunk."""
+  chunk = infile.read() if size is None else infile.read(size)
+  yield chunk
+  while size is not None:
+    chunk = infile.read(size)
+    if not chunk:
+      return
+    yield chunk
+
+def _make_pool(opts):
+  """Returns a process pool for the --jobs option, or None for one job."""
+  jobs = getattr(opts, "jobs", 1)
+  return multiprocessing.Pool(jobs) if jobs > 1 else None
+
+def _encrypt_hybrid(key, chunks, outfile, pool=None):
+  """Writes a hybrid container for the plaintext chunks: a random session
+     key encrypted with key, then the chunks XORed with its keystream. Every
+     chunk but the last must be a multiple of KEYSTREAM_BLOCK bytes."""
+  session_key = os.urandom(SESSION_KEY_BYTES)
+  with span("encrypt"):
+    msg = key.Encrypt(Message.Encode(session_key, key.N))
+  writer = CiphertextWriter(outfile, key, msg.overflow, hybrid=True)
+  writer.write(msg)
+  for data in _keystream_xor(session_key, chunks, pool):
+    with span("write"):
+      writer.write_payload(data)
+
+def encrypt(args, opts=None):
+  """Encrypt command line option. Writes a binary ciphertext container; in
+     streaming mode the input is read, encrypted and written a chunk at a
+     time. In hybrid mode only a session key is encrypted with the key and the
+     input is always streamed through its keystream."""
+  with span("load key"):
+    key = _load_key(open(args[1], "rb"), True)
 
   infile = open(args[2], "rb") if args[2] != "-" else sys.stdin
   outfile = open(args[3], "wb") if args[3] != "-" else sys.stdout
 
-  msg = key.Encrypt(Message.Encode(infile.read(), key.N))
+  packing = PACKING_BITS if getattr(opts, "pack", False) else PACKING_BYTES
+  chunk_size = None
+  if getattr(opts, "stream", False):
+    if packing == PACKING_BITS:
+      group_bytes, per_group = Message._bit_groups(
+          Message._bits_per_item(key.N))
+      chunk_size = group_bytes * max(STREAM_CHUNK_BLOCKS / per_group, 1)
+    else:
+      chunk_size = Message._bytes_per_item(key.N) * STREAM_CHUNK_BLOCKS
+
+  pool = _make_pool(opts)
+  try:
+    if getattr(opts, "hybrid", False):
+      _encrypt_hybrid(key, _spanned("read", _read_chunks(infile,
+                                                         HYBRID_CHUNK_BYTES)),
+                      outfile, pool)
+    else:
+      writer = None
+      for data in _spanned("read", _read_chunks(infile, chunk_size)):
+        with span("encode"):
+          msg = Message.Encode(data, key.N, packing)
+        with span("encrypt"):
+          msg = key.Encrypt(msg, pool)
+        with span("write"):
+          if writer is None:
+            # Without streaming there is exactly one chunk, so its overflow is
+            # final.
+            writer = CiphertextWriter(outfile, key,
+                                      None if chunk_size else msg.overflow,
+                                      packing)
+          writer.write(msg)
+      with span("write"):
+        writer.finish(msg.overflow)
+  finally:
+    if pool is not None:
+      pool.terminate()
 
-  cPickle.dump((key, msg), outfile, -1)
   if infile is not sys.stdin:
     infile.close()
   if outfile is not sys.stdout:
     outfile.close()
 
-def decrypt(args):
-  """Decrypt command line option"""
-  key = _load_key(open(args[1], "rb"))
+def _load_ciphertext(infile, key, pickled=True):
+  """Opens a ciphertext for key. Returns (session, chunks): for a hybrid
+     container, the Message holding the encrypted session key and an iterator
+     over the payload; otherwise None and an iterator over its Messages. Both
+     are None if it was encrypted to a different key. Accepts the binary
+     container and, unless pickled is False, the older pickled (key, message)
+     format."""
+  magic = infile.read(len(CONTAINER_MAGIC))
+  if magic == CONTAINER_MAGIC:
+    reader = CiphertextReader(infile, magic)
+    if reader.fingerprint != key.Fingerprint():
+      return None, None
+    if reader.hybrid:
+      return reader.session(key.N), reader.payload()
+    return None, reader.messages(key.N)
+  if not pickled:
+    raise MalformedCiphertext("Unrecognized ciphertext format.")
+
+  infile = _PrefixedFile(magic, infile)
+  enc_key, msg = cPickle.load(infile)
+  if enc_key != key:
+    return None, None
+  return None, iter([msg])
+
+def _decrypt_chunks(key, session, chunks, pool=None):
+  """Yields the plaintext of a ciphertext opened by _load_ciphertext a chunk
+     at a time."""
+  if session is not None:
+    with span("decrypt"):
+      session_key = key.Decrypt(session).Decode()
+    if len(session_key) != SESSION_KEY_BYTES:
+      raise MalformedCiphertext("Bad session key.")
+    for data in _keystream_xor(session_key, _spanned("read", chunks), pool):
+      yield data
+    return
+
+  for msg in _spanned("read", chunks):
+    with span("decrypt"):
+      msg = key.Decrypt(msg, pool)
+    with span("decode"):
+      data = msg.Decode()
+    yield data
+
+def decrypt(args, opts=None):
+  """Decrypt command line option. Chunks are decrypted and written one at a
+     time, so large files are decrypted in constant memory."""
+  with span("load key"):
+    key = _load_key(open(args[1], "rb"))
   if not hasattr(key, "Decrypt"):
     print >> sys.stderr, ("This key is not capable of decryption."
                           " You must provide a private key.")
@@ -350,33 +1754,50 @@ def decrypt(args):
   infile = open(args[2], "rb") if args[2] != "-" else sys.stdin
   outfile = open(args[3], "wb") if args[3] != "-" else sys.stdout
 
-  enc_key, msg = cPickle.load(infile)
-  if enc_key != key:
+  with span("read"):
+    session, chunks = _load_ciphertext(infile, key)
+  if chunks is None:
     print >> sys.stderr, ("This key does not match the key this message was "
                           "encrypted to.")
     return
 
-  outfile.write(key.Decrypt(msg).Decode())
+  pool = _make_pool(opts)
+  try:
+    for data in _decrypt_chunks(key, session, chunks, pool):
+      with span("write"):
+        outfile.write(data)
+  finally:
+    if pool is not None:
+      pool.terminate()
   if infile is not sys.stdin:
     infile.close()
   if outfile is not sys.stdout:
     outfile.close()
 
-def keygen(args):
+def calibrate_command(args, opts=None):
+  """Calibrate command line option"""
+  profile = calibrate(args[1] if len(args) > 1 else None)
+  for tier in ("karatsuba", "toom3"):
+    bits = profile[tier + "_bits"]
+    print "%-10s %s" % (tier, "never" if bits is None else "%d bits" % bits)
+
+def keygen(args, opts=None):
   """Keygen command line option"""
   nbits = int(args[1])
   if nbits < 8:
     print >> sys.stderr, "Private key must be at least 8 bits long!"
     return
-  key = RSAPrivateKey(nbits)
-  if args[2] == "-":
-    cPickle.dump(key, sys.stdout, -1)
-  else:
-    cPickle.dump(key, open(args[2], "wb"), -1)
-    cPickle.dump(key.GetPublicKey(),
-                 open(args[2] + ".pub", "wb"), -1)
+  with span("generate"):
+    key = RSAPrivateKey(nbits, getattr(opts, "workers", 1))
+  with span("write"):
+    if args[2] == "-":
+      cPickle.dump(key, sys.stdout, -1)
+    else:
+      cPickle.dump(key, open(args[2], "wb"), -1)
+      cPickle.dump(key.GetPublicKey(),
+                   open(args[2] + ".pub", "wb"), -1)
 
-def publicextract(args):
+def publicextract(args, opts=None):
   """Public key extract command line option"""
   infile = open(args[1], "rb") if args[1] != "-" else sys.stdin
   outfile = open(args[2], "wb") if args[2] != "-" else sys.stdout
@@ -387,23 +1808,400 @@ def publicextract(args):
     return
   cPickle.dump(key.GetPublicKey(), outfile, -1)
 
-MODES = {"encrypt":encrypt,
+def _encrypt_data(key, data):
+  """Encrypts data to key as a complete ciphertext container."""
+  outfile = cStringIO.StringIO()
+  msg = key.Encrypt(Message.Encode(data, key.N))
+  writer = CiphertextWriter(outfile, key, msg.overflow)
+  writer.write(msg)
+  writer.finish(msg.overflow)
+  return outfile.getvalue()
+
+def _decrypt_data(key, data):
+  """Decrypts a ciphertext held in memory, which must be a binary container:
+     it may come from a client of serve, and unpickling it would run whatever
+     it asks to."""
+  session, chunks = _load_ciphertext(cStringIO.StringIO(data), key,
+                                     pickled=False)
+  if chunks is None:
+    raise ServeError("This key does not match the key this message was "
+                     "encrypted to.")
+  return "".join(_decrypt_chunks(key, session, chunks))
+
+# Keys by name in serve's worker processes; see _serve_init.
+_serve_keys = {}
+
+def _serve_init(keys, worker_process=False):
+  global _serve_keys
+  _serve_keys = keys
+  if worker_process:
+    # Interrupts are for the server to handle; it stops the pool itself.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _serve_work(request):
+  """Pool worker for RSAServer: carries out one request."""
+  operation, name, payload = request
+  key = _serve_keys[name]
+  if operation == "encrypt":
+    if not hasattr(key, "Encrypt"):
+      key = key.GetPublicKey()
+    return _encrypt_data(key, payload)
+  if operation == "decrypt":
+    if not hasattr(key, "Decrypt"):
+      raise ServeError("This key is not capable of decryption.")
+    return _decrypt_data(key, payload)
+  if not hasattr(key, "GetPublicKey"):
+    raise ServeError("This key is not capable of providing a public key.")
+  return cPickle.dumps(key.GetPublicKey(), -1)
+
+class _FailedRequest(object):
+  """Stands in for the AsyncResult of a request rejected before it reached
+     the pool."""
+  def __init__(self, message):
+    self.message = message
+
+  def get(self):
+    raise ServeError(self.message)
+
+def _read_exactly(fileio, size):
+  data = fileio.read(size)
+  if len(data) != size:
+    raise EOFError()
+  return data
+
+class _ServeHandler(SocketServer.StreamRequestHandler):
+  """Reads pipelined requests from one connection and hands them to the pool,
+     while a second thread writes the responses back in order."""
+  def handle(self):
+    pending = Queue.Queue()
+    slots = threading.BoundedSemaphore(SERVE_MAX_PENDING)
+    gone = threading.Event()
+    writer = threading.Thread(target=self._write_responses,
+                              args=(pending, slots, gone))
+    writer.daemon = True
+    writer.start()
+    try:
+      while True:
+        try:
+          header = _read_exactly(self.rfile, SERVE_REQUEST.size)
+        except EOFError:
+          break
+        operation, name_length, length = SERVE_REQUEST.unpack(header)
+        if length > SERVE_MAX_PAYLOAD:
+          # The stream cannot be resynchronized without reading the payload.
+          slots.acquire()
+          pending.put(_FailedRequest("Request too large."))
+          break
+        try:
+          name = _read_exactly(self.rfile, name_length)
+          payload = _read_exactly(self.rfile, length)
+        except EOFError:
+          break
+        # Blocks, and so stops reading from the socket, while
+        # SERVE_MAX_PENDING requests from this connection are unanswered.
+        slots.acquire()
+        if gone.is_set():
+          # No one is left to read the answer.
+          break
+        pending.put(self.server.submit(operation, name, payload))
+    finally:
+      pending.put(None)
+      writer.join()
+
+  def _write_responses(self, pending, slots, gone):
+    while True:
+      result = pending.get()
+      if result is None:
+        return
+      try:
+        try:
+          status, payload = SERVE_OK, result.get()
+        except Exception, e:
+          status, payload = SERVE_ERROR, str(e) or type(e).__name__
+        self.wfile.write(SERVE_RESPONSE.pack(status, len(payload)) + payload)
+      except socket.error:
+        # The client went away; keep draining so the slots are released.
+        gone.set()
+      finally:
+        slots.release()
+
+class RSAServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """Serves encrypt, decrypt and publicextract requests for keys loaded once
+     at startup. keys maps file names to keys; requests may name a key by the
+     absolute path of that file or by its fingerprint in hex. The work is done
+     by a pool of jobs processes, or a thread if jobs is 1."""
+  daemon_threads = True
+
+  def __init__(self, path, keys, jobs=1):
+    self.pool = None
+    self._bound = False
+    self.keys = {}
+    for filename, key in keys.iteritems():
+      self.keys[os.path.abspath(filename)] = key
+      # A private key and its public key share a fingerprint; prefer the one
+      # that can decrypt.
+      fingerprint = binascii.hexlify(key.Fingerprint())
+      if hasattr(key, "Decrypt") or fingerprint not in self.keys:
+        self.keys[fingerprint] = key
+    self._remove_stale(path)
+    SocketServer.UnixStreamServer.__init__(self, path, _ServeHandler)
+    try:
+      if jobs > 1:
+        self.pool = multiprocessing.Pool(jobs, _serve_init, (self.keys, True))
+      else:
+        self.pool = multiprocessing.pool.ThreadPool(1, _serve_init,
+                                                    (self.keys,))
+    except:
+      self.server_close()
+      raise
+
+  @staticmethod
+  def _remove_stale(path):
+    """Removes a socket left at path by a server that is no longer running.
+       Raises ServeError if path is something else or a server answers."""
+    try:
+      mode = os.lstat(path).st_mode
+    except OSError:
+      return
+    if not stat.S_ISSOCK(mode):
+      raise ServeError("%s exists and is not a socket." % path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(path)
+    except socket.error:
+      os.unlink(path)
+    else:
+      raise ServeError("A server is already listening on %s." % path)
+    finally:
+      probe.close()
+
+  def server_bind(self):
+    # Bind with a umask that leaves the socket to its owner alone, rather than
+    # chmod afterwards and leave a window open.
+    umask = os.umask(0777 & ~SOCKET_MODE)
+    try:
+      SocketServer.UnixStreamServer.server_bind(self)
+    finally:
+      os.umask(umask)
+    self._bound = True
+
+  def submit(self, operation, name, payload):
+    """Starts a request, returning an object whose get() returns the result
+       or raises."""
+    if operation >= len(SERVE_OPERATIONS):
+      return _FailedRequest("Unknown operation %d." % operation)
+    if name not in self.keys:
+      return _FailedRequest("Unknown key %s." % name)
+    return self.pool.apply_async(_serve_work,
+                                 ((SERVE_OPERATIONS[operation], name, payload),))
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    if self.pool is not None:
+      self.pool.terminate()
+    # Only remove the socket if it is ours.
+    if self._bound and os.path.exists(self.server_address):
+      os.unlink(self.server_address)
+
+class RSAClient(object):
+  """Talks to an RSAServer over its Unix socket."""
+  def __init__(self, path):
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._socket.connect(path)
+    self._rfile = self._socket.makefile("rb")
+
+  def Request(self, operation, key, payload=""):
+    """Returns the result of one request, raising ServeError if the server
+       could not carry it out. key is a key file name or fingerprint."""
+    return next(self.Pipelined([(operation, key, payload)]))
+
+  def Pipelined(self, requests, window=SERVE_CLIENT_WINDOW):
+    """Sends (operation, key, payload) requests, keeping up to window of them
+       ahead of the responses, and yields the results in order. Raises
+       ServeError at the first request that failed, after reading the
+       responses to any requests still in flight so the connection stays
+       usable; the same happens if the caller stops iterating early."""
+    sent = collections.deque()
+    requests = iter(requests)
+    try:
+      while True:
+        while len(sent) < window:
+          request = next(requests, None)
+          if request is None:
+            break
+          self._send(*request)
+          sent.append(request)
+        if not sent:
+          return
+        sent.popleft()
+        yield self._receive()
+    finally:
+      self._discard(len(sent))
+
+  def _discard(self, count):
+    """Reads and drops count responses."""
+    for _ in xrange(count):
+      try:
+        self._receive()
+      except ServeError:
+        pass
+
+  def _send(self, operation, key, payload):
+    if os.path.exists(key):
+      key = os.path.abspath(key)
+    self._socket.sendall(SERVE_REQUEST.pack(SERVE_OPERATIONS.index(operation),
+                                            len(key), len(payload)) +
+                         key + payload)
+
+  def _receive(self):
+    try:
+      status, length = SERVE_RESPONSE.unpack(
+          _read_exactly(self._rfile, SERVE_RESPONSE.size))
+      payload = _read_exactly(self._rfile, length)
+    except EOFError:
+      raise ServeError("The server closed the connection.")
+    if status != SERVE_OK:
+      raise ServeError(payload)
+    return payload
+
+  def close(self):
+    self._rfile.close()
+    self._socket.close()
+
+def _socket_path(opts):
+  return (getattr(opts, "socket", None) or os.environ.get(SOCKET_ENVIRONMENT)
+          or DEFAULT_SOCKET)
+
+def serve(args, opts=None):
+  """Serve command line option: serve keyfile [keyfile ...]"""
+  keys = {}
+  for filename in args[1:]:
+    with open(filename, "rb") as fileio:
+      keys[filename] = _load_key(fileio)
+  if not keys:
+    print >> sys.stderr, "Give at least one key file to serve."
+    return
+  try:
+    server = RSAServer(_socket_path(opts), keys, getattr(opts, "jobs", 1))
+  except ServeError, e:
+    print >> sys.stderr, e
+    return
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+def client(args, opts=None):
+  """Client command line option: takes the arguments of the encrypt, decrypt
+     or publicextract command and has a running server carry it out."""
+  if len(args) < 2 or args[1] not in SERVE_OPERATIONS:
+    print >> sys.stderr, "The client runs one of %s." % ", ".join(
+        SERVE_OPERATIONS)
+    return
+  if len(args) < (4 if args[1] == "publicextract" else 5):
+    if args[1] == "publicextract":
+      usage = "publicextract in_privatekeyfile out_publickeyfile"
+    else:
+      usage = "%s key infile outfile" % args[1]
+    print >> sys.stderr, "Usage: %s client %s" % (sys.argv[0], usage)
+    return
+  operation, key = args[1], args[2]
+  if operation == "publicextract":
+    payload, output = "", args[3]
+  else:
+    infile = open(args[3], "rb") if args[3] != "-" else sys.stdin
+    payload, output = infile.read(), args[4]
+    if infile is not sys.stdin:
+      infile.close()
+
+  connection = RSAClient(_socket_path(opts))
+  try:
+    result = connection.Request(operation, key, payload)
+  except ServeError, e:
+    print >> sys.stderr, e
+    return
+  finally:
+    connection.close()
+  outfile = open(output, "wb") if output != "-" else sys.stdout
+  outfile.write(result)
+  if outfile is not sys.stdout:
+    outfile.close()
+
+MODES = {"calibrate":calibrate_command,
+         "client":client,
+         "encrypt":encrypt,
          "decrypt":decrypt,
          "keygen":keygen,
-         "publicextract":publicextract}
+         "publicextract":publicextract,
+         "serve":serve}
+
+def _profile_mode(mode, args, opts):
+  """Runs a command under cProfile for the --profile option."""
+  profiler = cProfile.Profile()
+  try:
+    profiler.runcall(mode, args, opts)
+  finally:
+    if opts.profile == "-":
+      pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+          "cumulative").print_stats(25)
+    else:
+      profiler.dump_stats(opts.profile)
 
 def main():
   parser = optparse.OptionParser()
+  parser.add_option("-w", "--workers", type="int", default=1,
+                    help="processes to search for primes with in keygen")
+  parser.add_option("-j", "--jobs", type="int", default=1,
+                    help="processes to encrypt or decrypt blocks with")
+  parser.add_option("-s", "--stream", action="store_true", default=False,
+                    help="encrypt the input a chunk at a time, in constant "
+                         "memory")
+  parser.add_option("-p", "--pack", action="store_true", default=False,
+                    help="encrypt floor(log2(N)) bits of plaintext per block "
+                         "instead of whole bytes, for fewer, denser blocks")
+  parser.add_option("-H", "--hybrid", action="store_true", default=False,
+                    help="encrypt only a random session key with the key and "
+                         "the input with a keystream made from it, for bulk "
+                         "data")
+  parser.add_option("-b", "--backend", choices=available_backends(),
+                    help="arithmetic backend: %s (default from $%s, else %s)"
+                         % (", ".join(available_backends()),
+                            BACKEND_ENVIRONMENT, DEFAULT_BACKEND))
+  parser.add_option("--socket", metavar="PATH",
+                    help="Unix socket for serve and client (default from $%s, "
+                         "else %s)" % (SOCKET_ENVIRONMENT, DEFAULT_SOCKET))
+  parser.add_option("--stats", action="store_true", default=False,
+                    help="print operation counts and time per phase to stderr")
+  parser.add_option("--profile", metavar="FILE",
+                    help="run the command under cProfile and save the "
+                         "statistics to FILE, or print them to stderr for -")
   opts, args = parser.parse_args()
+  if opts.backend:
+    set_backend(opts.backend)
+  load_profile()
 
   # Dispatch the command.
   if len(args) >= 1 and args[0] in MODES:
-    MODES[args[0]](args)
+    if opts.stats:
+      enable_stats()
+    if opts.profile:
+      _profile_mode(MODES[args[0]], args, opts)
+    else:
+      MODES[args[0]](args, opts)
+    if opts.stats:
+      print >> sys.stderr, format_stats()
   else:
     print >> sys.stderr, \
              "Usage: %s [encrypt|decrypt] key infile outfile" % sys.argv[0] + \
              "\n       %s keygen nbits outfile" % sys.argv[0] + \
              "\n       %s publicextract in_privatekeyfile out_publickeyfile" \
+               % sys.argv[0] + \
+             "\n       %s calibrate [profile]" % sys.argv[0] + \
+             "\n       %s serve keyfile [keyfile ...]" % sys.argv[0] + \
+             "\n       %s client [encrypt|decrypt|publicextract] ..." \
                % sys.argv[0]
     return
 
@@ -1,12 +1,44 @@
+import binascii
+import collections
 import contextlib
 import cPickle
 import mock
+import multiprocessing
+import optparse
+import os
 import random
+import shutil
+import socket
+import stat
 import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 
 import rsa
 
+class _BackendSuite(unittest.TestSuite):
+  """Runs its tests with rsa switched to the named arithmetic backend."""
+  def __init__(self, name, tests):
+    super(_BackendSuite, self).__init__(tests)
+    self.name = name
+
+  def run(self, result):
+    previous = rsa.get_backend().name
+    rsa.set_backend(self.name)
+    try:
+      return super(_BackendSuite, self).run(result)
+    finally:
+      rsa.set_backend(previous)
+
+def load_tests(loader, tests, pattern):
+  """Runs the whole suite once per available backend."""
+  return unittest.TestSuite(
+      _BackendSuite(name, loader.loadTestsFromModule(sys.modules[__name__], False))
+      for name in rsa.available_backends())
+
 class test__extended_euclidean(unittest.TestCase):
   def test_coprime(self):
     for a, b in [(25, 11), (9, 13), (8, 15)]:
@@ -25,6 +57,21 @@ class test__extended_euclidean(unittest.TestCase):
       y2, x2, gcd2 = rsa._extended_euclidean(b, a)
       self.assertTupleEqual((x1, y1, gcd1), (x2, y2, gcd2))
 
+  def test_zero(self):
+    self.assertTupleEqual(rsa._extended_euclidean(7, 0), (1, 0, 7))
+    self.assertTupleEqual(rsa._extended_euclidean(0, 7), (0, 1, 7))
+
+  def test_large(self):
+    """Deep inputs used to overflow the recursion limit."""
+    R = random.Random(34)
+    for i in range(5):
+      a = R.getrandbits(8192)
+      b = R.getrandbits(8192)
+      x, y, gcd = rsa._extended_euclidean(a, b)
+      self.assertEquals(a * x + b * y, gcd)
+      self.assertEquals(a % gcd, 0)
+      self.assertEquals(b % gcd, 0)
+
 class test_gcd(unittest.TestCase):
   """Mostly tested in tests for extended euclidean."""
   def test_trivial(self):
@@ -75,6 +122,108 @@ class test_modmul(unittest.TestCase):
   def tearDown(self):
     rsa.NATIVE_MATH_MAX = self.native_val
 
+class test_multiply(unittest.TestCase):
+  def setUp(self):
+    self.thresholds = rsa.NATIVE_MATH_MAX, rsa.TOOM3_MATH_MIN
+
+  def tearDown(self):
+    rsa.NATIVE_MATH_MAX, rsa.TOOM3_MATH_MIN = self.thresholds
+
+  def check_stress(self):
+    R = random.Random(34)
+    for i in range(20):
+      x = R.getrandbits(R.randint(1, 1000))
+      y = R.getrandbits(R.randint(1, 1000))
+      self.assertEquals(rsa.multiply(x, y), x * y)
+      self.assertEquals(rsa.multiply(-x, y), -x * y)
+      self.assertEquals(rsa.multiply(-x, -y), x * y)
+      n = R.randint(1, 2 ** 1000)
+      self.assertEquals(rsa.modmul(x, y, n), (x * y) % n)
+
+  def test_tiers(self):
+    for native, toom3 in ((1 << 8, 1 << 16), (1 << 8, None), (None, 1 << 16),
+                          (1 << 64, 1 << 256), (None, None)):
+      rsa.NATIVE_MATH_MAX, rsa.TOOM3_MATH_MIN = native, toom3
+      self.check_stress()
+
+  def test_toom3_edge(self):
+    for x, y in ((1 << 16, 1 << 16), ((1 << 300) - 1, (1 << 300) - 1),
+                 ((1 << 300) - 1, 1), ((1 << 300), 0)):
+      self.assertEquals(rsa._multiply_toom3(x, y), x * y)
+      self.assertEquals(rsa._multiply_karatsuba(x, y), x * y)
+
+class test_profile(unittest.TestCase):
+  def setUp(self):
+    self.thresholds = rsa.NATIVE_MATH_MAX, rsa.TOOM3_MATH_MIN
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, "profile.json")
+
+  def tearDown(self):
+    rsa.NATIVE_MATH_MAX, rsa.TOOM3_MATH_MIN = self.thresholds
+    shutil.rmtree(self.tempdir)
+
+  def write(self, text):
+    with open(self.path, "w") as fileio:
+      fileio.write(text)
+
+  def test_load(self):
+    self.write('{"version": 1, "karatsuba_bits": 256, "toom3_bits": null}')
+    self.assertEquals(rsa.load_profile(self.path),
+                      {"version":1, "karatsuba_bits":256, "toom3_bits":None})
+    self.assertEquals(rsa.NATIVE_MATH_MAX, 1 << 256)
+    self.assertIsNone(rsa.TOOM3_MATH_MIN)
+
+  def test_load_unusable(self):
+    expected = rsa.NATIVE_MATH_MAX, rsa.TOOM3_MATH_MIN
+    self.assertIsNone(rsa.load_profile(self.path))
+    for text in ("", "[]", '{"version": 1}', '{"version": 0}',
+                 '{"version": 1, "karatsuba_bits": "x", "toom3_bits": null}'):
+      self.write(text)
+      self.assertIsNone(rsa.load_profile(self.path))
+      self.assertEquals((rsa.NATIVE_MATH_MAX, rsa.TOOM3_MATH_MIN), expected)
+
+  def test_environment(self):
+    self.write('{"version": 1, "karatsuba_bits": 1, "toom3_bits": 1}')
+    with mock.patch.dict(os.environ, {rsa.PROFILE_ENVIRONMENT:self.path}):
+      self.assertIsNotNone(rsa.load_profile())
+    # Thresholds are clamped to what the tiers need to terminate.
+    self.assertEquals(rsa.NATIVE_MATH_MAX, 4)
+    self.assertEquals(rsa.TOOM3_MATH_MIN, 1 << 16)
+
+  def test_not_on_import(self):
+    # Importing the module leaves the defaults alone; only the command line
+    # reads the profile.
+    self.write('{"version": 1, "karatsuba_bits": 256, "toom3_bits": 512}')
+    env = dict(os.environ)
+    env[rsa.PROFILE_ENVIRONMENT] = self.path
+    out = subprocess.check_output(
+        [sys.executable, "-c",
+         "import rsa; print rsa.NATIVE_MATH_MAX, rsa.TOOM3_MATH_MIN"],
+        cwd=os.path.dirname(os.path.abspath(rsa.__file__)), env=env)
+    self.assertEquals(out.split(), [str(1 << 64), "None"])
+    with mock.patch.dict(os.environ, {rsa.PROFILE_ENVIRONMENT:self.path}):
+      with mock.patch("sys.argv", ["rsa.py"]):
+        with mock.patch("sys.stderr", StringIO.StringIO()):
+          rsa.main()
+    self.assertEquals(rsa.NATIVE_MATH_MAX, 1 << 256)
+    self.assertEquals(rsa.TOOM3_MATH_MIN, 1 << 512)
+
+  def test_calibrate(self):
+    with mock.patch("rsa.CALIBRATION_BITS", (64, 128)):
+      profile = rsa.calibrate(self.path, repeat=1)
+    self.assertEquals(rsa.load_profile(self.path), profile)
+    self.assertEquals(sorted(profile), ["karatsuba_bits", "toom3_bits",
+                                        "version"])
+
+  def test_crossover(self):
+    R = random.Random(34)
+    with mock.patch("rsa._time_multiplication") as timer:
+      # Upper tier wins at 128 bits by chance, then from 512 bits on.
+      timer.side_effect = [2, 1, 1, 2, 2, 1, 1, 2, 1, 2] + [1, 2] * 10
+      self.assertEquals(rsa._crossover(None, None, R, 1), 512)
+      timer.side_effect = [2, 1] * 20
+      self.assertIsNone(rsa._crossover(None, None, R, 1))
+
 class test_rsa_modinv(unittest.TestCase):
   def test_simple(self):
     self.assertEquals(rsa.modinv(3, 4), 3)
@@ -93,6 +242,34 @@ class test_rsa_modinv(unittest.TestCase):
         if inv is not None:
           self.assertEquals(rsa.modmul(inv, j, i), 1)
 
+class test_rsa_batch_modinv(unittest.TestCase):
+  def test_simple(self):
+    self.assertEquals(rsa.batch_modinv([], 7), [])
+    self.assertEquals(rsa.batch_modinv([3], 4), [3])
+    self.assertEquals(rsa.batch_modinv(range(1, 7), 7),
+                      [rsa.modinv(i, 7) for i in range(1, 7)])
+
+  def test_not_invertible(self):
+    self.assertEquals(rsa.batch_modinv([3, 5, 7, 0, 4], 12),
+                      [None, 5, 7, None, None])
+
+  def test_stress(self):
+    R = random.Random(34)
+    n = R.getrandbits(512) | 1
+    values = [R.randint(1, n - 1) for _ in range(50)]
+    for value, inverse in zip(values, rsa.batch_modinv(values, n)):
+      self.assertEquals(inverse, rsa.modinv(value, n))
+
+  def test_multiplication_count(self):
+    calls = []
+    real_modmul = rsa.modmul
+    def counting_modmul(*args):
+      calls.append(args)
+      return real_modmul(*args)
+    with mock.patch("rsa.modmul", side_effect=counting_modmul):
+      rsa.batch_modinv(range(1, 11), 101)
+    self.assertEquals(len(calls), 3 * 9)
+
 class test_rsa_modexp(unittest.TestCase):
   def test_edge_nomod(self):
     self.assertEquals(rsa.modexp(0, 0, 100), 1)
@@ -133,6 +310,235 @@ class test_rsa_modexp(unittest.TestCase):
       n = R.randint(1, 100)
       self.assertEquals(rsa.modexp(x, y, n), (x ** y) % n)
 
+class test_rsa_modexp_window(unittest.TestCase):
+  def test_stress(self):
+    R = random.Random(34)
+    for i in range(10):
+      n = R.randint(1, 2 ** 160) * 2 + 1
+      x = R.randint(0, n - 1)
+      y = R.randint(0, 2 ** 160)
+      for window in (rsa.WINDOW_AUTO, 1, 2, 3, 4, 5, 6):
+        for sliding in (True, False):
+          for ctx in (None, rsa.MontgomeryContext(n)):
+            self.assertEquals(rsa.modexp(x, y, n, ctx, window, sliding),
+                              pow(x, y, n))
+
+  def test_edge(self):
+    for window in (2, 5):
+      for sliding in (True, False):
+        self.assertEquals(rsa.modexp(5, 0, 100, window=window,
+                                     sliding=sliding), 1)
+        self.assertEquals(rsa.modexp(0, 0, 1, window=window,
+                                     sliding=sliding), 0)
+        self.assertEquals(rsa.modexp(0, 7, 100, window=window,
+                                     sliding=sliding), 0)
+        for y in range(70):
+          self.assertEquals(rsa.modexp(3, y, 1000003, window=window,
+                                       sliding=sliding), pow(3, y, 1000003))
+
+  def test_fewer_multiplications(self):
+    R = random.Random(34)
+    y = R.getrandbits(1024) | (1 << 1023)
+    counts = {}
+    def counting_mul(a, b):
+      counts[key] += 1
+      return (a * b) % 1000003
+    for key, k in (("binary", 1), ("sliding", rsa._window_size(1024))):
+      counts[key] = 0
+      if k == 1:
+        rsa._exp_binary(3, y, counting_mul, 1)
+      else:
+        rsa._exp_sliding_window(3, y, counting_mul, 1, k)
+    self.assertLess(counts["sliding"], 0.8 * counts["binary"])
+
+class test_MontgomeryContext(unittest.TestCase):
+  def test_constants(self):
+    for n in (3, 5, 15, 97, 561, 65537, 2 ** 127 - 1):
+      ctx = rsa.MontgomeryContext(n)
+      self.assertEquals((ctx.R * ctx.R_inv) % n, 1)
+      self.assertEquals((n * ctx.n_prime) % ctx.R, ctx.R - 1)
+      for x in (0, 1, 2, n - 1):
+        self.assertEquals(ctx.from_montgomery(ctx.to_montgomery(x)), x)
+
+  def test_modmul(self):
+    R = random.Random(34)
+    for i in range(50):
+      n = R.randint(1, 2 ** 200) * 2 + 1
+      ctx = rsa.MontgomeryContext(n)
+      x = R.randint(0, n - 1)
+      y = R.randint(0, n - 1)
+      self.assertEquals(rsa.modmul(x, y, n, context=ctx), (x * y) % n)
+
+  def test_modexp(self):
+    R = random.Random(34)
+    for i in range(50):
+      n = R.randint(1, 2 ** 200) * 2 + 1
+      ctx = rsa.MontgomeryContext(n)
+      x = R.randint(0, n - 1)
+      y = R.randint(0, 2 ** 200)
+      self.assertEquals(rsa.modexp(x, y, n, ctx), pow(x, y, n))
+    self.assertEquals(rsa.modexp(5, 0, 7, rsa.MontgomeryContext(7)), 1)
+    self.assertEquals(rsa.modexp(0, 3, 7, rsa.MontgomeryContext(7)), 0)
+
+class test_ExponentContext(unittest.TestCase):
+  def test_power(self):
+    R = random.Random(34)
+    for i in range(50):
+      n = R.randint(2, 2 ** 200)
+      y = R.randint(0, 2 ** R.randint(0, 200))
+      ctx = rsa.ExponentContext(n, y)
+      for x in (0, 1, n - 1, R.randint(0, n - 1), R.randint(n, 2 * n)):
+        self.assertEquals(ctx.power(x), pow(x, y, n))
+
+  def test_schedule(self):
+    self.assertEquals(rsa._sliding_window_schedule(0, 3), [])
+    self.assertEquals(rsa._sliding_window_schedule(1, 3), [(1, 0)])
+    # 0b1011000: window 101, then window 1, then three trailing squarings.
+    self.assertEquals(rsa._sliding_window_schedule(0b1011000, 3),
+                      [(3, 2), (1, 0), (3, None)])
+
+  def test_window(self):
+    for window in (1, 2, 5):
+      ctx = rsa.ExponentContext(1009, 2 ** 40 + 12345, window)
+      self.assertEquals(ctx.window, window)
+      self.assertEquals(ctx.power(17), pow(17, 2 ** 40 + 12345, 1009))
+
+class test_context_cache(unittest.TestCase):
+  def setUp(self):
+    rsa.clear_context_cache()
+
+  def tearDown(self):
+    rsa.clear_context_cache()
+
+  def test_hits_misses(self):
+    first = rsa.exponent_context(1009, 65537)
+    self.assertIs(rsa.exponent_context(1009, 65537), first)
+    rsa.exponent_context(1013, 65537)
+    self.assertEquals(rsa.context_cache_info(),
+                      rsa.ContextCacheInfo(1, 2, rsa.CONTEXT_CACHE_SIZE, 2))
+    rsa.clear_context_cache()
+    self.assertEquals(rsa.context_cache_info(),
+                      rsa.ContextCacheInfo(0, 0, rsa.CONTEXT_CACHE_SIZE, 0))
+
+  def test_lru(self):
+    with mock.patch("rsa.CONTEXT_CACHE_SIZE", 2):
+      a = rsa.exponent_context(1009, 3)
+      rsa.exponent_context(1013, 3)
+      rsa.exponent_context(1009, 3)
+      rsa.exponent_context(1019, 3)  # Evicts 1013, the least recently used.
+      self.assertIs(rsa.exponent_context(1009, 3), a)
+      rsa.exponent_context(1013, 3)
+      self.assertEquals(rsa.context_cache_info(), (2, 4, 2, 2))
+
+  def test_keys(self):
+    with mock.patch("random.randint") as random_mock:
+      random_mock.side_effect=random.Random(34).randint
+      K = rsa.RSAPrivateKey(64)
+    k = K.GetPublicKey()
+    for data in range(20):
+      self.assertEquals(K.DecryptInteger(k.EncryptInteger(data)), data)
+    # One context each for e mod N, dP mod p and dQ mod q, built once.
+    self.assertEquals(rsa.context_cache_info().misses, 3)
+    self.assertEquals(rsa.context_cache_info().hits, 0)
+
+    # Contexts are rebuilt rather than pickled.
+    loaded = cPickle.loads(cPickle.dumps(K, -1))
+    self.assertNotIn("_contexts", loaded.__dict__)
+    self.assertNotIn("_contexts", loaded.GetPublicKey().__dict__)
+    self.assertEquals(loaded.DecryptInteger(k.EncryptInteger(7)), 7)
+    self.assertEquals(rsa.context_cache_info().hits, 2)
+
+class test_backend(unittest.TestCase):
+  def setUp(self):
+    self.previous = rsa.get_backend().name
+
+  def tearDown(self):
+    rsa.set_backend(self.previous)
+
+  def test_registry(self):
+    self.assertEquals(rsa.available_backends()[:2], ["python", "builtin"])
+    self.assertEquals("gmpy2" in rsa.available_backends(),
+                      rsa.gmpy2 is not None)
+    rsa.set_backend("builtin")
+    self.assertEquals(rsa.get_backend().name, "builtin")
+    self.assertRaises(rsa.UnknownBackend, rsa.set_backend, "abacus")
+    self.assertEquals(rsa.get_backend().name, "builtin")
+
+  def test_arithmetic(self):
+    R = random.Random(34)
+    for name in rsa.available_backends():
+      rsa.set_backend(name)
+      backend = rsa.get_backend()
+      for i in range(20):
+        n = R.randint(2, 2 ** 300)
+        x = R.randint(0, n - 1)
+        y = R.randint(0, 2 ** 300)
+        self.assertEquals(backend.mulmod(x, y, n), (x * y) % n)
+        self.assertEquals(backend.powmod(x, y, n), pow(x, y, n))
+        self.assertEquals(backend.context(n, y).power(x), pow(x, y, n))
+        self.assertEquals(backend.invert(x, n), rsa.modinv(x, n))
+      self.assertIsNone(backend.invert(6, 9))
+
+  def test_contexts_per_backend(self):
+    key = rsa.RSAPublicKey(1009 * 1013, 5)
+    rsa.set_backend("python")
+    self.assertIsInstance(rsa._key_context(key, key.N, key.e),
+                          rsa.ExponentContext)
+    rsa.set_backend("builtin")
+    self.assertIsInstance(rsa._key_context(key, key.N, key.e), rsa._PowContext)
+    self.assertEquals(key.EncryptInteger(12345), pow(12345, 5, key.N))
+
+class test_stats(unittest.TestCase):
+  def tearDown(self):
+    rsa.disable_stats()
+
+  def test_disabled(self):
+    self.assertIsNone(rsa.get_stats())
+    with rsa.span("nothing"):
+      rsa.modmul(3, 4, 5)
+    self.assertIsNone(rsa.get_stats())
+
+  def test_counters(self):
+    rsa.enable_stats()
+    rsa.modmul(3, 4, 5)
+    self.assertEquals(rsa.get_stats()[0], {"modmul":1})
+    rsa.modexp(3, 4, 5)
+    with mock.patch("random.randint") as random_mock:
+      random_mock.side_effect=random.Random(34).randint
+      rsa.get_prime(64)
+    msg = rsa.Message.Encode("Count these blocks", 2 ** 24)
+    msg.Mapped(abs)
+    counters, spans = rsa.get_stats()
+    self.assertGreaterEqual(counters["modexp"], counters["mr_rounds"])
+    self.assertGreater(counters["candidates"], 0)
+    self.assertGreater(counters["sieved"], 0)
+    self.assertEquals(counters["blocks"], 9)
+
+    # Explicit stats still go where they are asked to.
+    stats = collections.Counter()
+    rsa.isprime(1000003, stats=stats)
+    self.assertEquals(stats["mr_rounds"], len(rsa.MR_DETERMINISTIC_BASES))
+    self.assertEquals(rsa.get_stats()[0]["mr_rounds"], counters["mr_rounds"])
+
+    # Exponentiations multiply in Montgomery form, not through modmul.
+    rsa.enable_stats()
+    rsa.modexp(3, 2 ** 64 - 1, 2 ** 61 - 1, rsa.MontgomeryContext(2 ** 61 - 1))
+    self.assertGreaterEqual(rsa.get_stats()[0]["montgomery_mul"], 64)
+
+  def test_spans(self):
+    rsa.enable_stats()
+    with mock.patch("time.time") as time_mock:
+      time_mock.side_effect = [10.0, 10.5, 20.0, 20.25, 30.0, 31.0, 40.0, 40.0]
+      with rsa.span("a"):
+        pass
+      with rsa.span("a"):
+        pass
+      self.assertEquals(list(rsa._spanned("b", [1])), [1])
+    self.assertEquals(rsa.get_stats()[1], {"a":0.75, "b":1.0})
+    self.assertRegexpMatches(rsa.format_stats(), "a +0.7500\nb +1.0000")
+    rsa.enable_stats()
+    self.assertEquals(rsa.get_stats(), ({}, {}))
+
 class test_rsa_isprime(unittest.TestCase):
   def test_first_few_prime(self):
     for i in (2, 3, 5, 7, 11):
@@ -180,6 +586,44 @@ class test_rsa_isprime(unittest.TestCase):
         mocked_sample.side_effect=sampler
         self.assertFalse(rsa.isprime(n))
 
+  def test_small_exhaustive(self):
+    primes = set(rsa._small_primes(2000)) | set([2])
+    for i in range(2000):
+      self.assertEquals(rsa.isprime(i), i in primes)
+
+  def test_strong_pseudoprimes(self):
+    """Composites that fool Miller-Rabin for the first several prime bases."""
+    for n in (2047, 3215031751, 3825123056546413051,
+              318665857834031151167461):
+      self.assertFalse(rsa.isprime(n))
+
+  def test_large(self):
+    m127 = 2 ** 127 - 1
+    m521 = 2 ** 521 - 1
+    self.assertTrue(rsa.isprime(m127))
+    self.assertTrue(rsa.isprime(m521))
+    self.assertFalse(rsa.isprime(m127 * m521))
+    self.assertFalse(rsa.isprime(m521 * m521))
+
+  def test_rounds(self):
+    self.assertEquals(rsa._mr_rounds(512), 7)
+    self.assertEquals(rsa._mr_rounds(1024), 5)
+    self.assertEquals(rsa._mr_rounds(2048), 4)
+    self.assertEquals(rsa._mr_rounds(100), rsa.PRIMALITY_ITERATIONS)
+
+    stats = collections.Counter()
+    self.assertTrue(rsa.isprime(2 ** 521 - 1, stats=stats))
+    self.assertEquals(stats["mr_rounds"], 7)
+    stats = collections.Counter()
+    self.assertTrue(rsa.isprime(2 ** 127 - 1, stats=stats))
+    self.assertEquals(stats["mr_rounds"], rsa.PRIMALITY_ITERATIONS)
+    stats = collections.Counter()
+    self.assertTrue(rsa.isprime(2 ** 521 - 1, N=3, stats=stats))
+    self.assertEquals(stats["mr_rounds"], 3)
+    stats = collections.Counter()
+    self.assertTrue(rsa.isprime(1000003, stats=stats))
+    self.assertEquals(stats["mr_rounds"], len(rsa.MR_DETERMINISTIC_BASES))
+
 class test_rsa_get_prime(unittest.TestCase):
   def test_edge(self):
     with mock.patch("random.randint") as random_mock:
@@ -193,6 +637,63 @@ class test_rsa_get_prime(unittest.TestCase):
           self.assertTrue(rsa.isprime(prime))
           self.assertTrue(prime < 2 ** b)
 
+  def test_no_sieve(self):
+    with mock.patch("random.randint") as random_mock:
+      random_mock.side_effect=random.Random(34).randint
+      for b in (3, 4, 5, 10, 20):
+        for i in range(3):
+          prime = rsa.get_prime(b, sieve=False)
+          self.assertTrue(rsa.isprime(prime))
+          self.assertTrue(2 ** (b - 1) <= prime < 2 ** b)
+
+  def test_sieve_window(self):
+    for start, count in ((3, 100), (1001, 500), (2 ** 40 + 1, 300)):
+      largest = start + 2 * count
+      composite = rsa._sieve_window(start, count, largest)
+      for i in range(count):
+        n = start + 2 * i
+        has_factor = any(n % p == 0 for p in rsa._SIEVE_PRIMES if p * p <= largest)
+        self.assertEquals(bool(composite[i]), has_factor)
+
+  def test_small_primes(self):
+    self.assertEquals(rsa._small_primes(30), [3, 5, 7, 11, 13, 17, 19, 23, 29])
+
+  def test_stats(self):
+    with mock.patch("random.randint") as random_mock:
+      random_mock.side_effect=random.Random(34).randint
+      stats = collections.Counter()
+      rsa.get_prime(64, stats=stats)
+      self.assertGreater(stats["sieved"], 0)
+      self.assertGreater(stats["candidates"], 0)
+      self.assertGreaterEqual(stats["mr_rounds"],
+                              len(rsa.MR_DETERMINISTIC_BASES))
+
+class test_get_distinct_primes(unittest.TestCase):
+  def setUp(self):
+    # Key generation draws from the global generator; seed it for these tests
+    # and leave it as it was for the rest.
+    self.random_state = random.getstate()
+    random.seed(34)
+
+  def tearDown(self):
+    random.setstate(self.random_state)
+
+  def test_distinct(self):
+    for workers in (1, 2, 3):
+      primes = rsa.get_distinct_primes(20, 3, workers)
+      self.assertEquals(len(set(primes)), 3)
+      for prime in primes:
+        self.assertTrue(rsa.isprime(prime))
+        self.assertTrue(2 ** 19 <= prime < 2 ** 20)
+
+  def test_worker_failure(self):
+    with mock.patch("rsa.get_prime", side_effect=ValueError("boom")):
+      self.assertRaises(ValueError, rsa.get_distinct_primes, 20, 2, 2)
+
+  def test_exhausts_small_space(self):
+    """Only two 3 bit primes exist, so duplicates must be retried."""
+    self.assertEquals(sorted(rsa.get_distinct_primes(3, 2, 4)), [5, 7])
+
 class test_Message(unittest.TestCase):
   def test_message_edge(self):
     self.assertEquals(rsa.Message([72, 69, 76, 76, 79], 2 ** 16, 1).Decode(),
@@ -224,10 +725,117 @@ class test_Message(unittest.TestCase):
         self.assertEquals(rsa.Message.Encode(data, 2 ** base).Decode(),
                           data)
 
+  def test_Encode_blocks(self):
+    R = random.Random(34)
+    data = "".join(chr(R.randint(0, 255)) for _ in range(1000))
+    for modulo in (2 ** 16, 2 ** 24 + 1, 2 ** 512 - 1, 3 ** 700):
+      width = rsa.Message._bytes_per_item(modulo)
+      msg = rsa.Message.Encode(data, modulo)
+      padded = data + "\0" * (-len(data) % width)
+      self.assertEquals(msg.numbers,
+                        [int(padded[i:i + width].encode("hex"), 16)
+                         for i in range(0, len(padded), width)])
+      self.assertEquals(msg.Decode(), data)
+
+  def test_base_from_modulo(self):
+    for modulo, base in ((2 ** 8, 8), (2 ** 8 + 1, 16), (2 ** 16, 16),
+                         (2 ** 16 + 1, 24), (2 ** 4096 + 1, 4104)):
+      self.assertEquals(rsa.Message._base_from_modulo(modulo), base)
+
   def test_Mapped(self):
     msg = rsa.Message([72, 69, 76, 76, 79], 2 ** 16, 1)
     self.assertEquals(msg.Mapped(lambda x: x + 2).Decode(), "JGNNQ")
 
+  def test_Mapped_pool(self):
+    msg = rsa.Message.Encode("This was a triumph. " * 20, 2 ** 24)
+    pool = multiprocessing.Pool(2)
+    try:
+      with mock.patch("rsa.PARALLEL_CHUNK_BLOCKS", 7):
+        self.assertEquals(msg.Mapped(abs, pool), msg)
+        k = rsa.RSAPublicKey(4294967291 * 65521, 7)
+        self.assertEquals(msg.Mapped(k.EncryptInteger, pool, k.N).numbers,
+                          map(k.EncryptInteger, msg.numbers))
+    finally:
+      pool.terminate()
+
+  def test_Mapped_bound(self):
+    msg = rsa.Message.Encode("Hi there", 2 ** 16)
+    wide = msg.Mapped(lambda x: x << 16, bound=2 ** 32)
+    self.assertEquals(len(wide.BlockBytes()), 4 * len(msg.numbers))
+    self.assertEquals(wide.numbers, [x << 16 for x in msg.numbers])
+    self.assertEquals(wide.Mapped(lambda x: x >> 16).Decode(), "Hi there")
+    self.assertRaises(rsa.DecodeRangeError, wide.Decode)
+    self.assertRaises(rsa.BlockRangeError, msg.Mapped, lambda x: x << 16)
+
+  def test_blocks(self):
+    msg = rsa.Message([1, 2, 3, 65535, 0], 2 ** 16 + 1, 2)
+    self.assertEquals(msg.BlockBytes(),
+                      "\0\0\x01\0\0\x02\0\0\x03\0\xff\xff\0\0\0")
+    self.assertEquals(list(msg.Blocks(2)), [1, 2, 3, 65535, 0])
+    self.assertEquals(rsa.Message.FromBlocks(msg.BlockBytes(), 2 ** 16 + 1, 2),
+                      msg)
+    self.assertRaises(rsa.BlockRangeError, rsa.Message.FromBlocks, "\0\0",
+                      2 ** 16 + 1, 2)
+    self.assertRaises(rsa.BlockRangeError, rsa.Message, [2 ** 24], 2 ** 16, 2)
+    self.assertRaises(rsa.BlockRangeError, rsa.Message, [-1], 2 ** 16, 2)
+
+  def test_pickle(self):
+    msg = rsa.Message.Encode("Pickle me", 2 ** 24)
+    wide = msg.Mapped(abs, bound=2 ** 64)
+    for m in (msg, wide):
+      self.assertEquals(cPickle.loads(cPickle.dumps(m, 2)), m)
+    # Messages pickled when they kept a list of numbers.
+    legacy = rsa.Message.__new__(rsa.Message)
+    legacy.__setstate__({"numbers":msg.numbers, "modulo":2 ** 24,
+                         "overflow":msg.overflow})
+    self.assertEquals(legacy, msg)
+
+  def test_Encode_bits(self):
+    msg = rsa.Message.Encode("\xab\xcd\xef", 2 ** 12, rsa.PACKING_BITS)
+    self.assertEquals((msg.numbers, msg.overflow), ([0xabc, 0xdef], 12))
+    msg = rsa.Message.Encode("\xab\xcd", 2 ** 12, rsa.PACKING_BITS)
+    self.assertEquals((msg.numbers, msg.overflow), ([0xabc, 0xd00], 4))
+    self.assertEquals(msg.Decode(), "\xab\xcd")
+    msg = rsa.Message.Encode("", 2 ** 12, rsa.PACKING_BITS)
+    self.assertEquals((msg.numbers, msg.Decode()), ([], ""))
+
+  def test_bits_exhaustive(self):
+    R = random.Random(34)
+    for nbits in range(9, 80) + [127, 128, 129, 1024]:
+      for modulo in (2 ** (nbits - 1) + 1, 2 ** nbits - 1, 2 ** nbits):
+        for length in range(0, 20) + [R.randint(20, 300)]:
+          value = "".join(chr(R.randint(0, 255)) for _ in range(length))
+          msg = rsa.Message.Encode(value, modulo, rsa.PACKING_BITS)
+          self.assertEquals(msg.Decode(), value)
+          self.assertTrue(all(n < modulo for n in msg.numbers))
+          self.assertEquals(len(msg.numbers),
+                            -(-8 * length // (modulo.bit_length() - 1)))
+
+  def test_bits_fewer_blocks(self):
+    value = "x" * 10000
+    for modulo in (2 ** 12 + 1, 2 ** 100 + 1, 2 ** 512 - 1):
+      dense = rsa.Message.Encode(value, modulo, rsa.PACKING_BITS)
+      sparse = rsa.Message.Encode(value, modulo)
+      self.assertLess(len(dense.numbers), len(sparse.numbers))
+      self.assertNotEquals(dense, sparse)
+
+  def test_Decode_bits_range(self):
+    msg = rsa.Message([0xabc, 0x2000], 2 ** 13 + 1, 12, rsa.PACKING_BITS)
+    self.assertRaises(rsa.DecodeRangeError, msg.Decode)
+
+  def test_bits_crypt(self):
+    key = rsa.RSAPrivateKey.__new__(rsa.RSAPrivateKey)
+    p, q = 4294967291, 4294967279
+    key.__setstate__({"p":p, "q":q, "phi":(p - 1) * (q - 1), "N":p * q,
+                      "e":3, "d":rsa.modinv(3, (p - 1) * (q - 1)),
+                      "public":rsa.RSAPublicKey(p * q, 3)})
+    value = "Pack these bits tightly, please."
+    msg = rsa.Message.Encode(value, key.N, rsa.PACKING_BITS)
+    encrypted = key.GetPublicKey().Encrypt(msg)
+    self.assertEquals(encrypted.packing, rsa.PACKING_BITS)
+    self.assertEquals(key.Decrypt(encrypted).Decode(), value)
+    self.assertEquals(cPickle.loads(cPickle.dumps(msg, -1)), msg)
+
   def test_high_bits_encoding_regression(self):
     """Must be able to encode messages larger than n in any base."""
     value = "\xFF\xFF\xFF\xFF\xFF"
@@ -246,6 +854,15 @@ class test_Message(unittest.TestCase):
     self.assertEquals(msg2, msg2)
 
 class test_RSA(unittest.TestCase):
+  def setUp(self):
+    # Key generation draws from the global generator; seed it for these tests
+    # and leave it as it was for the rest.
+    self.random_state = random.getstate()
+    random.seed(34)
+
+  def tearDown(self):
+    random.setstate(self.random_state)
+
   def test_creation_edge(self):
     with mock.patch("random.randint") as random_mock:
       random_mock.side_effect=random.Random(34).randint
@@ -282,6 +899,53 @@ class test_RSA(unittest.TestCase):
 
         self.assertEquals(K.Decrypt(k.Encrypt(msg)).Decode(), value)
   
+  def test_parallel_keygen(self):
+    K = rsa.RSAPrivateKey(64, workers=2)
+    k = K.GetPublicKey()
+    self.assertNotEquals(K.p, K.q)
+    self.assertEquals(K.N, K.p * K.q)
+    for data in (0, 1, 12345, K.N - 1):
+      self.assertEquals(K.DecryptInteger(k.EncryptInteger(data)), data)
+
+  def test_message_crypt_pool(self):
+    K = rsa.RSAPrivateKey(32)
+    k = K.GetPublicKey()
+    msg = rsa.Message.Encode("Hello world! " * 100, K.N)
+    pool = multiprocessing.Pool(2)
+    try:
+      enc = k.Encrypt(msg, pool)
+      self.assertEquals(enc, k.Encrypt(msg))
+      self.assertEquals(K.Decrypt(enc, pool), msg)
+    finally:
+      pool.terminate()
+
+  def test_crt_matches_full(self):
+    with mock.patch("random.randint") as random_mock:
+      random_mock.side_effect=random.Random(34).randint
+      for nbits in (3, 4, 5, 10, 20, 64):
+        K = rsa.RSAPrivateKey(nbits)
+        k = K.GetPublicKey()
+        R = random.Random(nbits)
+        for data in [0, 1, K.N - 1] + [R.randint(0, K.N - 1) for _ in range(20)]:
+          self.assertEquals(K.DecryptInteger(data), K.DecryptIntegerFull(data))
+          self.assertEquals(K.DecryptInteger(k.EncryptInteger(data)), data)
+
+  def test_crt_old_pickle(self):
+    with mock.patch("random.randint") as random_mock:
+      random_mock.side_effect=random.Random(34).randint
+      K = rsa.RSAPrivateKey(20)
+    dP, dQ, qInv = K.dP, K.dQ, K.qInv
+    del K.dP, K.dQ, K.qInv
+    loaded = cPickle.loads(cPickle.dumps(K, -1))
+    self.assertEquals((loaded.dP, loaded.dQ, loaded.qInv), (dP, dQ, qInv))
+
+    # Keys from before the primes were stored can still decrypt.
+    del K.p, K.q, K.phi
+    loaded = cPickle.loads(cPickle.dumps(K, -1))
+    self.assertIsNone(loaded.qInv)
+    value = K.GetPublicKey().EncryptInteger(12345)
+    self.assertEquals(loaded.DecryptInteger(value), 12345)
+
   def test_eq_neq(self):
     with mock.patch("random.randint") as random_mock:
       random_mock.side_effect=random.Random(34).randint
@@ -314,6 +978,444 @@ def make_fs_side_effect(tester, files):
     return fd
   return open_file
 
+class test_Ciphertext(unittest.TestCase):
+  def setUp(self):
+    self.key = rsa.RSAPublicKey(2 ** 40 + 15, 3)
+    self.numbers = [0, 1, 2 ** 40, 12345678901]
+
+  def write(self, overflow, chunks):
+    out = StringIO.StringIO()
+    writer = rsa.CiphertextWriter(out, self.key, overflow)
+    for chunk in chunks:
+      writer.write(rsa.Message(chunk, self.key.N, 5))
+    writer.finish(3)
+    return StringIO.StringIO(out.getvalue())
+
+  def test_roundtrip(self):
+    for overflow in (3, None):
+      reader = rsa.CiphertextReader(self.write(overflow, [self.numbers[:3],
+                                                          self.numbers[3:]]))
+      self.assertEquals(reader.fingerprint, self.key.Fingerprint())
+      self.assertEquals(reader.width, 6)
+      self.assertEquals(reader.trailer, overflow is None)
+      self.assertEquals(list(reader.blocks()), self.numbers)
+      self.assertEquals(reader.overflow, 3)
+
+  def test_random_access(self):
+    for overflow in (3, None):
+      reader = rsa.CiphertextReader(self.write(overflow, [self.numbers]))
+      self.assertEquals(len(reader), 4)
+      for k in (3, 0, 2, 1):
+        self.assertEquals(reader.block(k), self.numbers[k])
+      self.assertRaises(IndexError, reader.block, 4)
+
+  def test_messages(self):
+    with mock.patch("rsa.STREAM_CHUNK_BLOCKS", 2):
+      for count in range(6):
+        reader = rsa.CiphertextReader(self.write(None, [self.numbers[:count]]))
+        messages = list(reader.messages(self.key.N))
+        self.assertEquals(sum((m.numbers for m in messages), []),
+                          self.numbers[:count])
+        self.assertEquals([m.overflow for m in messages],
+                          [5] * (len(messages) - 1) + [3])
+
+  def test_bit_packed_messages(self):
+    key = rsa.RSAPublicKey(2 ** 41 + 21, 3)
+    R = random.Random(34)
+    for length in (0, 1, 5, 41, 42, 100, 333):
+      value = "".join(chr(R.randint(0, 255)) for _ in range(length))
+      msg = rsa.Message.Encode(value, key.N, rsa.PACKING_BITS)
+      for overflow in (msg.overflow, None):
+        out = StringIO.StringIO()
+        writer = rsa.CiphertextWriter(out, key, overflow, rsa.PACKING_BITS)
+        writer.write(msg)
+        writer.finish(msg.overflow)
+        with mock.patch("rsa.STREAM_CHUNK_BLOCKS", 3):
+          reader = rsa.CiphertextReader(StringIO.StringIO(out.getvalue()))
+          self.assertEquals(reader.packing, rsa.PACKING_BITS)
+          messages = list(reader.messages(key.N))
+        # Each message decodes on its own.
+        self.assertEquals("".join(m.Decode() for m in messages), value)
+        self.assertTrue(all(len(m.numbers) % 8 == 0 for m in messages[:-1]))
+
+  def test_malformed(self):
+    data = self.write(None, [self.numbers]).getvalue()
+    flags = data[:5] + "\x80" + data[6:]
+    for bad in (data[:10], data[:-1], "XXXX" + data[4:], flags):
+      with self.assertRaises(rsa.MalformedCiphertext):
+        list(rsa.CiphertextReader(StringIO.StringIO(bad)).blocks())
+
+  def header(self, data, **fields):
+    """data with the named header fields replaced."""
+    names = ("magic", "version", "flags", "fingerprint", "width", "overflow")
+    size = rsa.CONTAINER_HEADER.size
+    values = dict(zip(names, rsa.CONTAINER_HEADER.unpack(data[:size])))
+    values.update(fields)
+    return (rsa.CONTAINER_HEADER.pack(*[values[name] for name in names]) +
+            data[size:])
+
+  def test_malformed_header(self):
+    data = self.write(3, [self.numbers]).getvalue()
+    # Blocks too narrow for any data.
+    for width in (0, 1):
+      with self.assertRaises(rsa.MalformedCiphertext):
+        rsa.CiphertextReader(StringIO.StringIO(self.header(data, width=width)))
+    # Blocks that are not as wide as the key's modulus.
+    for width in (2, 5, 7):
+      reader = rsa.CiphertextReader(
+          StringIO.StringIO(self.header(data, width=width)))
+      with self.assertRaises(rsa.MalformedCiphertext):
+        list(reader.messages(self.key.N))
+    # Overflows no encoding of the blocks could have.
+    for overflow in (0, 6, 2 ** 32 - 1):
+      reader = rsa.CiphertextReader(
+          StringIO.StringIO(self.header(data, overflow=overflow)))
+      with self.assertRaises(rsa.MalformedCiphertext):
+        list(reader.messages(self.key.N))
+    trailer = self.write(None, [self.numbers]).getvalue()
+    reader = rsa.CiphertextReader(StringIO.StringIO(
+        trailer[:-6] + rsa._pack_blocks([0], 6)))
+    with self.assertRaises(rsa.MalformedCiphertext):
+      list(reader.messages(self.key.N))
+
+  def test_bit_packed_overflow(self):
+    # Ten 40 bit blocks hold 400 bits, so the final one must bring the total
+    # to a whole number of bytes.
+    data = self.write(3, [self.numbers] * 3).getvalue()
+    data = self.header(data, flags=rsa.CONTAINER_BIT_PACKED)
+    for overflow, valid in ((8, True), (40, True), (3, False), (41, False)):
+      reader = rsa.CiphertextReader(
+          StringIO.StringIO(self.header(data, overflow=overflow)))
+      if valid:
+        self.assertEquals(len(list(reader.messages(self.key.N))), 1)
+      else:
+        with self.assertRaises(rsa.MalformedCiphertext):
+          list(reader.messages(self.key.N))
+
+class test_hybrid(unittest.TestCase):
+  def setUp(self):
+    with mock.patch("random.randint") as rmock:
+      rmock.side_effect=random.Random(34).randint
+      self.key = rsa.RSAPrivateKey(64)
+    R = random.Random(34)
+    self.data = "".join(chr(R.randint(0, 255)) for _ in range(1000))
+
+  def encrypt(self, chunks, pool=None):
+    out = StringIO.StringIO()
+    rsa._encrypt_hybrid(self.key.GetPublicKey(), chunks, out, pool)
+    return out.getvalue()
+
+  def decrypt(self, ciphertext, key=None, pool=None):
+    key = key or self.key
+    session, chunks = rsa._load_ciphertext(StringIO.StringIO(ciphertext), key)
+    if chunks is None:
+      return None
+    return "".join(rsa._decrypt_chunks(key, session, chunks, pool))
+
+  def test_keystream(self):
+    stream = rsa._keystream("k" * 32, 0, 1000)
+    self.assertEquals(len(stream), 1000)
+    self.assertEquals(stream[:64], rsa.hashlib.sha512("k" * 32 +
+                                                      "\0" * 8).digest())
+    # Any block-aligned stretch can be made on its own.
+    self.assertEquals(rsa._keystream("k" * 32, 128, 200), stream[128:328])
+    self.assertNotEquals(rsa._keystream("j" * 32, 0, 64), stream[:64])
+    self.assertRaises(ValueError, rsa._keystream, "k" * 32, 10, 64)
+
+  def test_keystream_xor(self):
+    chunks = [self.data[i:i + 128] for i in range(0, len(self.data), 128)]
+    encrypted = "".join(rsa._keystream_xor("k" * 32, chunks))
+    self.assertEquals(rsa._xor_bytes(self.data, encrypted),
+                      rsa._keystream("k" * 32, 0, len(self.data)))
+    self.assertEquals("".join(rsa._keystream_xor("k" * 32, [encrypted])),
+                      self.data)
+    self.assertEquals(rsa._xor_bytes("", ""), "")
+    # Whole words and a tail of single bytes.
+    for length in (1, 7, 8, 9, 23):
+      a, b = self.data[:length], self.data[100:100 + length]
+      self.assertEquals(rsa._xor_bytes(a, b),
+                        "".join(chr(ord(x) ^ ord(y)) for x, y in zip(a, b)))
+
+  def test_roundtrip(self):
+    with mock.patch("rsa.HYBRID_CHUNK_BYTES", 128):
+      for length in (0, 1, 64, 128, 129, 1000):
+        data = self.data[:length]
+        chunks = [data[i:i + 128] for i in range(0, length, 128)] or [""]
+        ciphertext = self.encrypt(chunks)
+        reader = rsa.CiphertextReader(StringIO.StringIO(ciphertext))
+        self.assertTrue(reader.hybrid)
+        self.assertFalse(reader.trailer)
+        # Three 128 bit blocks hold the 32 byte session key.
+        self.assertEquals(reader.width, 16)
+        header = rsa.CONTAINER_HEADER.size + 3 * 16
+        self.assertEquals(len(ciphertext), header + length)
+        if length >= 16:
+          self.assertNotEquals(ciphertext[header:header + 16], data[:16])
+        self.assertEquals(self.decrypt(ciphertext), data)
+
+  def test_blocks(self):
+    ciphertext = self.encrypt([self.data])
+    session = rsa.CiphertextReader(StringIO.StringIO(ciphertext)).session(
+        self.key.N)
+    reader = rsa.CiphertextReader(StringIO.StringIO(ciphertext))
+    # The blocks are the session key's, not the keystream payload.
+    self.assertEquals(len(reader), 3)
+    self.assertEquals([reader.block(k) for k in range(3)], session.numbers)
+    self.assertRaises(IndexError, reader.block, 3)
+    reader = rsa.CiphertextReader(StringIO.StringIO(ciphertext))
+    self.assertEquals(list(reader.blocks()), session.numbers)
+
+  def test_session_keys(self):
+    # A fresh session key each time, so the same data encrypts differently.
+    first, second = self.encrypt([self.data]), self.encrypt([self.data])
+    self.assertNotEquals(first, second)
+    self.assertEquals(self.decrypt(first), self.decrypt(second))
+
+  def test_pool(self):
+    pool = multiprocessing.Pool(2)
+    try:
+      with mock.patch("rsa.KEYSTREAM_WINDOW", 3):
+        chunks = [self.data[i:i + 64] for i in range(0, len(self.data), 64)]
+        ciphertext = self.encrypt(chunks, pool)
+        self.assertEquals(self.decrypt(ciphertext), self.data)
+        with mock.patch("rsa.HYBRID_CHUNK_BYTES", 128):
+          self.assertEquals(self.decrypt(ciphertext, pool=pool), self.data)
+    finally:
+      pool.terminate()
+
+  def test_wrong_key(self):
+    with mock.patch("random.randint") as rmock:
+      rmock.side_effect=random.Random(35).randint
+      other = rsa.RSAPrivateKey(64)
+    self.assertIsNone(self.decrypt(self.encrypt([self.data]), other))
+
+  def test_malformed(self):
+    ciphertext = self.encrypt([self.data])
+    header = rsa.CONTAINER_HEADER.size
+    for flags in ("\x05", "\x06"):
+      bad = ciphertext[:5] + flags + ciphertext[6:]
+      with self.assertRaises(rsa.MalformedCiphertext):
+        rsa.CiphertextReader(StringIO.StringIO(bad))
+    with self.assertRaises(rsa.MalformedCiphertext):
+      self.decrypt(ciphertext[:header + 10])
+    # Header fields the session key's blocks cannot have.
+    fields = list(rsa.CONTAINER_HEADER.unpack(ciphertext[:header]))
+    for width, overflow in ((0, 32), (1, 32), (8, 32), (16, 0), (16, 15)):
+      fields[4:] = width, overflow
+      bad = rsa.CONTAINER_HEADER.pack(*fields) + ciphertext[header:]
+      with self.assertRaises(rsa.MalformedCiphertext):
+        self.decrypt(bad)
+
+  def test_serve_decrypt(self):
+    self.assertEquals(rsa._decrypt_data(self.key, self.encrypt([self.data])),
+                      self.data)
+
+class test_serve(unittest.TestCase):
+  def setUp(self):
+    with mock.patch("random.randint") as random_mock:
+      random_mock.side_effect=random.Random(34).randint
+      self.key = rsa.RSAPrivateKey(64)
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, "rsa.sock")
+    self.keyfile = os.path.join(self.tempdir, "key")
+    with open(self.keyfile, "wb") as fileio:
+      cPickle.dump(self.key, fileio, -1)
+    self.servers = []
+
+  def tearDown(self):
+    for server, thread in self.servers:
+      server.shutdown()
+      server.server_close()
+      thread.join()
+    shutil.rmtree(self.tempdir)
+
+  def start(self, keys=None, jobs=1):
+    server = rsa.RSAServer(self.path, keys or {self.keyfile:self.key}, jobs)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.start()
+    self.servers.append((server, thread))
+    return rsa.RSAClient(self.path)
+
+  def test_roundtrip(self):
+    client = self.start()
+    data = "Serve me something nice." * 10
+    encrypted = client.Request("encrypt", self.keyfile, data)
+    self.assertEquals(rsa._decrypt_data(self.key, encrypted), data)
+    fingerprint = binascii.hexlify(self.key.Fingerprint())
+    self.assertEquals(client.Request("decrypt", fingerprint, encrypted), data)
+    self.assertEquals(cPickle.loads(client.Request("publicextract",
+                                                   self.keyfile)),
+                      self.key.GetPublicKey())
+    client.close()
+
+  def test_pipelined(self):
+    client = self.start()
+    data = ["Message %d" % i for i in range(20)]
+    encrypted = list(client.Pipelined(
+        [("encrypt", self.keyfile, value) for value in data], window=5))
+    self.assertEquals(list(client.Pipelined(
+        [("decrypt", self.keyfile, value) for value in encrypted])), data)
+
+  def test_backpressure(self):
+    with mock.patch("rsa.SERVE_MAX_PENDING", 1):
+      client = self.start()
+      data = ["Message %d" % i for i in range(10)]
+      results = client.Pipelined(
+          [("encrypt", self.keyfile, value) for value in data], window=10)
+      self.assertEquals([rsa._decrypt_data(self.key, value)
+                         for value in results], data)
+
+  def test_stalled_client(self):
+    # A client that sends requests but never reads the responses fills its
+    # socket and its own slots, not everyone's.
+    with mock.patch("rsa.SERVE_MAX_PENDING", 1):
+      client = self.start()
+      stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      stalled.connect(self.path)
+      try:
+        payload = "x" * (64 << 10)
+        request = (rsa.SERVE_REQUEST.pack(0, len(self.keyfile), len(payload)) +
+                   self.keyfile + payload)
+        stalled.settimeout(1)
+        try:
+          for _ in range(16):
+            stalled.sendall(request)
+        except socket.timeout:
+          pass
+        client._socket.settimeout(30)
+        self.assertEquals(cPickle.loads(client.Request("publicextract",
+                                                       self.keyfile)),
+                          self.key.GetPublicKey())
+      finally:
+        stalled.close()
+        client.close()
+
+  def test_errors(self):
+    public = self.key.GetPublicKey()
+    pub = os.path.join(self.tempdir, "pub")
+    client = self.start({pub:public, self.keyfile:self.key})
+    self.assertRaisesRegexp(rsa.ServeError, "Unknown key",
+                            client.Request, "encrypt", "nokey", "data")
+    self.assertRaisesRegexp(rsa.ServeError, "not capable of decryption",
+                            client.Request, "decrypt", pub, "data")
+    other = rsa.RSAPublicKey(1009 * 1013, 5)
+    self.assertRaisesRegexp(rsa.ServeError, "does not match",
+                            client.Request, "decrypt", self.keyfile,
+                            rsa._encrypt_data(other, "data"))
+    # The private key answers to the fingerprint both keys share.
+    fingerprint = binascii.hexlify(self.key.Fingerprint())
+    self.assertEquals(client.Request("decrypt", fingerprint,
+                                     client.Request("encrypt", pub, "fp")),
+                      "fp")
+    # The connection is still usable.
+    self.assertEquals(client.Request("decrypt", self.keyfile,
+                                     client.Request("encrypt", pub, "ok")),
+                      "ok")
+
+  def test_pickled_decrypt(self):
+    # The daemon never unpickles what a client sends; this one would create
+    # a file.
+    client = self.start()
+    created = os.path.join(self.tempdir, "created")
+    payload = "c__builtin__\nopen\n(S%r\nS'w'\ntR." % created
+    self.assertRaisesRegexp(rsa.ServeError, "Unrecognized ciphertext format",
+                            client.Request, "decrypt", self.keyfile, payload)
+    self.assertFalse(os.path.exists(created))
+    msg = self.key.GetPublicKey().Encrypt(rsa.Message.Encode("old",
+                                                             self.key.N))
+    self.assertRaisesRegexp(rsa.ServeError, "Unrecognized ciphertext format",
+                            client.Request, "decrypt", self.keyfile,
+                            cPickle.dumps((self.key.GetPublicKey(), msg), -1))
+    client.close()
+
+  def test_failed_pipeline(self):
+    client = self.start()
+    requests = [("encrypt", self.keyfile, "one"), ("encrypt", "nokey", "two"),
+                ("encrypt", self.keyfile, "three"),
+                ("encrypt", self.keyfile, "four")]
+    results = client.Pipelined(requests)
+    self.assertEquals(rsa._decrypt_data(self.key, next(results)), "one")
+    self.assertRaisesRegexp(rsa.ServeError, "Unknown key", next, results)
+    # The responses still in flight were read, so the next request gets its
+    # own answer.
+    self.assertEquals(cPickle.loads(client.Request("publicextract",
+                                                   self.keyfile)),
+                      self.key.GetPublicKey())
+
+    # Likewise when the caller stops early.
+    results = client.Pipelined(requests[2:] * 3)
+    next(results)
+    results.close()
+    self.assertEquals(cPickle.loads(client.Request("publicextract",
+                                                   self.keyfile)),
+                      self.key.GetPublicKey())
+    client.close()
+
+  def test_socket(self):
+    self.start()
+    self.assertEquals(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+    # A live server's socket is left alone.
+    self.assertRaisesRegexp(rsa.ServeError, "already listening",
+                            rsa.RSAServer, self.path, {self.keyfile:self.key})
+    self.assertTrue(os.path.exists(self.path))
+
+  def test_stale_socket(self):
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(self.path)
+    stale.close()
+    client = self.start()
+    self.assertEquals(client.Request("decrypt", self.keyfile,
+                                     client.Request("encrypt", self.keyfile,
+                                                    "fresh")),
+                      "fresh")
+
+  def test_not_a_socket(self):
+    with open(self.path, "wb") as fileio:
+      fileio.write("precious")
+    self.assertRaisesRegexp(rsa.ServeError, "not a socket",
+                            rsa.RSAServer, self.path, {self.keyfile:self.key})
+    with open(self.path, "rb") as fileio:
+      self.assertEquals(fileio.read(), "precious")
+
+  def test_bind_failure(self):
+    path = os.path.join(self.tempdir, "missing", "rsa.sock")
+    with mock.patch("multiprocessing.pool.ThreadPool") as pool:
+      self.assertRaises(socket.error, rsa.RSAServer, path,
+                        {self.keyfile:self.key})
+    self.assertFalse(pool.called)
+
+  def test_process_pool(self):
+    client = self.start(jobs=2)
+    encrypted = client.Request("encrypt", self.keyfile, "Processed")
+    self.assertEquals(client.Request("decrypt", self.keyfile, encrypted),
+                      "Processed")
+
+  def test_client_command(self):
+    self.start()
+    opts = optparse.Values({"socket":self.path})
+    plain = os.path.join(self.tempdir, "plain")
+    with open(plain, "wb") as fileio:
+      fileio.write("Through the command line.")
+    cipher = os.path.join(self.tempdir, "cipher")
+    rsa.client(["client", "encrypt", self.keyfile, plain, cipher], opts)
+    # The output is an ordinary ciphertext container.
+    rsa.decrypt(["decrypt", self.keyfile, cipher, plain + ".out"])
+    with open(plain + ".out", "rb") as fileio:
+      self.assertEquals(fileio.read(), "Through the command line.")
+
+    stderr = StringIO.StringIO()
+    with mock.patch("sys.stderr", stderr):
+      rsa.client(["client", "decrypt", "nokey", plain, cipher], opts)
+    self.assertRegexpMatches(stderr.getvalue(), "Unknown key")
+
+    for args in (["encrypt", self.keyfile], ["decrypt", self.keyfile, plain],
+                 ["publicextract", self.keyfile]):
+      stderr = StringIO.StringIO()
+      with mock.patch("sys.stderr", stderr):
+        rsa.client(["client"] + args, opts)
+      self.assertRegexpMatches(stderr.getvalue(), "Usage: .* client %s"
+                               % args[0])
+
 class test_load_key(unittest.TestCase):
   def test_load_key(self):
     with mock.patch("random.randint") as random_mock:
@@ -339,7 +1441,7 @@ class test_encrypt_decrypt(unittest.TestCase):
       key = rsa.RSAPrivateKey(12)
       badkey = rsa.RSAPrivateKey(10)
       good = (key.GetPublicKey(),
-              rsa.Message([1385493, 12416809, 4364045], 13021759, 1))
+              rsa.Message([218099, 7895285, 5933993], 10198387, 1))
       files = {"pub":(StringIO.StringIO(cPickle.dumps(key.GetPublicKey(),
                                                         -1)), "rb"),
                "priv":(StringIO.StringIO(cPickle.dumps(key, -1)), "rb"),
@@ -360,11 +1462,115 @@ class test_encrypt_decrypt(unittest.TestCase):
       self.files["in"][0].seek(0)
       rsa.encrypt(["", "priv", "in", "enc2"])
 
-      enc1 = cPickle.loads(self.files["enc1"][0].getvalue())
-      enc2 = cPickle.loads(self.files["enc2"][0].getvalue())
-      good = cPickle.loads(self.files["good"][0].getvalue())
-      self.assertEquals(enc1, good)
-      self.assertEquals(enc2, good)
+      good_key, good = cPickle.loads(self.files["good"][0].getvalue())
+      for name in ("enc1", "enc2"):
+        reader = rsa.CiphertextReader(
+            StringIO.StringIO(self.files[name][0].getvalue()))
+        self.assertEquals(reader.fingerprint, good_key.Fingerprint())
+        self.assertEquals(reader.width, 3)
+        self.assertEquals(list(reader.messages(good_key.N)), [good])
+
+  def test_encrypt_stream(self):
+    with contextlib.nested(mock.patch("__builtin__.open"),
+                           mock.patch("rsa.STREAM_CHUNK_BLOCKS", 2)) as (opener,
+                                                                        _):
+      opener.side_effect = self.opener_fxn
+      rsa.encrypt(["", "pub", "in", "enc1"],
+                  optparse.Values({"stream": True}))
+
+      enc = StringIO.StringIO(self.files["enc1"][0].getvalue())
+      reader = rsa.CiphertextReader(enc)
+      self.assertTrue(reader.trailer)
+      self.assertIsNone(reader.overflow)
+      good = cPickle.loads(self.files["good"][0].getvalue())[1]
+      self.assertEquals(list(reader.blocks()), good.numbers)
+      self.assertEquals(reader.overflow, good.overflow)
+
+      self.files["good"] = (enc, "rb")
+      enc.seek(0)
+      rsa.decrypt(["", "priv", "good", "dec"])
+      self.assertEquals(self.files["dec"][0].getvalue(), "Hello")
+
+  def test_encrypt_pack(self):
+    for stream in (False, True):
+      with contextlib.nested(mock.patch("__builtin__.open"),
+                             mock.patch("rsa.STREAM_CHUNK_BLOCKS", 2)) as (
+                                 opener, _):
+        opener.side_effect = self.opener_fxn
+        for name in ("in", "pub", "priv"):
+          self.files[name][0].seek(0)
+        self.files["enc1"] = (StringIO.StringIO(), "wb")
+        rsa.encrypt(["", "pub", "in", "enc1"],
+                    optparse.Values({"stream":stream, "pack":True}))
+
+        enc = StringIO.StringIO(self.files["enc1"][0].getvalue())
+        reader = rsa.CiphertextReader(enc)
+        self.assertEquals(reader.packing, rsa.PACKING_BITS)
+        # 40 bits in 23 bit blocks rather than 5 bytes in 2 byte blocks.
+        self.assertEquals(len(list(reader.blocks())), 2)
+
+        enc.seek(0)
+        self.files["good"] = (enc, "rb")
+        self.files["dec"] = (StringIO.StringIO(), "wb")
+        rsa.decrypt(["", "priv", "good", "dec"])
+        self.assertEquals(self.files["dec"][0].getvalue(), "Hello")
+
+  def test_encrypt_hybrid(self):
+    R = random.Random(34)
+    data = "".join(chr(R.randint(0, 255)) for _ in range(1000))
+    with contextlib.nested(mock.patch("__builtin__.open"),
+                           mock.patch("rsa.HYBRID_CHUNK_BYTES", 128)) as (
+                               opener, _):
+      opener.side_effect = self.opener_fxn
+      self.files["in"] = (StringIO.StringIO(data), "rb")
+      rsa.encrypt(["", "pub", "in", "enc1"], optparse.Values({"hybrid":True}))
+
+      enc = StringIO.StringIO(self.files["enc1"][0].getvalue())
+      reader = rsa.CiphertextReader(enc)
+      self.assertTrue(reader.hybrid)
+      self.assertEquals(reader.fingerprint, self.key.Fingerprint())
+
+      enc.seek(0)
+      self.files["good"] = (enc, "rb")
+      rsa.decrypt(["", "priv", "good", "dec"])
+      self.assertEquals(self.files["dec"][0].getvalue(), data)
+
+  def test_container_wrong_key(self):
+    with contextlib.nested(mock.patch("__builtin__.open"),
+                           mock.patch("sys.stderr")) as (opener, stderr):
+      opener.side_effect = self.opener_fxn
+      stderr_backing = StringIO.StringIO()
+      stderr.write = stderr_backing.write
+      rsa.encrypt(["", "pub", "in", "enc1"])
+      self.files["good"] = (StringIO.StringIO(self.files["enc1"][0].getvalue()),
+                            "rb")
+      rsa.decrypt(["", "badkey", "good", "dec"])
+      self.assertRegexpMatches(stderr_backing.getvalue(), "does not match the key")
+      self.assertEquals(self.files["dec"][0].getvalue(), "")
+
+  def test_jobs(self):
+    real_open = open
+    def opener_fxn(fn, *args):
+      # Pool workers reopen stdin on os.devnull when they start.
+      if fn == os.devnull:
+        return real_open(fn, *args)
+      return self.opener_fxn(fn, *args)
+
+    with mock.patch("__builtin__.open") as opener:
+      opener.side_effect = opener_fxn
+      opts = optparse.Values({"jobs": 2})
+      rsa.encrypt(["", "pub", "in", "enc1"], opts)
+      self.files["good"] = (StringIO.StringIO(self.files["enc1"][0].getvalue()),
+                            "rb")
+      rsa.decrypt(["", "priv", "good", "dec"], opts)
+      self.assertEquals(self.files["dec"][0].getvalue(), "Hello")
+
+  def test_read_chunks(self):
+    data = StringIO.StringIO("abcdefg")
+    self.assertEquals(list(rsa._read_chunks(data, 3)), ["abc", "def", "g"])
+    data.seek(0)
+    self.assertEquals(list(rsa._read_chunks(data)), ["abcdefg"])
+    self.assertEquals(list(rsa._read_chunks(StringIO.StringIO(""), 3)), [""])
 
   def test_decrypt(self):
     with mock.patch("__builtin__.open") as opener:
@@ -427,6 +1633,17 @@ class test_keygen(unittest.TestCase):
       self.assertEquals(cPickle.loads(self.files["key"][0].getvalue()), 
                         self.key)
 
+  def test_keygen_workers(self):
+    with contextlib.nested(mock.patch("__builtin__.open"),
+                           mock.patch("rsa.get_distinct_primes")) as (opener,
+                                                                     search):
+      opener.side_effect = self.opener_fxn
+      search.return_value = [self.key.p, self.key.q]
+      rsa.keygen(["", "12", "key"], optparse.Values({"workers": 3}))
+      search.assert_called_once_with(12, 2, 3)
+      self.assertEquals(cPickle.loads(self.files["key"][0].getvalue()),
+                        self.key)
+
   def test_too_short(self):
     with contextlib.nested(mock.patch("__builtin__.open"),
                            mock.patch("sys.stderr"),